@@ -1,6 +1,17 @@
+import argparse
 from evolution import SDEvolver
+from session import Session
+from phenotype_cache import PhenotypeCache
 
-evolver = SDEvolver()
-evolver.start_evolution()
-
+parser = argparse.ArgumentParser(description="Evolve images interactively.")
+parser.add_argument("--cache-dir", default=None, help="Phenotype cache directory. Defaults to $SDEVOLUTION_CACHE_DIR or ./phenotype_cache")
+parser.add_argument("--session", default=None, help="Directory to save the session in. An existing session resumes")
+args = parser.parse_args()
 
+# The model loads in the background once the window is open
+evolver = SDEvolver(load = False)
+evolver.phenotype_cache = PhenotypeCache(args.cache_dir)
+if args.session:
+    evolver.session = Session(args.session)
+    evolver.session.restore(evolver)
+evolver.start_evolution()
@@ -1,4 +1,17 @@
+import argparse
 from evolution import SDXLEvolver
+from session import Session
+from phenotype_cache import PhenotypeCache
 
-evolver = SDXLEvolver(False)
-evolver.start_evolution()
\ No newline at end of file
+parser = argparse.ArgumentParser(description="Evolve images interactively.")
+parser.add_argument("--cache-dir", default=None, help="Phenotype cache directory. Defaults to $SDEVOLUTION_CACHE_DIR or ./phenotype_cache")
+parser.add_argument("--session", default=None, help="Directory to save the session in. An existing session resumes")
+args = parser.parse_args()
+
+# The model loads in the background once the window is open
+evolver = SDXLEvolver(False, load = False)
+evolver.phenotype_cache = PhenotypeCache(args.cache_dir)
+if args.session:
+    evolver.session = Session(args.session)
+    evolver.session.restore(evolver)
+evolver.start_evolution()
@@ -0,0 +1,316 @@
+"""
+Microbenchmarks for the parts of evolution that do not need a GPU.
+Each benchmark prints one JSON object per measurement, so runs can be
+compared across versions. The evolution loop is measured with the stub
+pipeline from stub_pipeline.py, so its numbers isolate this repo's own
+overhead from diffusion time.
+
+Example:
+    python benchmark.py grid --images 9 --resizes 50
+    python benchmark.py startup --model sd --prompt "a white cat"
+    python benchmark.py mutation --population 1000000
+    python benchmark.py evolution --populations 9 36 144 --generations 10
+    python benchmark.py save --populations 9 36 144
+    python benchmark.py suite > results.jsonl
+    python benchmark.py trajectory --parents 4 --children 4
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+REPORT_SCHEMA = 1 # bump when the fields of a report change meaning
+
+def versions():
+    """ Versions of the libraries whose upgrades the benchmarks watch for """
+    found = {}
+    for name in ("diffusers", "torch", "PIL", "numpy"):
+        try:
+            found[name] = __import__(name).__version__
+        except ImportError:
+            found[name] = None
+    return found
+
+def report(name, **results):
+    print(json.dumps({"benchmark" : name, "schema" : REPORT_SCHEMA, "versions" : versions(), **results}, sort_keys=True))
+
+def bench_grid(n_images, n_resizes, image_size):
+    """ Cost of filling an ImageGridViewer, then of a window resize storm """
+    import tkinter as tk
+    from PIL import Image
+    from image_grid import ImageGridViewer
+
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        print(f"Skipping grid benchmark, no display: {e}")
+        return
+
+    viewer = ImageGridViewer(root)
+    root.update()
+    images = [Image.effect_noise((image_size, image_size), 64).convert("RGB") for _ in range(n_images)]
+
+    start = time.perf_counter()
+    viewer.clear_images()
+    for (i, image) in enumerate(images):
+        viewer.add_image(image, f"image {i}")
+        root.update()
+    fill_seconds = time.perf_counter() - start
+
+    # Simulate dragging the window edge one step at a time
+    width = root.winfo_width()
+    height = root.winfo_height()
+    start = time.perf_counter()
+    for i in range(n_resizes):
+        root.geometry(f"{width - i}x{height - i}")
+        root.update()
+    drag_seconds = time.perf_counter() - start
+
+    # Let the debounced high quality pass run
+    start = time.perf_counter()
+    root.after(0, viewer._resize_done)
+    root.update()
+    settle_seconds = time.perf_counter() - start
+    root.destroy()
+
+    report("grid", images=n_images, image_size=image_size, resizes=n_resizes,
+           fill_seconds=fill_seconds, drag_seconds=drag_seconds, settle_seconds=settle_seconds)
+
+def bench_startup(model, prompt):
+    """
+    Import time, model load time and time to the first image, measured from
+    this fresh process, so run it from the command line rather than importing it.
+    """
+    start = time.perf_counter()
+    import evolution
+    import_seconds = time.perf_counter() - start
+
+    if model == "sdxl":
+        evolver = evolution.SDXLEvolver(False, load = False)
+    else:
+        evolver = evolution.SDEvolver(load = False)
+    evolver.phenotype_cache = None # A cache hit would not measure rendering
+    constructed_seconds = time.perf_counter() - start
+
+    evolver.ensure_loaded()
+    loaded_seconds = time.perf_counter() - start
+
+    evolver.evolve([], prompt, "")
+    evolver.render_genomes(evolver.genomes[:1], lambda: False, None)
+    first_image_seconds = time.perf_counter() - start
+
+    report("startup", model=model, import_seconds=import_seconds, construct_seconds=constructed_seconds - import_seconds,
+           load_seconds=loaded_seconds - constructed_seconds, first_image_seconds=first_image_seconds)
+
+def bench_mutation(population_size, generations, object_sample):
+    """ Seconds per million mutated children, vectorized and one genome object at a time """
+    from genome import SDGenome
+    from population import Population
+
+    population = Population.random(population_size, "a white cat", "", seed = 0)
+    keepers = list(range(min(10, population_size)))
+    start = time.perf_counter()
+    for _ in range(generations):
+        population = population.next_generation(keepers, population_size)
+    vector_seconds = (time.perf_counter() - start) / generations
+
+    parents = [SDGenome("a white cat", "", 0, 20, 7.5) for _ in keepers]
+    start = time.perf_counter()
+    for i in range(object_sample):
+        parents[i % len(parents)].mutated_child()
+    object_seconds = time.perf_counter() - start
+
+    report("mutation", population=population_size, generations=generations,
+           vectorized_seconds_per_million=vector_seconds * 1e6 / population_size,
+           object_seconds_per_million=object_seconds * 1e6 / object_sample)
+
+def bench_evolution(population_size, generations, image_size, seconds_per_step, keep):
+    """
+    Throughput of the evolution loop with a stub pipeline: breeding, rendering
+    and caching each generation, plus cache hit rates and history memory growth
+    """
+    from stub_pipeline import StubEvolver
+    from phenotype_cache import PhenotypeCache
+
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as directory:
+        evolver = StubEvolver(image_size, seconds_per_step)
+        evolver.population_size = population_size
+        evolver.phenotype_cache = PhenotypeCache(os.path.join(directory, "cache"))
+        evolver.evolution_history.directory = os.path.join(directory, "history")
+
+        evolve_seconds = 0.0
+        render_seconds = 0.0
+        history_bytes = []
+        start = time.perf_counter()
+        evolver.evolve([], "a white cat", "")
+        evolve_seconds += time.perf_counter() - start
+        for _ in range(generations):
+            start = time.perf_counter()
+            evolver.render_genomes(evolver.genomes, lambda: False, None)
+            render_seconds += time.perf_counter() - start
+
+            selected = sorted(random.sample(range(population_size), min(keep, population_size)))
+            start = time.perf_counter()
+            evolver.evolve(selected, "a white cat", "")
+            evolve_seconds += time.perf_counter() - start
+            history_bytes.append(sum(row["image_bytes"] + row["latent_bytes"] for row in evolver.evolution_history.memory_report()))
+
+        evolver.evolution_history.flush() # before the directory goes away
+        evolver.phenotype_cache.flush()
+        cache = evolver.phenotype_cache
+        report("evolution", population=population_size, generations=generations, image_size=image_size,
+               seconds_per_step=seconds_per_step,
+               generations_per_second=generations / (evolve_seconds + render_seconds),
+               evolve_seconds_per_generation=evolve_seconds / generations,
+               render_seconds_per_generation=render_seconds / generations,
+               pipeline_images=evolver.pipe.images, pipeline_calls=evolver.pipe.calls,
+               cache_hits=cache.hits, cache_misses=cache.misses,
+               cache_hit_rate=cache.hits / max(1, cache.hits + cache.misses),
+               history_bytes=history_bytes)
+
+def bench_save(population_size, image_size, image_format, compress_level):
+    """ Images per second saved by the background ImageWriter, including its index """
+    from stub_pipeline import StubPipeline
+    from genome import SDGenome
+    from image_writer import ImageWriter
+
+    pipe = StubPipeline(image_size)
+    genomes = [SDGenome("a white cat", "", seed, 20, 7.5) for seed in range(population_size)]
+    images = pipe(genomes)
+    with tempfile.TemporaryDirectory() as directory:
+        writer = ImageWriter(directory, image_format, compress_level)
+        start = time.perf_counter()
+        for (i, (g, image)) in enumerate(zip(genomes, images)):
+            writer.save(image, g.metadata(), i)
+        queued_seconds = time.perf_counter() - start
+        writer.close()
+        seconds = time.perf_counter() - start
+        total_bytes = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+    report("save", population=population_size, image_size=image_size, format=image_format, compress_level=compress_level,
+           queue_seconds=queued_seconds, seconds=seconds, images_per_second=population_size / seconds, bytes=total_bytes)
+
+def bench_trajectory(prompt, n_parents, n_children, steps):
+    """
+    Render small-change children of rendered parents with and without the
+    trajectory cache. Reports the speedup and how far resumed images drift
+    from full renders. Needs the real model.
+    """
+    import copy
+    import numpy as np
+    from evolution import SDEvolver
+    from genome import SDGenome, MUTATE_MAX_STEP_DELTA, MUTATE_MAX_GUIDANCE_DELTA
+    from trajectory import TrajectoryCache
+
+    rng = random.Random(0)
+    evolver = SDEvolver()
+    evolver.phenotype_cache = None # every image must really be rendered
+    evolver.trajectory_cache = TrajectoryCache()
+    parents = [SDGenome(prompt, "", seed, steps, 7.5, False) for seed in range(n_parents)]
+    evolver.render_genomes(parents, lambda: False, None)
+
+    # Mutations that keep the seed, the case trajectories help with
+    children = []
+    for parent in parents:
+        for _ in range(n_children):
+            child = SDGenome(prompt, "", parent.seed, parent.num_inference_steps, parent.guidance_scale, False, parent.id)
+            child.change_inference_steps(rng.randint(-MUTATE_MAX_STEP_DELTA, MUTATE_MAX_STEP_DELTA))
+            child.change_guidance_scale(rng.uniform(-MUTATE_MAX_GUIDANCE_DELTA, MUTATE_MAX_GUIDANCE_DELTA))
+            children.append(child)
+    full_children = [copy.copy(g) for g in children]
+
+    start = time.perf_counter()
+    evolver.render_genomes(children, lambda: False, None)
+    resumed_seconds = time.perf_counter() - start
+    stats = evolver.trajectory_cache.stats()
+
+    evolver.trajectory_cache = None
+    start = time.perf_counter()
+    evolver.render_genomes(full_children, lambda: False, None)
+    full_seconds = time.perf_counter() - start
+
+    drift = []
+    psnr = []
+    for (resumed, full) in zip(children, full_children):
+        difference = np.asarray(resumed.image, dtype=np.float64) - np.asarray(full.image, dtype=np.float64)
+        drift.append(float(np.abs(difference).mean()))
+        mse = float((difference ** 2).mean())
+        psnr.append(10 * np.log10(255.0 ** 2 / mse) if mse > 0 else None)
+
+    finite = [p for p in psnr if p is not None]
+    report("trajectory", parents=n_parents, children=len(children), steps=steps,
+           resumed_seconds=resumed_seconds, full_seconds=full_seconds, speedup=full_seconds / resumed_seconds,
+           resumed=stats["resumed"], skipped_steps=stats["skipped_steps"], checkpoint_bytes=stats["bytes"],
+           mean_abs_drift=sum(drift) / len(drift), max_abs_drift=max(drift),
+           mean_psnr=sum(finite) / len(finite) if finite else None)
+
+def bench_suite():
+    """ Every benchmark that runs without a GPU, at fixed sizes so results stay comparable """
+    for population_size in (9, 36, 144):
+        bench_evolution(population_size, 10, 256, 0.0, 2)
+    for population_size in (9, 36, 144):
+        bench_save(population_size, 512, "PNG", 6)
+    bench_mutation(1000000, 5, 100000)
+    for n_images in (9, 36):
+        bench_grid(n_images, 50, 512)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run evolution microbenchmarks.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    grid = subparsers.add_parser("grid", help="ImageGridViewer fill and resize cost")
+    grid.add_argument("--images", type=int, default=9)
+    grid.add_argument("--resizes", type=int, default=50)
+    grid.add_argument("--image-size", type=int, default=512)
+
+    startup = subparsers.add_parser("startup", help="Import, model load and first image times")
+    startup.add_argument("--model", choices=["sd", "sdxl"], default="sd")
+    startup.add_argument("--prompt", default="a white cat")
+
+    mutation = subparsers.add_parser("mutation", help="Mutation throughput of large populations")
+    mutation.add_argument("--population", type=int, default=1000000)
+    mutation.add_argument("--generations", type=int, default=5)
+    mutation.add_argument("--object-sample", type=int, default=100000, help="Children made as genome objects for comparison")
+
+    evolution = subparsers.add_parser("evolution", help="Evolution loop throughput with a stub pipeline")
+    evolution.add_argument("--populations", type=int, nargs="+", default=[9, 36, 144])
+    evolution.add_argument("--generations", type=int, default=10)
+    evolution.add_argument("--image-size", type=int, default=256)
+    evolution.add_argument("--seconds-per-step", type=float, default=0.0, help="Simulated denoising cost")
+    evolution.add_argument("--keep", type=int, default=2, help="Genomes selected each generation")
+
+    save = subparsers.add_parser("save", help="Background save throughput")
+    save.add_argument("--populations", type=int, nargs="+", default=[9, 36, 144])
+    save.add_argument("--image-size", type=int, default=512)
+    save.add_argument("--format", choices=["PNG", "JPEG", "WEBP"], default="PNG")
+    save.add_argument("--compress-level", type=int, default=6)
+
+    subparsers.add_parser("suite", help="Every benchmark that needs no GPU, at fixed sizes")
+
+    trajectory = subparsers.add_parser("trajectory", help="Speedup and drift of resuming children from parent trajectories")
+    trajectory.add_argument("--prompt", default="a white cat")
+    trajectory.add_argument("--parents", type=int, default=4)
+    trajectory.add_argument("--children", type=int, default=4, help="Children per parent")
+    trajectory.add_argument("--steps", type=int, default=20)
+
+    args = parser.parse_args()
+    if args.benchmark == "grid":
+        bench_grid(args.images, args.resizes, args.image_size)
+    elif args.benchmark == "startup":
+        bench_startup(args.model, args.prompt)
+    elif args.benchmark == "mutation":
+        bench_mutation(args.population, args.generations, args.object_sample)
+    elif args.benchmark == "evolution":
+        for population_size in args.populations:
+            bench_evolution(population_size, args.generations, args.image_size, args.seconds_per_step, args.keep)
+    elif args.benchmark == "save":
+        for population_size in args.populations:
+            bench_save(population_size, args.image_size, args.format, args.compress_level)
+    elif args.benchmark == "suite":
+        bench_suite()
+    elif args.benchmark == "trajectory":
+        bench_trajectory(args.prompt, args.parents, args.children, args.steps)
@@ -0,0 +1,53 @@
+"""
+Keeps duplicates from wasting the few slots of a population. Children
+whose parameters match a keeper or a sibling are resampled before
+anything renders (see Evolver.evolve). Optionally, a rendered child
+whose image is nearly identical to one already in the population, by
+difference hash, is mutated again and rendered again, within a bounded
+number of retries. That only happens when the population itself is
+rendered, such as in the viewer or headless.py, never for speculative
+renders (see Evolver.render_genomes).
+"""
+
+from PIL import Image
+
+DUPLICATE_RETRIES = 5 # times a child with duplicate parameters is resampled
+PERCEPTUAL_THRESHOLD = 4 # differing hash bits, out of 64, at or below which images count as duplicates
+PERCEPTUAL_RETRIES = 4 # re-renders spent on perceptual duplicates per population
+
+def dhash(image, size = 8):
+    """ 64 bit difference hash: which neighboring pixels of a tiny grayscale copy get brighter """
+    small = image.convert("L").resize((size + 1, size), Image.BILINEAR)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+class PerceptualDedup:
+    def __init__(self, images, threshold = PERCEPTUAL_THRESHOLD, retries = PERCEPTUAL_RETRIES):
+        """
+        Args:
+            images: images already in the population, such as the keepers'
+            retries: most re-renders this population may spend on duplicates
+        """
+        self.threshold = threshold
+        self.retries = retries
+        self.hashes = [dhash(image) for image in images]
+        self.rejected = 0
+
+    def accept(self, image):
+        """ Record image and return True, or return False if it duplicates one already accepted """
+        h = dhash(image)
+        if self.retries > 0 and any(hamming(h, other) <= self.threshold for other in self.hashes):
+            self.retries -= 1
+            self.rejected += 1
+            return False
+        self.hashes.append(h)
+        return True
@@ -0,0 +1,41 @@
+"""
+Least recently used cache of text encoder outputs. Every genome in a
+generation shares its prompt and negative prompt, so the text encoders
+only need to run once per generation instead of once per image.
+"""
+
+from collections import OrderedDict
+from instrumentation import tracer
+
+EMBEDDING_CACHE_SIZE = 16 # prompt pairs remembered per cache
+
+def repeat_embeds(embeds, n):
+    """ Repeat each tensor of a single prompt's embeddings n times along the batch dimension """
+    return tuple(e.repeat(n, *[1] * (e.dim() - 1)) for e in embeds)
+
+class PromptEmbeddingCache:
+    def __init__(self, max_entries = EMBEDDING_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, encode_fn):
+        """
+        Embeddings for key, usually (model, prompt, neg_prompt).
+        encode_fn() computes them on a miss.
+        """
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            tracer.count("embedding_cache.hit")
+            return self.entries[key]
+
+        self.misses += 1
+        tracer.count("embedding_cache.miss")
+        with tracer.span("encode_prompt"):
+            embeds = encode_fn()
+        self.entries[key] = embeds
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return embeds
@@ -1,37 +1,142 @@
-from image_grid import ImageGridViewer
-import tkinter as tk
+from render_worker import RenderWorker
+from phenotype_cache import PhenotypeCache, phenotype_key
+from history import EvolutionHistory
+from residency import ModelResidency, POLICY_AUTO, POLICY_SWAP
+from embedding_cache import PromptEmbeddingCache, repeat_embeds
+from dedup import PerceptualDedup, DUPLICATE_RETRIES, PERCEPTUAL_RETRIES
+from population import Population
+from render_scheduler import placeholder_image, render_steps
+from instrumentation import tracer
 import random
-from genome import (SDGenome, SDXLGenome)
-import torch
-from diffusers import EulerDiscreteScheduler
+import copy
+import time
+from genome import (SDGenome, SDXLGenome, SDLatentGenome, SDXLLatentGenome)
 from abc import ABC, abstractmethod
-from models import SD_MODEL, SDXL_MODEL
+from models import SD_MODEL, SDXL_MODEL, SDXL_REFINER
+
+# torch and diffusers take seconds to import, so they are imported where
+# they are first needed. The window can then open before they are loaded.
+
+POLL_MILLISECONDS = 100 # How often the Tk thread checks for finished renders
+
+REFINE_ENSEMBLE = "ensemble" # base denoises up to denoising_split of the schedule, the refiner finishes it
+REFINE_IMG2IMG = "img2img" # base denoises fully, then the refiner runs a light img2img pass
+IMG2IMG_STRENGTH = 0.3 # diffusers' default, which is why img2img refining ran far fewer steps than refine_steps
 
 class Evolver(ABC):
-    def __init__(self, population_size = 9):
+    def __init__(self, population_size = 9, max_batch_size = 4, device = None):
+        self.device = device # Chosen when the model loads if None
+        self.dtype = None
+        self.model_loaded = False
+        self.load_seconds = None
+        self.residency = None # ModelResidency for the pipelines of subclasses
+        self.embedding_cache = PromptEmbeddingCache() # text encoder outputs per (model, prompt, neg_prompt)
         self.population_size = population_size
+        self.max_batch_size = max_batch_size # Most genomes rendered by a single pipeline call
         self.steps = 20
         self.guidance_scale = 7.5
         self.latents_first = False
+        self.phenotype_cache = PhenotypeCache() # Set to None to always render
+        self.speculative_children = 0 # Children pre-rendered per displayed genome while the user chooses. 0 disables
+        self.speculated = {} # parent id -> children sampled ahead of time, used in order
+        self.preview_steps = 0 # Show a render with this many steps before the full image. 0 disables
+        self.previews = {} # genome id -> cheap preview image shown until the full render arrives
+        self.latent_genomes = False # Genomes that mutate their initial noise by interpolation instead of only by seed
+        self.crossover_rate = 0.25 # Chance that a child crosses two keepers, for genomes that support crossover
+        self.render_pool = None # RenderPool that renders in other processes instead of this one
+        self.fitness_selection = None # FitnessSelection that pre-selects images for the user to confirm
+        self.session = None # Session that saves every displayed generation
+        self.trajectory_cache = None # TrajectoryCache that lets children resume from a parent's partial render
+        self.duplicate_retries = DUPLICATE_RETRIES # Resamples of a child whose parameters repeat a keeper's or sibling's
+        self.perceptual_threshold = 0 # Re-mutate children whose image hash is this close to another's, such as dedup.PERCEPTUAL_THRESHOLD. 0 disables. Only for population renders, see render_genomes
+        self.perceptual_retries = PERCEPTUAL_RETRIES # Re-renders each population may spend on perceptual duplicates
+        self.vectorized_population = False # Breed with a population.Population, for automated runs with huge populations. Children only mutate: no crossover, latent noise, speculation or resampling of duplicates
+        self.population = None # Population behind self.genomes when vectorized_population is set
+        self.scheduler = None # RenderScheduler that orders batches by predicted cost and keeps to a time budget
+        self.deferred = set() # ids of displayed genomes left for later by the scheduler
+        self.image_size = 512 # width and height of rendered images, for predicting render cost
+        self.genomes = []
+        self.generation = 0
+        self.prompt = ""
+        self.neg_prompt = ""
 
-        self.evolution_history = []
+        # Older generations are spilled to disk. Raise window to keep more in RAM
+        self.evolution_history = EvolutionHistory(lambda g: phenotype_key(g, self.render_settings()), cache_fn=lambda: self.phenotype_cache)
 
     def start_evolution(self):
-        self.genomes = []
-        self.generation = 0
+        # Only the interactive front end needs a display, see headless.py otherwise
+        import tkinter as tk
+        from image_grid import ImageGridViewer
 
+        # genomes and generation are kept, since a restored session may have set them
         self.root = tk.Tk()
         self.viewer = ImageGridViewer(
             self.root, 
             callback_fn=self.next_generation,
-            initial_prompt="",
-            initial_neg_prompt="",
-            back_fn=self.previous_generation
+            initial_prompt=self.prompt,
+            initial_neg_prompt=self.neg_prompt,
+            back_fn=self.previous_generation,
+            settings_fn=self.render_settings
         )
+        self.worker = RenderWorker(self.render_genomes)
         self.fill_with_images_from_genomes(self.genomes)
+        self.root.after(POLL_MILLISECONDS, self._poll_renders)
+        # The window is usable right away: the worker loads the model as part
+        # of rendering the (empty) first population submitted above.
+
+        # Start the GUI event loop. Rendering happens on the worker thread.
+        self.root.mainloop()
+        self.worker.stop()
+        if self.session:
+            self.session.close()
+        tracer.close()
+
+    def load_model(self):
+        """ Load the pipelines. Subclasses that render in this process override this """
+        self.model_loaded = True
+
+    def ensure_loaded(self):
+        """ Load the model on first use, unless a render pool renders instead """
+        if self.model_loaded or self.render_pool:
+            return
+        start = time.perf_counter()
+        with tracer.span("load_model"):
+            self.load_model()
+        self.load_seconds = time.perf_counter() - start
+        print(f"Loaded model in {self.load_seconds:.1f}s")
+
+    def fork(self):
+        """
+        Shallow copy with its own population, history and front end, sharing the
+        loaded pipelines and caches. Lets several users evolve against one model.
+        """
+        other = copy.copy(self)
+        other.genomes = []
+        other.generation = 0
+        other.speculated = {}
+        other.population = None
+        other.previews = {}
+        other.deferred = set()
+        other.session = None
+        other.evolution_history = EvolutionHistory(lambda g: phenotype_key(g, other.render_settings()),
+                                                   self.evolution_history.window, self.evolution_history.directory,
+                                                   lambda: other.phenotype_cache, self.evolution_history.max_bytes)
+        return other
+
+    def resolve_device(self):
+        """ Pick the render device and precision once torch is imported """
+        import torch
+        if self.device is None:
+            self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        # Half precision is only fast (or supported at all) on the GPU
+        self.dtype = torch.float16 if self.device.startswith("cuda") else torch.float32
 
     def previous_generation(self):
+        if not self.evolution_history:
+            print("No previous generation")
+            return
         self.genomes = self.evolution_history.pop()
+        self.population = None # rebuilt from self.genomes if needed
         self.generation -= 1
         self.fill_with_images_from_genomes(self.genomes)
 
@@ -40,150 +145,618 @@ class Evolver(ABC):
         pass
 
     def next_generation(self,selected_images,prompt,neg_prompt):
+        if selected_images is None:
+            # No human picks: let the fitness function choose
+            selected = self.fitness_selected(self.genomes)
+        else:
+            selected = [i for (i,_) in selected_images]
+        self.evolve(selected, prompt, neg_prompt)
+        self.fill_with_images_from_genomes(self.genomes)
+
+    def fitness_selected(self, genomes):
+        """ Indices into genomes chosen by fitness, among those rendered so far. Deferred genomes have no image yet """
+        rendered = [i for (i, g) in enumerate(genomes) if g.image]
+        return [rendered[i] for i in self.fitness_selection.select([genomes[i] for i in rendered], self.generation)]
+
+    def evolve(self, selected, prompt, neg_prompt):
+        """
+        Replace self.genomes with the next generation bred from the genomes
+        at the selected indices. An empty selection resets the population.
+        Nothing is rendered here.
+        """
         self.prompt = prompt
         self.neg_prompt = neg_prompt
-        if selected_images == []:
+        if selected == []:
             print("Resetting population and generations--------------------")
-            self.initialize_population()
+            self.speculated = {}
             self.generation = 0
+            if self.vectorized_population:
+                self.population = Population.random(self.population_size, prompt, neg_prompt, self.steps, self.guidance_scale,
+                                                    getattr(self, "refine_steps", None), random.getrandbits(64))
+                self.genomes = self.population.genomes()
+            else:
+                self.initialize_population()
         else:
             print(f"Generation {self.generation}---------------------------")
-            for (i,image) in selected_images:
+            for i in selected:
                 print(f"Selected for survival: {self.genomes[i]}")
-                #self.genomes[i].set_image(image) # Done earlier, for ALL genomes
 
             # Track history of all genomes
-            self.evolution_history.append(self.genomes.copy())
+            self.evolution_history.append(self.genomes)
+            self.evolution_history.print_memory_report(self.genomes)
 
             # Pure elitism
-            keepers = [self.genomes[i] for (i,_) in selected_images]
+            keepers = [self.genomes[i] for i in selected]
+            if self.vectorized_population:
+                self.genomes = keepers + self.population_children(selected, prompt, neg_prompt)
+                self.generation += 1
+                return
 
             children = []
+            # Parameters already present. Clamped steps and guidance often repeat them
+            seen = set(phenotype_key(k, self.render_settings()) for k in keepers)
             # Fill remaining slots with mutated children
             for i in range(len(keepers), self.population_size):
-                g = random.choice(keepers).mutated_child() # New genome
-                # prompts may have changed
-                g.prompt = prompt
-                g.neg_prompt = neg_prompt
+                g = self.make_child(keepers, prompt, neg_prompt)
+                key = phenotype_key(g, self.render_settings())
+                for _ in range(self.duplicate_retries):
+                    if key not in seen:
+                        break
+                    tracer.count("dedup.resampled")
+                    g = self.make_child(keepers, prompt, neg_prompt)
+                    key = phenotype_key(g, self.render_settings())
+                seen.add(key)
                 children.append(g)
 
             # combined population
             self.genomes = keepers + children
             self.generation += 1
 
-        self.fill_with_images_from_genomes(self.genomes)
+    def population_children(self, selected, prompt, neg_prompt):
+        """ Children of the genomes at the selected indices, bred by self.population """
+        if self.population is None:
+            self.population = Population.from_genomes(self.genomes, self.generation, random.getrandbits(64))
+        self.population.prompt = prompt
+        self.population.neg_prompt = neg_prompt
+        self.population = self.population.next_generation(selected, self.population_size)
+        return self.population.genomes(range(len(selected), len(self.population)))
+
+    def make_child(self, keepers, prompt, neg_prompt):
+        """ One new genome bred from keepers, with the current prompts """
+        parent = random.choice(keepers)
+        if len(keepers) > 1 and hasattr(parent, "crossover") and random.random() < self.crossover_rate:
+            mate = random.choice([k for k in keepers if k is not parent])
+            g = parent.crossover(mate) # New genome between two parents
+        else:
+            g = self.child_of(parent) # New genome
+        # prompts may have changed
+        if (g.prompt, g.neg_prompt) != (prompt, neg_prompt):
+            # A copy, because a speculative render of the old prompts may still be running on g
+            g = copy.copy(g)
+            g.set_image(None)
+            g.step_override = None
+            if getattr(g, "base_latents", None) is not None:
+                g.base_latents = None
+        g.prompt = prompt
+        g.neg_prompt = neg_prompt
+        return g
+
+    def child_of(self, parent):
+        """ The next speculated child of parent, or a fresh mutated child once those run out """
+        children = self.speculated.get(parent.id)
+        if children:
+            return children.pop(0)
+        return parent.mutated_child()
+
+    def speculate(self, genomes):
+        """
+        Sample the children each displayed genome would get if selected and
+        render them at low priority while the user chooses. Because the
+        children are sampled now, next_generation uses exactly these genomes.
+        """
+        self.speculated = {}
+        if self.speculative_children <= 0:
+            return
+        for g in genomes:
+            children = [g.mutated_child() for _ in range(self.speculative_children)]
+            self.speculated[g.id] = children
+            self.worker.submit(children, speculative=True)
+
+    def batch_key(self, g):
+        """ genomes with equal keys can share a single pipeline call """
+        return (g.prompt, g.neg_prompt, render_steps(g), g.guidance_scale)
+
+    def make_batches(self, genomes):
+        """
+        Group the genomes that still need an image into buckets of
+        matching settings, each split into batches of at most max_batch_size.
+        """
+        buckets = {}
+        for g in genomes:
+            if not g.image:
+                buckets.setdefault(self.batch_key(g), []).append(g)
+
+        batches = []
+        for bucket in buckets.values():
+            for i in range(0, len(bucket), self.max_batch_size):
+                batches.append(bucket[i:i + self.max_batch_size])
+        return batches
+
+    def generate_image(self, g):
+        return self.generate_images([g])[0]
+
+    def initial_latents(self, pipe, genomes):
+        """
+        Initial noise for a batch, or None when the genomes only have seeds
+        and the pipeline should draw the noise from their generators.
+        """
+        if not hasattr(genomes[0], "initial_latents"):
+            return None
+        import torch
+        shape = (pipe.unet.config.in_channels, pipe.unet.config.sample_size, pipe.unet.config.sample_size)
+        return torch.stack([g.initial_latents(shape) for g in genomes]).to(self.device, self.dtype)
+
+    @abstractmethod
+    def generate_images(self, genomes):
+        """ render one batch from make_batches, returning images in the same order """
+        pass
 
     def fill_with_images_from_genomes(self,genomes):
+        """
+        Show genomes in the viewer. Cached images appear on the next poll,
+        and the rest are rendered by the worker, superseding any generation
+        that was still being rendered.
+        """
         self.viewer.clear_images()
+        self.displayed_genomes = genomes
+        self.num_displayed = 0
+        self.showing_preview = set() # viewer indices still showing a preview
+        self.grid_complete = len(genomes) == 0
+        self.generation_saved = self.grid_complete
+        self.preselect_pending = False # waiting for the worker to score the grid
+        self.previews = {}
+        self.deferred = set()
+        self.worker.submit(genomes)
+
+    def render_settings(self):
+        """
+        Settings besides the genome itself that change rendered images.
+        Half precision on a GPU renders differently from full precision on the CPU.
+        """
+        (device, dtype) = self.render_precision()
+        return {"device" : device, "dtype" : dtype}
+
+    def render_precision(self):
+        """ (device type, dtype name) that images are rendered with, as resolve_device picks them """
+        device = self.render_pool.workers[0].device if self.render_pool else self.device
+        if device is None:
+            self.resolve_device()
+            device = self.device
+        kind = device.split(":")[0]
+        return (kind, "float16" if kind == "cuda" else "float32")
+
+    def load_cached_images(self, genomes):
+        """ Fill in images from the on-disk phenotype cache where possible """
+        if not self.phenotype_cache:
+            return
+        for g in genomes:
+            if g.image:
+                tracer.count("image.reused")
+            else:
+                image = self.phenotype_cache.get(phenotype_key(g, self.render_settings()))
+                if image:
+                    print(f"Use disk cached image for {g}")
+                    g.set_image(image)
+                tracer.count("phenotype_cache.hit" if image else "phenotype_cache.miss")
+
+    def render_genomes(self, genomes, cancelled, publish, population = None):
+        """
+        Runs on the worker thread. Renders every uncached genome batch by batch.
+        population is True when genomes is the population itself, so that perceptual
+        dedup may replace its members. It defaults to whether results are published,
+        because speculative jobs render children that are not in any population.
+        """
+        if population is None:
+            population = publish is not None
+        self.load_cached_images(genomes)
+        if self.fitness_selection and publish:
+            # Score on this thread, so that pre-selecting on the Tk thread only looks scores up
+            self.fitness_selection.fitness.score([g for g in genomes if g.image])
+        batches = self.make_batches(genomes)
+        deferred = []
+        if self.scheduler:
+            (batches, deferred) = self.scheduler.plan(self, batches)
+            if publish:
+                for g in deferred:
+                    self.previews[g.id] = placeholder_image()
+                    self.deferred.add(g.id)
+        if batches or not genomes:
+            # An empty population preloads the model. A fully cached one, such as
+            # a restored session, is shown without loading it.
+            self.ensure_loaded()
+
+        def finish(batch):
+            if publish:
+                if self.fitness_selection:
+                    self.fitness_selection.fitness.score(batch)
+                publish(batch)
+            if self.phenotype_cache:
+                for g in batch:
+                    # Resumed and capped renders only approximate the full render, see trajectory.py
+                    if not getattr(g, "resumed_at_step", 0) and not getattr(g, "step_override", None):
+                        # Written in the background, so the next batch starts right away
+                        self.phenotype_cache.put_later(phenotype_key(g, self.render_settings()), g.image)
+
+        if self.render_pool:
+            with tracer.span("render_pool", images=sum(len(batch) for batch in batches)):
+                self.render_pool.render(batches, cancelled, finish)
+        else:
+            dedup = None
+            if self.perceptual_threshold > 0 and population:
+                dedup = PerceptualDedup([g.image for g in genomes if g.image], self.perceptual_threshold, self.perceptual_retries)
+            self.render_batches(batches, cancelled, publish, finish, genomes, dedup)
+        if cancelled():
+            print("Rendering superseded")
+            return
+
+        if deferred:
+            if publish and getattr(self, "worker", None):
+                # Rendered while the user looks at the rest. Placeholders are swapped out as images arrive
+                self.worker.submit(deferred, speculative=True)
+            else:
+                # Nothing would render them later, so do it now
+                self.render_batches(self.make_batches(deferred), cancelled, publish, finish)
+
+    def render_batches(self, batches, cancelled, publish, finish, population = None, dedup = None):
+        """
+        Render batches with this process's own pipelines, calling finish(batch) after each.
+        With a PerceptualDedup, a genome whose image duplicates an earlier one is replaced
+        in population by a re-mutated genome, which is rendered in a later batch.
+        """
+        # Pipelines only move between devices when a batch actually needs them,
+        # so a generation that is entirely cached never swaps models.
     
-        # SDXL generates new latents first before refining generates images
-        if self.latents_first:
+        # SDXL generates new latents first before refining generates images.
+        # Streaming instead hands each batch's latents straight to the refiner.
+        latent_seconds = {} # id(batch) -> seconds spent on its base latents
+        if self.latents_first and not self.stream_stages():
             # Do process all genomes while first model is in VRAM
-            self.pipe.to("cuda")
-            for g in self.genomes:
-                g.base_latents = self.generate_latents(g)
-                    
-            # Empty VRAM so that all latents can be refined next
-            self.pipe.to("cpu")
-            torch.cuda.empty_cache()
-            # Put refiner model in VRAM
-            self.refiner_pipe.to("cuda")
-
-        for g in self.genomes:
-            
+            for batch in batches:
+                if cancelled():
+                    break
+                start = time.perf_counter()
+                with tracer.span("generate_latents", iterations=render_steps(batch[0]), images=len(batch)):
+                    latents = self.generate_latents(batch)
+                latent_seconds[id(batch)] = time.perf_counter() - start
+                for (g, latents) in zip(batch, latents):
+                    g.base_latents = latents
+        elif self.preview_steps > 0 and publish:
+            self.render_previews(batches, cancelled, publish)
+
+        batches = list(batches)
+        for batch in batches: # grows when duplicates are replaced
+            if cancelled():
+                return
+            iterations = self.image_iterations(batch[0])
+            start = time.perf_counter()
+            with tracer.span("generate_images", iterations=iterations, images=len(batch)):
+                images = self.generate_images(batch)
+            if self.scheduler:
+                # Base latents rendered ahead of time are part of the batch's cost
+                self.scheduler.observe(self, batch, time.perf_counter() - start + latent_seconds.get(id(batch), 0.0))
+            accepted = []
+            replacements = []
+            for (g, image) in zip(batch, images):
+                if self.latents_first:
+                    g.base_latents = None # release VRAM now that the image exists
+                if dedup and g in population and not dedup.accept(image):
+                    replacement = self.remutate(g)
+                    population[population.index(g)] = replacement
+                    replacements.append(replacement)
+                    continue
+                g.set_image(image)
+                accepted.append(g)
+            if accepted:
+                finish(accepted)
+            batches.extend(self.make_batches(replacements))
+
+    def remutate(self, g):
+        """ Stand-in for a genome whose image turned out to duplicate another """
+        print(f"Image of {g} duplicates another, mutating again")
+        tracer.count("dedup.perceptual")
+        replacement = g.mutated_child()
+        replacement.parent_id = g.parent_id # same lineage as the genome it replaces
+        return replacement
+
+    def stream_stages(self):
+        """ True to run both stages of a latents_first evolver batch by batch, so only one batch of latents is held """
+        return False
+
+    def image_iterations(self, g):
+        """ Denoising steps generate_images runs for g, for instrumentation """
+        return render_steps(g)
+
+    def step_count(self, g):
+        """ Every denoising step rendering g takes, across all stages, for predicting its cost """
+        return render_steps(g)
+
+    def activate_pipe(self, name):
+        """ Make sure the named pipeline is ready on the render device """
+        if self.residency:
+            self.residency.activate(name)
+
+    def render_previews(self, batches, cancelled, publish):
+        """
+        Quickly render every batch with only preview_steps steps, so a whole
+        grid is visible long before the full quality images are done.
+        Previews are never cached as the genome's phenotype.
+        """
+        for batch in batches:
+            if cancelled():
+                return
+            previews = []
+            for g in batch:
+                preview = copy.copy(g)
+                preview.num_inference_steps = min(self.preview_steps, render_steps(g))
+                preview.step_override = None
+                preview.is_preview = True
+                previews.append(preview)
+            with tracer.span("generate_previews", iterations=previews[0].num_inference_steps, images=len(batch)):
+                images = self.generate_images(previews)
+            for (g, image) in zip(batch, images):
+                self.previews[g.id] = image
+            publish(batch)
+
+    def _poll_renders(self):
+        """ Runs on the Tk thread. Adds finished images to the viewer in population order """
+        self.worker.poll()
+        genomes = self.displayed_genomes
+
+        # Swap full quality images in for previews. Perceptual dedup may have
+        # replaced the genome since its preview was shown, so its text goes too
+        for i in list(self.showing_preview):
+            if genomes[i].image:
+                self.deferred.discard(genomes[i].id)
+                self.viewer.replace_image(i, genomes[i].image, genomes[i].__str__(), genomes[i].metadata())
+                self.showing_preview.remove(i)
+
+        while self.num_displayed < len(genomes):
+            g = genomes[self.num_displayed]
             if g.image:
-                # used saved image from previous generation
-                print(f"Use cached image for {g}")
-                image = g.image
+                self.viewer.add_image(g.image, g.__str__(), g.metadata())
+            elif g.id in self.previews:
+                self.viewer.add_image(self.previews[g.id], g.__str__(), g.metadata())
+                self.showing_preview.add(self.num_displayed)
             else:
-                image = self.generate_image(g)
-                g.set_image(image)
+                break
+            self.num_displayed += 1
+
+        # Deferred genomes do not hold up the grid, their placeholders are replaced later
+        waiting = [i for i in self.showing_preview if genomes[i].id not in self.deferred]
+        if not self.model_loaded and not self.render_pool and (self.num_displayed < len(genomes) or not genomes):
+            self.viewer.set_status("Loading model...")
+        elif self.num_displayed < len(genomes) or waiting:
+            self.viewer.set_status(f"Rendering {self.num_displayed - len(self.showing_preview)}/{len(genomes)}")
+        elif self.showing_preview:
+            self.viewer.set_status(f"Ready, {len(self.showing_preview)} deferred")
+        else:
+            self.viewer.set_status("Ready")
 
-            # Add image to viewer
-            self.viewer.add_image(image, g.__str__(), g.metadata())
-        
-            # Update the GUI to show new image
-            self.root.update()
+        if not self.grid_complete and self.num_displayed == len(genomes) and not waiting:
+            print("Make selections and click \"Evolve\"")
+            self.grid_complete = True
+            self.preselect_pending = self.fitness_selection is not None
+            tracer.end_generation(self.generation)
+            self.speculate(genomes)
 
-        if self.latents_first:
-            # Take refiner out of VRAM so base model can do in next generation
-            self.refiner_pipe.to("cpu")
-            torch.cuda.empty_cache()
-    
-        print("Make selections and click \"Evolve\"")
-        # Start the GUI event loop
-        self.root.mainloop()
+        if self.preselect_pending and self.fitness_selection.fitness.scored([g for g in genomes if g.image]):
+            # The worker scores each batch before publishing it, so this rarely waits
+            self.preselect_pending = False
+            self.viewer.set_selection(self.fitness_selected(genomes))
 
-from diffusers import StableDiffusionPipeline
+        if self.grid_complete and not self.generation_saved and not self.showing_preview:
+            # Waits for deferred genomes, so that the session records every image
+            self.generation_saved = True
+            if self.session:
+                self.session.save_generation(self)
+
+        self.root.after(POLL_MILLISECONDS, self._poll_renders)
 
 class SDEvolver(Evolver):
-    def __init__(self):
-        Evolver.__init__(self)
+    def __init__(self, device = None, residency_policy = POLICY_AUTO, load = True):
+        """ Use load = False when a render pool does the rendering and this process needs no model """
+        Evolver.__init__(self, device = device)
+        self.residency_policy = residency_policy
+        if load:
+            self.load_model()
+
+    def load_model(self):
+        from diffusers import StableDiffusionPipeline, EulerDiscreteScheduler
         global SD_MODEL
         print(f"Using {SD_MODEL}")
+        self.resolve_device()
 
         # I disabled the safety checker. There is a risk of NSFW content.
         self.pipe = StableDiffusionPipeline.from_pretrained(
             SD_MODEL,
-            torch_dtype=torch.float16,
+            torch_dtype=self.dtype,
             custom_pipeline="lpw_stable_diffusion", # Allows token weighting, as in "A (white:1.5) cat"
             safety_checker = None,
             requires_safety_checker = False
         )
-        self.pipe.to("cuda")
 
         # Default is PNDMScheduler
         self.pipe.scheduler = EulerDiscreteScheduler.from_config(
             self.pipe.scheduler.config
         )
 
-    def initialize_population(self):
-        self.genomes = [SDGenome(self.prompt, self.neg_prompt, seed, self.steps, self.guidance_scale) for seed in range(self.population_size)]
+        self.residency = ModelResidency({"base" : self.pipe}, self.device, self.residency_policy)
+        self.model_loaded = True
 
-    def generate_image(self, g):
-        # generate fresh new image
-        print(f"Generate new image for {g}")
-        generator = torch.Generator("cuda").manual_seed(g.seed)
-        image = self.pipe(
-            g.prompt,
-            generator=generator,
-            guidance_scale=g.guidance_scale,
-            num_inference_steps=g.num_inference_steps
-        ).images[0]
+    def encode_prompt(self, prompt, neg_prompt):
+        """ (prompt_embeds, negative_prompt_embeds), with lpw token weighting applied """
+        import torch
+        def encode():
+            with torch.no_grad():
+                # Returns negative and positive embeddings concatenated for classifier free guidance
+                embeds = self.pipe._encode_prompt(prompt, self.pipe._execution_device, 1, True, neg_prompt)
+            (negative_prompt_embeds, prompt_embeds) = embeds.chunk(2)
+            return (prompt_embeds, negative_prompt_embeds)
+        return self.embedding_cache.get((SD_MODEL, prompt, neg_prompt), encode)
 
-        return image
+    def initialize_population(self):
+        genome_class = SDLatentGenome if self.latent_genomes else SDGenome
+        self.genomes = [genome_class(self.prompt, self.neg_prompt, seed, self.steps, self.guidance_scale) for seed in range(self.population_size)]
+
+    def generate_images(self, genomes):
+        # generate fresh new images. Every genome in the batch shares the settings in batch_key
+        import torch
+        for g in genomes:
+            print(f"Generate new image for {g}")
+        if self.trajectory_cache and not getattr(genomes[0], "is_preview", False):
+            # Previews would save checkpoints that the genome's own full render could then resume from
+            return self.generate_images_with_trajectories(genomes)
+        g = genomes[0]
+        # One generator per genome, so each image matches a batch of size 1 with the same seed
+        generators = [torch.Generator(self.device).manual_seed(bg.seed) for bg in genomes]
+        self.activate_pipe("base")
+        (prompt_embeds, negative_prompt_embeds) = repeat_embeds(self.encode_prompt(g.prompt, g.neg_prompt), len(genomes))
+        images = self.pipe(
+            None,
+            prompt_embeds=prompt_embeds,
+            negative_prompt_embeds=negative_prompt_embeds,
+            generator=generators,
+            latents=self.initial_latents(self.pipe, genomes),
+            guidance_scale=g.guidance_scale,
+            num_inference_steps=render_steps(g)
+        ).images
+
+        return images
+
+    def generate_images_with_trajectories(self, genomes):
+        """
+        Same as the pipeline call, but with the denoising loop run here so that
+        latents can be saved at checkpoints and children can start from their
+        parent's checkpoints. Genomes that resume at the same step share a call.
+        """
+        import torch
+        g = genomes[0]
+        self.activate_pipe("base")
+        scheduler = self.new_scheduler(render_steps(g))
+        sigmas = scheduler.sigmas.tolist()
+
+        groups = {} # start step -> [(index in genomes, resume point)]
+        for (i, bg) in enumerate(genomes):
+            point = self.trajectory_cache.resume_point(bg, sigmas)
+            groups.setdefault(point[0] if point else 0, []).append((i, point))
+
+        images = [None] * len(genomes)
+        for (start, members) in groups.items():
+            group = [genomes[i] for (i, _) in members]
+            generators = [torch.Generator(self.device).manual_seed(bg.seed) for bg in group]
+            if start == 0:
+                latents = self.initial_latents(self.pipe, group)
+                if latents is None:
+                    shape = (self.pipe.unet.config.in_channels, self.pipe.unet.config.sample_size, self.pipe.unet.config.sample_size)
+                    latents = torch.stack([torch.randn(shape, generator=gen, device=self.device, dtype=self.dtype) for gen in generators])
+                latents = latents * scheduler.init_noise_sigma
+                self.trajectory_cache.full += len(group)
+            else:
+                # Add just enough fresh noise to bring each checkpoint up to the noise level of step start
+                saved = torch.stack([point[2] for (_, point) in members]).to(self.device, self.dtype)
+                extra = torch.tensor([max(0.0, sigmas[start] ** 2 - point[1] ** 2) ** 0.5 for (_, point) in members],
+                                     device=self.device, dtype=self.dtype).view(-1, 1, 1, 1)
+                noise = torch.stack([torch.randn(saved.shape[1:], generator=gen, device=self.device, dtype=self.dtype) for gen in generators])
+                latents = saved + extra * noise
+                self.trajectory_cache.resumed += len(group)
+                self.trajectory_cache.skipped_steps += start * len(group)
+            for bg in group:
+                bg.resumed_at_step = start
+
+            # Schedulers keep track of their step, so every call needs its own
+            for (image, (i, _)) in zip(self.denoise(group, latents, self.new_scheduler(render_steps(g)), start), members):
+                images[i] = image
+        return images
+
+    def new_scheduler(self, steps):
+        from diffusers import EulerDiscreteScheduler
+        scheduler = EulerDiscreteScheduler.from_config(self.pipe.scheduler.config)
+        scheduler.set_timesteps(steps, device=self.device)
+        return scheduler
+
+    def denoise(self, genomes, latents, scheduler, start):
+        """ Euler denoising from step start of scheduler's schedule, saving checkpoints on the way if start is 0 """
+        import torch
+        g = genomes[0]
+        (prompt_embeds, negative_prompt_embeds) = repeat_embeds(self.encode_prompt(g.prompt, g.neg_prompt), len(genomes))
+        embeds = torch.cat([negative_prompt_embeds, prompt_embeds])
+        # Only full renders save checkpoints. A resumed render's latents already drifted,
+        # and children resuming from them would drift further every generation
+        checkpoints = self.trajectory_cache.checkpoint_indices(len(scheduler.timesteps)) if start == 0 else []
+        if hasattr(scheduler, "set_begin_index"):
+            scheduler.set_begin_index(start)
 
-from diffusers import (
-    StableDiffusionXLPipeline,
-    StableDiffusionXLImg2ImgPipeline
-)
+        with torch.no_grad():
+            for i in range(start, len(scheduler.timesteps)):
+                t = scheduler.timesteps[i]
+                latent_input = scheduler.scale_model_input(torch.cat([latents] * 2), t)
+                noise_pred = self.pipe.unet(latent_input, t, encoder_hidden_states=embeds).sample
+                (noise_uncond, noise_text) = noise_pred.chunk(2)
+                noise_pred = noise_uncond + g.guidance_scale * (noise_text - noise_uncond)
+                latents = scheduler.step(noise_pred, t, latents).prev_sample
+                if i in checkpoints:
+                    for (bg, bg_latents) in zip(genomes, latents):
+                        self.trajectory_cache.put(bg, scheduler.sigmas[i + 1], g.guidance_scale, bg_latents)
+
+            decoded = self.pipe.vae.decode(latents / self.pipe.vae.config.scaling_factor).sample
+        return self.pipe.image_processor.postprocess(decoded, output_type="pil")
 
 class SDXLEvolver(Evolver):
-    def __init__(self, refine):
-        Evolver.__init__(self, 4) # Smaller population size, generation takes so long
+    def __init__(self, refine, device = None, residency_policy = POLICY_AUTO, load = True, refine_mode = REFINE_ENSEMBLE):
+        """
+        Use load = False when a render pool does the rendering and this process needs no model.
+        refine_mode is REFINE_ENSEMBLE or REFINE_IMG2IMG, and only matters when refine is True.
+        """
+        Evolver.__init__(self, 4, device = device) # Smaller population size, generation takes so long
 
         self.refine_steps = 20
+        self.image_size = 1024
         if refine:
             self.latents_first = True
         else:
             self.latents_first = False 
-
+        self.refine_mode = refine_mode
+        self.residency_policy = residency_policy
+        if load:
+            self.load_model()
+
+    def load_model(self):
+        from diffusers import (
+            StableDiffusionXLPipeline,
+            StableDiffusionXLImg2ImgPipeline,
+            EulerDiscreteScheduler
+        )
+        refine = self.latents_first
         print(f"Using {SDXL_MODEL}")
+        self.resolve_device()
 
         self.pipe = StableDiffusionXLPipeline.from_pretrained(
             SDXL_MODEL,
-            torch_dtype=torch.float16
+            torch_dtype=self.dtype
         )
+        pipes = {"base" : self.pipe}
 
         if refine:
-            self.refiner_model = SDXL_REFINER,
+            self.refiner_model = SDXL_REFINER
+            print(f"Refining with {SDXL_REFINER} ({self.refine_mode})")
+            # The refiner shares the base model's second text encoder and VAE
             self.refiner_pipe = StableDiffusionXLImg2ImgPipeline.from_pretrained(
                 self.refiner_model,
-                torch_dtype = torch.float16
+                text_encoder_2 = self.pipe.text_encoder_2,
+                vae = self.pipe.vae,
+                torch_dtype = self.dtype
             )
-        else:
-            # Since there will be no switching, just put in cuda now
-            self.pipe.to("cuda")
+            pipes["refiner"] = self.refiner_pipe
 
         self.pipe.scheduler = EulerDiscreteScheduler.from_config(
             self.pipe.scheduler.config
@@ -193,46 +766,127 @@ class SDXLEvolver(Evolver):
                 self.refiner_pipe.scheduler.config
             )
 
-    def initialize_population(self):
-        self.genomes = [SDXLGenome(self.prompt, self.neg_prompt, seed, self.steps, self.guidance_scale, self.refine_steps) for seed in range(self.population_size)]
+        # Owns the base and refiner pipelines, swapping them in and out of VRAM if they do not both fit
+        self.residency = ModelResidency(pipes, self.device, self.residency_policy)
+        self.model_loaded = True
 
-    def generate_latents(self,g):
+    def initialize_population(self):
+        genome_class = SDXLLatentGenome if self.latent_genomes else SDXLGenome
+        self.genomes = [genome_class(self.prompt, self.neg_prompt, seed, self.steps, self.guidance_scale, self.refine_steps) for seed in range(self.population_size)]
+
+    def ensemble(self):
+        return self.latents_first and self.refine_mode == REFINE_ENSEMBLE
+
+    def batch_key(self, g):
+        # One pipeline call takes a single split point or refine step count
+        if self.ensemble():
+            return Evolver.batch_key(self, g) + (g.denoising_split,)
+        return Evolver.batch_key(self, g) + (g.refine_steps,)
+
+    def render_settings(self):
+        # The refiner changes the image, and refine_steps and denoising_split only matter when it is used
+        settings = Evolver.render_settings(self)
+        if not self.latents_first:
+            settings.update({"refine" : False, "ignored_fields" : ["refine_steps", "denoising_split"]})
+        elif self.ensemble():
+            settings.update({"refine" : True, "refine_mode" : self.refine_mode, "ignored_fields" : ["refine_steps"]})
+        else:
+            settings.update({"refine" : True, "refine_mode" : self.refine_mode, "ignored_fields" : ["denoising_split"]})
+        return settings
+
+    def stream_stages(self):
+        # Streaming would move pipelines in and out of VRAM for every batch
+        return self.residency is not None and self.residency.policy != POLICY_SWAP
+
+    def image_iterations(self, g):
+        if not self.latents_first:
+            return render_steps(g)
+        if self.ensemble():
+            return render_steps(g) - int(render_steps(g) * g.denoising_split)
+        return int(g.refine_steps * IMG2IMG_STRENGTH)
+
+    def step_count(self, g):
+        # Ensemble refining finishes the base model's schedule rather than adding steps to it
+        if self.latents_first and not self.ensemble():
+            return render_steps(g) + int(g.refine_steps * IMG2IMG_STRENGTH)
+        return render_steps(g)
+
+    def prompt_kwargs(self, pipe, model, g, n):
+        """ Cached prompt embedding arguments for a batch of n images rendered by pipe """
+        import torch
+        def encode():
+            with torch.no_grad():
+                return pipe.encode_prompt(
+                    prompt = g.prompt,
+                    device = pipe._execution_device,
+                    num_images_per_prompt = 1,
+                    do_classifier_free_guidance = True,
+                    negative_prompt = g.neg_prompt
+                )
+        embeds = repeat_embeds(self.embedding_cache.get((model, g.prompt, g.neg_prompt), encode), n)
+        names = ("prompt_embeds", "negative_prompt_embeds", "pooled_prompt_embeds", "negative_pooled_prompt_embeds")
+        return dict(zip(names, embeds))
+
+    def generate_latents(self, genomes):
         # generate latents first
-        print(f"Generate base latents for {g}")
-        generator = torch.Generator("cuda").manual_seed(g.seed)
+        import torch
+        for g in genomes:
+            print(f"Generate base latents for {g}")
+        g = genomes[0]
+        generators = [torch.Generator(self.device).manual_seed(bg.seed) for bg in genomes]
+        self.activate_pipe("base")
         with torch.no_grad():
             base_latents = self.pipe(
-                prompt = g.prompt,
-                generator=generator,
+                generator=generators,
                 guidance_scale=g.guidance_scale,
-                num_inference_steps=g.num_inference_steps,
-                negative_prompt = g.neg_prompt,
-                output_type = "latent"
-            ).images[0]
-
-        return base_latents
-
-    def generate_image(self, g):
-        
-        print(f"Generate new image for {g}")
-        generator = torch.Generator("cuda").manual_seed(g.seed)
+                num_inference_steps=render_steps(g),
+                denoising_end = g.denoising_split if self.ensemble() else None, # stop early, still noisy
+                latents = self.initial_latents(self.pipe, genomes),
+                output_type = "latent",
+                **self.prompt_kwargs(self.pipe, SDXL_MODEL, g, len(genomes))
+            ).images
+
+        return list(base_latents)
+
+    def generate_images(self, genomes):
+        import torch
+        for g in genomes:
+            print(f"Generate new image for {g}")
+        g = genomes[0]
+        generators = [torch.Generator(self.device).manual_seed(bg.seed) for bg in genomes]
 
         if self.latents_first:
+            if any(bg.base_latents is None for bg in genomes):
+                # Streaming: this batch's base pass has not run yet
+                with tracer.span("generate_latents", iterations=render_steps(g), images=len(genomes)):
+                    latents = self.generate_latents(genomes)
+            else:
+                latents = [bg.base_latents for bg in genomes]
+
+            self.activate_pipe("refiner")
+            if self.ensemble():
+                # The refiner picks up the same schedule where the base stopped
+                stage_kwargs = {"num_inference_steps" : render_steps(g), "denoising_start" : g.denoising_split,
+                                "guidance_scale" : g.guidance_scale}
+            else:
+                # img2img only runs strength times the steps it is given
+                stage_kwargs = {"num_inference_steps" : g.refine_steps, "strength" : IMG2IMG_STRENGTH}
             with torch.no_grad():
-                image = self.refiner_pipe(
-                    prompt = g.prompt,
-                    generator=generator,
-                    negative_prompt = g.neg_prompt,
-                    num_inference_steps=g.refine_steps, # Actual steps is roughly 1/4th of the value provided here, but the exact reason is not clear
-                    image = [g.base_latents]
-                ).images[0]
+                images = self.refiner_pipe(
+                    generator=generators,
+                    image = torch.stack(latents),
+                    **stage_kwargs,
+                    **self.prompt_kwargs(self.refiner_pipe, self.refiner_model, g, len(genomes))
+                ).images
         else:
+            self.activate_pipe("base")
             with torch.no_grad():
-                image = self.pipe(
-                    prompt = g.prompt,
-                    generator=generator,
-                    negative_prompt = g.neg_prompt,
-                    num_inference_steps=g.num_inference_steps 
-                ).images[0]
-
-        return image
+                images = self.pipe(
+                    generator=generators,
+                    guidance_scale=g.guidance_scale,
+                    num_inference_steps=render_steps(g),
+                    latents = self.initial_latents(self.pipe, genomes),
+                    **self.prompt_kwargs(self.pipe, SDXL_MODEL, g, len(genomes))
+                ).images
+
+        return images
@@ -0,0 +1,135 @@
+"""
+Automatic fitness functions that score rendered genomes, so that
+survivors can be chosen without a person clicking on every image.
+A FitnessSelection can stand in for the human in headless runs, or
+pre-select images in the viewer so that the user only has to confirm.
+"""
+
+import random
+from abc import ABC, abstractmethod
+
+class FitnessFunction(ABC):
+    """
+    Scores genomes by their images, higher is better. Scores are computed
+    in batches and cached by genome id, so keepers are never scored twice.
+    """
+    def __init__(self, batch_size = 8):
+        self.batch_size = batch_size
+        self.scores = {} # genome id -> score
+
+    @abstractmethod
+    def score_images(self, images, genomes):
+        """ Return one score per image """
+        pass
+
+    def scored(self, genomes):
+        """ True if every genome already has a score """
+        return all(g.id in self.scores for g in genomes)
+
+    def score(self, genomes):
+        """ Scores for every genome, in order. Every genome must already have an image """
+        todo = [g for g in genomes if g.id not in self.scores]
+        for i in range(0, len(todo), self.batch_size):
+            batch = todo[i:i + self.batch_size]
+            for (g, score) in zip(batch, self.score_images([g.image for g in batch], batch)):
+                self.scores[g.id] = float(score)
+        return [self.scores[g.id] for g in genomes]
+
+class CallableFitness(FitnessFunction):
+    """ Wraps any function from a PIL image to a score """
+    def __init__(self, fn, batch_size = 8):
+        FitnessFunction.__init__(self, batch_size)
+        self.fn = fn
+
+    def score_images(self, images, genomes):
+        return [self.fn(image) for image in images]
+
+class ClipFitness(FitnessFunction):
+    """ Base for fitness functions computed from CLIP embeddings """
+    def __init__(self, model_name = "openai/clip-vit-large-patch14", device = None, batch_size = 8):
+        FitnessFunction.__init__(self, batch_size)
+        # Imported here so that plain callables work without transformers
+        import torch
+        from transformers import CLIPModel, CLIPProcessor
+        self.torch = torch
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = device
+        self.model = CLIPModel.from_pretrained(model_name).to(device).eval()
+        self.processor = CLIPProcessor.from_pretrained(model_name)
+
+    def image_embeds(self, images):
+        with self.torch.no_grad():
+            inputs = self.processor(images=images, return_tensors="pt").to(self.device)
+            embeds = self.model.get_image_features(**inputs)
+        return embeds / embeds.norm(dim=-1, keepdim=True)
+
+    def text_embeds(self, texts):
+        with self.torch.no_grad():
+            inputs = self.processor(text=texts, return_tensors="pt", padding=True, truncation=True).to(self.device)
+            embeds = self.model.get_text_features(**inputs)
+        return embeds / embeds.norm(dim=-1, keepdim=True)
+
+class ClipPromptFitness(ClipFitness):
+    """
+    Cosine similarity between each image and a text. By default that is
+    the prompt the genome was rendered with.
+    """
+    def __init__(self, text = None, **kwargs):
+        ClipFitness.__init__(self, **kwargs)
+        self.text = text
+
+    def score_images(self, images, genomes):
+        texts = [self.text if self.text is not None else g.prompt for g in genomes]
+        return (self.image_embeds(images) * self.text_embeds(texts)).sum(dim=-1).tolist()
+
+class AestheticFitness(ClipFitness):
+    """
+    Applies an aesthetic predictor head, such as the LAION aesthetic MLP,
+    to normalized CLIP image embeddings. head maps a (batch, dim) tensor to
+    (batch,) or (batch, 1) scores.
+    """
+    def __init__(self, head, **kwargs):
+        ClipFitness.__init__(self, **kwargs)
+        self.head = head
+
+    def score_images(self, images, genomes):
+        with self.torch.no_grad():
+            scores = self.head(self.image_embeds(images))
+        return scores.reshape(-1).tolist()
+
+def top_k(scores, k):
+    """ Indices of the k best scores, in population order """
+    best = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:k]
+    return sorted(best)
+
+def tournament(scores, k, tournament_size = 3, rng = random):
+    """ k distinct winners of tournaments between randomly drawn indices, in population order """
+    remaining = list(range(len(scores)))
+    winners = []
+    while remaining and len(winners) < k:
+        entrants = rng.sample(remaining, min(tournament_size, len(remaining)))
+        winner = max(entrants, key=lambda i: scores[i])
+        winners.append(winner)
+        remaining.remove(winner)
+    return sorted(winners)
+
+class FitnessSelection:
+    """
+    Chooses survivors by fitness. Has the same select method as the
+    selection policies in headless.py, so it can replace human picks.
+    """
+    def __init__(self, fitness, keep = 2, method = "top_k", tournament_size = 3, seed = None):
+        self.fitness = fitness
+        self.keep = keep
+        self.method = method
+        self.tournament_size = tournament_size
+        self.rng = random.Random(seed)
+
+    def select(self, genomes, generation = None):
+        scores = self.fitness.score(genomes)
+        for (g, score) in zip(genomes, scores):
+            print(f"Fitness {score:.4f} for {g}")
+        if self.method == "tournament":
+            return tournament(scores, self.keep, self.tournament_size, self.rng)
+        return top_k(scores, self.keep)
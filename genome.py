@@ -5,16 +5,29 @@ to Stable Diffusion. Can be mutated to change the configuration.
 
 import random
 import json
+import ast
+import math
 from models import SD_MODEL, SDXL_MODEL
 
 MUTATE_MAX_STEP_DELTA = 10
 MUTATE_MAX_REFINE_STEP_DELTA = 20 # Made large: actual steps is just 1/4th of parameter value for some reason
 MUTATE_MAX_GUIDANCE_DELTA = 1.0
+MUTATE_MAX_SPLIT_DELTA = 0.1
+DEFAULT_DENOISING_SPLIT = 0.8 # Fraction of the schedule the SDXL base denoises before the refiner takes over
+MIN_DENOISING_SPLIT = 0.5
+MAX_DENOISING_SPLIT = 0.95
+DEFAULT_REFINE_STEPS = 20 # for SDXL metadata saved before refine_steps was recorded
 
 genome_id = 0
 
+def next_genome_id():
+    global genome_id
+    genome_id += 1
+    return genome_id - 1
+
 class SDGenome:
-    def __init__(self, prompt, neg_prompt, seed, steps, guidance_scale, randomize = True, parent_id = None):
+    def __init__(self, prompt, neg_prompt, seed, steps, guidance_scale, randomize = True, parent_id = None, genome_id = None):
+        """ genome_id keeps an id allocated in advance. None takes the next free one """
         self.prompt = prompt
         self.neg_prompt = neg_prompt
         self.seed = seed
@@ -26,9 +39,10 @@ class SDGenome:
             self.change_inference_steps(random.randint(-MUTATE_MAX_STEP_DELTA, MUTATE_MAX_STEP_DELTA))
             self.change_guidance_scale(random.uniform(-MUTATE_MAX_GUIDANCE_DELTA, MUTATE_MAX_GUIDANCE_DELTA))
         
-        global genome_id
-        self.id = genome_id
-        genome_id += 1
+        if genome_id is None:
+            self.id = next_genome_id()
+        else:
+            self.id = genome_id
         self.parent_id = parent_id
         self.image = None
 
@@ -77,20 +91,25 @@ class SDGenome:
         return child
 
 class SDXLGenome(SDGenome):
-    def __init__(self, prompt, neg_prompt, seed, steps, guidance_scale, refine_steps, randomize = True, parent_id = None):
-        SDGenome.__init__(self, prompt, neg_prompt, seed, steps, guidance_scale, randomize, parent_id)
+    def __init__(self, prompt, neg_prompt, seed, steps, guidance_scale, refine_steps, randomize = True, parent_id = None, denoising_split = DEFAULT_DENOISING_SPLIT, genome_id = None):
+        SDGenome.__init__(self, prompt, neg_prompt, seed, steps, guidance_scale, randomize, parent_id, genome_id)
         self.refine_steps = refine_steps
+        self.denoising_split = denoising_split
         self.base_latents = None
 
         if randomize: 
             self.change_refine_steps(random.randint(-MUTATE_MAX_REFINE_STEP_DELTA, MUTATE_MAX_REFINE_STEP_DELTA))
+            self.change_denoising_split(random.uniform(-MUTATE_MAX_SPLIT_DELTA, MUTATE_MAX_SPLIT_DELTA))
 
     def change_refine_steps(self, delta):
         self.refine_steps += delta
         self.refine_steps = max(1, self.refine_steps) # Do not go below 1 step
 
+    def change_denoising_split(self, delta):
+        self.denoising_split = min(MAX_DENOISING_SPLIT, max(MIN_DENOISING_SPLIT, self.denoising_split + delta))
+
     def __str__(self):
-        return f"SDXLGenome(id={self.id},parent_id={self.parent_id},prompt=\"{self.prompt}\",neg_prompt=\"{self.neg_prompt}\",seed={self.seed},steps={self.num_inference_steps},guidance={self.guidance_scale},refine_steps={self.refine_steps})"
+        return f"SDXLGenome(id={self.id},parent_id={self.parent_id},prompt=\"{self.prompt}\",neg_prompt=\"{self.neg_prompt}\",seed={self.seed},steps={self.num_inference_steps},guidance={self.guidance_scale},refine_steps={self.refine_steps},split={self.denoising_split:.2f})"
 
     def metadata(self):
         return {
@@ -101,7 +120,8 @@ class SDXLGenome(SDGenome):
             "neg_prompt" : self.neg_prompt,
             "seed" : self.seed,
             "num_inference_steps" : self.num_inference_steps,
-            # "refine_steps" : self.refine_steps,
+            "refine_steps" : self.refine_steps,
+            "denoising_split" : self.denoising_split,
             "guidance_scale" : self.guidance_scale
         }
 
@@ -114,8 +134,170 @@ class SDXLGenome(SDGenome):
             self.change_inference_steps(random.randint(-MUTATE_MAX_STEP_DELTA, MUTATE_MAX_STEP_DELTA))
             self.change_guidance_scale(random.uniform(-MUTATE_MAX_GUIDANCE_DELTA, MUTATE_MAX_GUIDANCE_DELTA))
             self.change_refine_steps(random.randint(-MUTATE_MAX_REFINE_STEP_DELTA, MUTATE_MAX_REFINE_STEP_DELTA))
+            self.change_denoising_split(random.uniform(-MUTATE_MAX_SPLIT_DELTA, MUTATE_MAX_SPLIT_DELTA))
+
+    def mutated_child(self):
+        child = SDXLGenome(self.prompt, self.neg_prompt, self.seed, self.num_inference_steps, self.guidance_scale, self.refine_steps, False, self.id, self.denoising_split)
+        child.mutate()
+        return child
+
+MUTATE_MAX_NOISE_STRENGTH = 0.3 # Largest step of a noise mutation toward fresh noise
+MAX_NOISE_TERMS = 16 # Most seeds a noise recipe mixes. The weakest are dropped beyond that
+
+def noise_latents(recipe, shape):
+    """
+    Initial noise described by a recipe: the sum of the noise of each seed in
+    recipe["terms"] times its weight, scaled back to unit variance. No terms means
+    the noise of recipe["seed"] alone. Generated on the CPU so that it is
+    identical on every device.
+    """
+    import torch
+    terms = recipe["terms"] or [(recipe["seed"], 1.0)]
+    latents = sum(weight * torch.randn(shape, generator=torch.Generator("cpu").manual_seed(seed)) for (seed, weight) in terms)
+    return latents / sum(weight ** 2 for (_, weight) in terms) ** 0.5
+
+def mix_noise_terms(a, b, t):
+    """
+    Terms for noise partway from terms a (t = 0) to terms b (t = 1). For independent
+    noise this is a spherical interpolation. Shared seeds merge, so the list stays
+    bounded however many generations of crossover it went through.
+    """
+    angle = t * math.pi / 2
+    weights = {}
+    for (terms, scale) in ((a, math.cos(angle)), (b, math.sin(angle))):
+        for (seed, weight) in terms:
+            weights[seed] = weights.get(seed, 0.0) + scale * weight
+    kept = sorted(weights.items(), key=lambda term: abs(term[1]), reverse=True)[:MAX_NOISE_TERMS]
+    norm = sum(weight ** 2 for (_, weight) in kept) ** 0.5
+    if norm < 1e-12:
+        return list(a)
+    return [(seed, weight / norm) for (seed, weight) in kept]
+
+class NoiseLatentsMixin:
+    """
+    For genomes whose initial noise is a weighted mix of the noise of several
+    seeds, instead of the noise of the seed alone. A mutation can then nudge
+    the noise part of the way toward fresh noise rather than replacing it,
+    and two parents can be crossed by mixing their noise. Only seeds and
+    weights are stored, never the noise itself, and at most MAX_NOISE_TERMS.
+    """
+    def set_seed(self, new_seed):
+        self.seed = new_seed
+        self.noise_terms = [] # old terms mixed in the old seed's noise
+
+    def own_noise_terms(self):
+        return self.noise_terms or [(self.seed, 1.0)]
+
+    def noise_recipe(self):
+        return {"seed" : self.seed, "terms" : [list(term) for term in self.noise_terms]}
+
+    def initial_latents(self, shape):
+        return noise_latents(self.noise_recipe(), shape)
+
+    def perturb_noise(self, strength):
+        self.noise_terms = mix_noise_terms(self.own_noise_terms(), [(random.getrandbits(64), 1.0)], strength)
+
+    def mutate(self):
+        if bool(random.getrandbits(1)):
+            # Medium change: move part of the way toward fresh noise
+            self.perturb_noise(random.uniform(0.0, MUTATE_MAX_NOISE_STRENGTH))
+        else:
+            super().mutate()
+
+    def crossover(self, other):
+        """ Child with noise partway between both parents and settings taken from either """
+        child = self.child()
+        child.noise_terms = mix_noise_terms(self.own_noise_terms(), other.own_noise_terms(), random.random())
+        child.num_inference_steps = random.choice([self.num_inference_steps, other.num_inference_steps])
+        child.guidance_scale = random.choice([self.guidance_scale, other.guidance_scale])
+        return child
+
+class SDLatentGenome(NoiseLatentsMixin, SDGenome):
+    def __init__(self, prompt, neg_prompt, seed, steps, guidance_scale, randomize = True, parent_id = None, noise_terms = ()):
+        SDGenome.__init__(self, prompt, neg_prompt, seed, steps, guidance_scale, randomize, parent_id)
+        self.noise_terms = [tuple(term) for term in noise_terms]
+
+    def __str__(self):
+        return f"SDLatentGenome(id={self.id},parent_id={self.parent_id},prompt=\"{self.prompt}\",neg_prompt=\"{self.neg_prompt}\",seed={self.seed},noise_terms={len(self.noise_terms)},steps={self.num_inference_steps},guidance={self.guidance_scale})"
+
+    def metadata(self):
+        metadata = SDGenome.metadata(self)
+        metadata["noise"] = self.noise_recipe()
+        return metadata
+
+    def child(self):
+        """ Unmutated copy with its own id """
+        return SDLatentGenome(self.prompt, self.neg_prompt, self.seed, self.num_inference_steps, self.guidance_scale, False, self.id, self.noise_terms)
 
     def mutated_child(self):
-        child = SDXLGenome(self.prompt, self.neg_prompt, self.seed, self.num_inference_steps, self.guidance_scale, self.refine_steps, False, self.id)
+        child = self.child()
         child.mutate()
         return child
+
+class SDXLLatentGenome(NoiseLatentsMixin, SDXLGenome):
+    def __init__(self, prompt, neg_prompt, seed, steps, guidance_scale, refine_steps, randomize = True, parent_id = None, noise_terms = (), denoising_split = DEFAULT_DENOISING_SPLIT):
+        SDXLGenome.__init__(self, prompt, neg_prompt, seed, steps, guidance_scale, refine_steps, randomize, parent_id, denoising_split)
+        self.noise_terms = [tuple(term) for term in noise_terms]
+
+    def __str__(self):
+        return f"SDXLLatentGenome(id={self.id},parent_id={self.parent_id},prompt=\"{self.prompt}\",neg_prompt=\"{self.neg_prompt}\",seed={self.seed},noise_terms={len(self.noise_terms)},steps={self.num_inference_steps},guidance={self.guidance_scale},refine_steps={self.refine_steps},split={self.denoising_split:.2f})"
+
+    def metadata(self):
+        metadata = SDXLGenome.metadata(self)
+        metadata["noise"] = self.noise_recipe()
+        return metadata
+
+    def child(self):
+        """ Unmutated copy with its own id """
+        return SDXLLatentGenome(self.prompt, self.neg_prompt, self.seed, self.num_inference_steps, self.guidance_scale, self.refine_steps, False, self.id, self.noise_terms, self.denoising_split)
+
+    def mutated_child(self):
+        child = self.child()
+        child.mutate()
+        return child
+
+def reserve_genome_ids(next_id):
+    """ Make sure new genomes get ids from next_id on, such as after loading a saved session """
+    global genome_id
+    genome_id = max(genome_id, next_id)
+
+def genome_from_metadata(metadata, genome_class = None):
+    """
+    Rebuild the genome that produced metadata(), keeping its id and parent_id.
+    Unless given, the class follows metadata["model"], and only without a known
+    model is it guessed from the fields present. Values may be strings, as they
+    are when read back from PNG text chunks.
+    """
+    noise = metadata.get("noise")
+    if isinstance(noise, str):
+        noise = ast.literal_eval(noise)
+    if genome_class is None:
+        model = metadata.get("model")
+        if model == SDXL_MODEL:
+            sdxl = True
+        elif model == SD_MODEL:
+            sdxl = False
+        else:
+            if model is not None:
+                print(f"Warning: metadata is from {model}, which is neither {SD_MODEL} nor {SDXL_MODEL}")
+            sdxl = "refine_steps" in metadata
+        if sdxl:
+            genome_class = SDXLLatentGenome if noise else SDXLGenome
+        else:
+            genome_class = SDLatentGenome if noise else SDGenome
+
+    args = [metadata["prompt"], metadata["neg_prompt"], int(metadata["seed"]),
+            int(metadata["num_inference_steps"]), float(metadata["guidance_scale"])]
+    if issubclass(genome_class, SDXLGenome):
+        args.append(int(metadata.get("refine_steps", DEFAULT_REFINE_STEPS)))
+    parent_id = metadata.get("parent_id")
+    parent_id = None if parent_id in (None, "None") else int(parent_id)
+
+    g = genome_class(*args, randomize = False, parent_id = parent_id)
+    if issubclass(genome_class, SDXLGenome):
+        g.denoising_split = float(metadata.get("denoising_split", DEFAULT_DENOISING_SPLIT))
+    g.id = int(metadata["id"])
+    if noise and issubclass(genome_class, NoiseLatentsMixin):
+        g.noise_terms = [tuple(term) for term in noise["terms"]]
+    reserve_genome_ids(g.id + 1)
+    return g
@@ -0,0 +1,181 @@
+"""
+Runs evolution without a display. Survivors are chosen by a scripted
+selection policy instead of clicks, and every generation is written to
+an output directory as PNGs with embedded metadata plus one line of
+JSON per generation in generations.jsonl.
+
+Example:
+    python headless.py --prompt "a white cat" --generations 10 --policy random --output runs/cat
+"""
+
+import argparse
+import functools
+import json
+import os
+import random
+import time
+from png_metadata import png_info
+from phenotype_cache import PhenotypeCache
+from instrumentation import tracer
+
+class RandomSelection:
+    """ Keep a random handful of genomes each generation """
+    def __init__(self, keep = 2, seed = None):
+        self.keep = keep
+        self.rng = random.Random(seed)
+
+    def select(self, genomes, generation):
+        return sorted(self.rng.sample(range(len(genomes)), min(self.keep, len(genomes))))
+
+class FileSelection:
+    """
+    Replay selections from a text file. Each line holds the indices kept
+    in one generation, separated by commas or spaces. An empty line resets
+    the population, just like clicking "Reset" with nothing selected.
+    """
+    def __init__(self, path):
+        with open(path) as f:
+            self.lines = [line.strip() for line in f]
+
+    def select(self, genomes, generation):
+        if generation >= len(self.lines):
+            raise ValueError(f"No selection for generation {generation} in selection file")
+        return [int(i) for i in self.lines[generation].replace(",", " ").split()]
+
+class CallbackSelection:
+    """ Let any function of (genomes, generation) pick the surviving indices """
+    def __init__(self, fn):
+        self.fn = fn
+
+    def select(self, genomes, generation):
+        return list(self.fn(genomes, generation))
+
+class HeadlessEvolution:
+    def __init__(self, evolver, policy, output_dir):
+        self.evolver = evolver
+        self.policy = policy
+        self.output_dir = output_dir
+        self.timings = [] # seconds spent rendering each generation
+        os.makedirs(output_dir, exist_ok=True)
+
+    def render(self):
+        """ Render the current population on this thread """
+        start = time.perf_counter()
+        self.evolver.render_genomes(self.evolver.genomes, lambda: False, None, population = True)
+        seconds = time.perf_counter() - start
+        self.timings.append(seconds)
+        return seconds
+
+    def save(self, step, selected, seconds):
+        directory = os.path.join(self.output_dir, f"step{step:04d}")
+        os.makedirs(directory, exist_ok=True)
+        with tracer.span("save_generation", images=len(self.evolver.genomes)):
+            for (i, g) in enumerate(self.evolver.genomes):
+                g.image.save(os.path.join(directory, f"Image_Id{g.id}_Num{i}.png"), "PNG", pnginfo=png_info(g.metadata()))
+
+        with open(os.path.join(self.output_dir, "generations.jsonl"), "a") as f:
+            f.write(json.dumps({
+                "step" : step,
+                "generation" : self.evolver.generation,
+                "render_seconds" : seconds,
+                "selected" : selected,
+                "genomes" : [g.metadata() for g in self.evolver.genomes]
+            }) + "\n")
+
+    def run(self, prompt, neg_prompt, steps):
+        """ Run steps rounds of render, save and select, starting from a fresh population """
+        self.evolver.evolve([], prompt, neg_prompt)
+        for step in range(steps):
+            seconds = self.render()
+            selected = self.policy.select(self.evolver.genomes, step)
+            print(f"Step {step}: rendered generation {self.evolver.generation} in {seconds:.2f}s, selected {selected}")
+            self.save(step, selected, seconds)
+            tracer.end_generation(self.evolver.generation)
+            self.evolver.evolve(selected, prompt, neg_prompt)
+
+        total = sum(self.timings)
+        print(f"Rendered {len(self.timings)} generations in {total:.2f}s ({total / max(1, len(self.timings)):.2f}s per generation)")
+
+def make_evolver(model, refine = False, device = None, load = True, refine_mode = "ensemble"):
+    """ Also the factory that render pool workers build their evolver with """
+    # Imported here so that --help works without loading torch
+    from evolution import SDEvolver, SDXLEvolver
+    if model == "stub":
+        from stub_pipeline import StubEvolver
+        return StubEvolver(device = device or "cpu", load = load)
+    if model == "sdxl":
+        return SDXLEvolver(refine, device = device, load = load, refine_mode = refine_mode)
+    return SDEvolver(device = device, load = load)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evolve images without a display.")
+    parser.add_argument("--model", choices=["sd", "sdxl", "stub"], default="sd",
+                        help="Which evolver to use. stub renders placeholder images without a GPU")
+    parser.add_argument("--refine", action="store_true", help="Use the SDXL refiner")
+    parser.add_argument("--refine-mode", choices=["ensemble", "img2img"], default="ensemble",
+                        help="ensemble hands partly denoised latents to the refiner, img2img refines finished latents")
+    parser.add_argument("--device", default=None, help="Render device, such as cuda:1 or cpu")
+    parser.add_argument("--workers", nargs="+", default=None, metavar="DEVICE",
+                        help="Render in one worker process per listed device instead, such as cuda:0 cuda:1")
+    parser.add_argument("--prompt", required=True)
+    parser.add_argument("--neg-prompt", default="")
+    parser.add_argument("--generations", type=int, default=10, help="Number of render and select rounds")
+    parser.add_argument("--population-size", type=int, default=None)
+    parser.add_argument("--vectorized", action="store_true",
+                        help="Breed each generation with NumPy array operations, for very large populations. Children only mutate")
+    parser.add_argument("--batch-size", type=int, default=None, help="Most images per pipeline call")
+    parser.add_argument("--policy", choices=["random", "file", "clip"], default="random",
+                        help="clip keeps the images closest to the prompt according to CLIP")
+    parser.add_argument("--keep", type=int, default=2, help="Genomes kept per generation by the random and clip policies")
+    parser.add_argument("--tournament", type=int, default=0, help="Tournament size for the clip policy. 0 keeps the top scores")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for selections and mutations")
+    parser.add_argument("--selections", help="Selection file for the file policy")
+    parser.add_argument("--output", default="headless_output", help="Directory for images and metadata")
+    parser.add_argument("--budget", type=float, default=None, help="Predicted render seconds allowed per generation")
+    parser.add_argument("--over-budget", choices=["defer", "cap"], default="defer",
+                        help="What happens to batches that do not fit the budget: render them last, or with fewer steps")
+    parser.add_argument("--cache-dir", default=None, help="Phenotype cache directory. Defaults to $SDEVOLUTION_CACHE_DIR or ./phenotype_cache")
+    parser.add_argument("--trace", default=None, help="JSON Lines file that gets per-stage timings of every generation")
+    parser.add_argument("--chrome-trace", default=None, help="Also write every timed stage as a Chrome trace")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed) # mutation randomness
+    if args.trace or args.chrome_trace:
+        tracer.enable(args.trace, args.chrome_trace)
+
+    if args.policy == "file":
+        if not args.selections:
+            parser.error("--policy file needs --selections")
+        policy = FileSelection(args.selections)
+    elif args.policy == "clip":
+        from fitness import ClipPromptFitness, FitnessSelection
+        method = "tournament" if args.tournament > 0 else "top_k"
+        policy = FitnessSelection(ClipPromptFitness(device=args.device), args.keep, method, args.tournament, args.seed)
+    else:
+        policy = RandomSelection(args.keep, args.seed)
+
+    pool = None
+    if args.workers:
+        from render_pool import RenderPool
+        pool = RenderPool(functools.partial(make_evolver, args.model, args.refine, refine_mode = args.refine_mode), args.workers)
+    evolver = make_evolver(args.model, args.refine, args.device, load = pool is None, refine_mode = args.refine_mode)
+    evolver.render_pool = pool
+    evolver.phenotype_cache = PhenotypeCache(args.cache_dir)
+    if args.population_size:
+        evolver.population_size = args.population_size
+    evolver.vectorized_population = args.vectorized
+    if args.batch_size:
+        evolver.max_batch_size = args.batch_size
+    if args.budget is not None:
+        from render_scheduler import RenderScheduler
+        evolver.scheduler = RenderScheduler(args.budget, args.over_budget)
+
+    HeadlessEvolution(evolver, policy, args.output).run(args.prompt, args.neg_prompt, args.generations)
+    if pool:
+        for (i, stats) in enumerate(pool.stats()):
+            print(f"Worker {i}: {stats}")
+        pool.close()
+    if evolver.scheduler:
+        print(f"Scheduler: {evolver.scheduler.report()}")
+    tracer.close()
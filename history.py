@@ -0,0 +1,153 @@
+"""
+Bounded record of earlier generations for the "Previous Generation"
+button. The most recent generations stay in RAM as they were. Older ones
+are compacted to genome parameters only: their images are spilled to
+disk and loaded again when the generation is popped.
+
+An image the phenotype cache already holds is not written again, the
+record just points at the cached file. Anything else is written on a
+background thread into a size-capped store, so compacting never stalls
+the thread that calls evolve. If a spilled image has been evicted by the
+time its generation is popped, it is rendered again.
+"""
+
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from phenotype_cache import PhenotypeCache
+
+HISTORY_DIR = "history"
+HISTORY_WINDOW = 3 # Generations whose images stay in RAM
+HISTORY_MAX_BYTES = 512 * 1024 ** 2 # Disk for spilled images the phenotype cache does not already hold
+
+def image_bytes(image):
+    """ Approximate RAM used by a PIL image """
+    if image is None:
+        return 0
+    return image.width * image.height * len(image.getbands())
+
+def latent_bytes(latents):
+    if latents is None:
+        return 0
+    return latents.numel() * latents.element_size()
+
+class EvolutionHistory:
+    def __init__(self, key_fn, window=HISTORY_WINDOW, directory=HISTORY_DIR, cache_fn=None, max_bytes=HISTORY_MAX_BYTES):
+        """
+        Args:
+            key_fn: maps a genome to a name for its spilled image. Genomes that share
+                    a key must share an image, so a phenotype_key works well.
+            window: number of most recent generations that keep images in RAM
+            directory: where compacted generations keep images the cache does not hold
+            cache_fn: returns the PhenotypeCache whose files can be reused, or None
+            max_bytes: size cap of directory
+        """
+        self.key_fn = key_fn
+        self.window = window
+        self.directory = directory
+        self.cache_fn = cache_fn
+        self.max_bytes = max_bytes
+        self.store = None # created on the first spill, so directory can still be changed
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.pending = {} # id of a generation list -> future of its spill
+        self.generations = []
+
+    def __len__(self):
+        return len(self.generations)
+
+    def append(self, genomes):
+        """ Record a copy of genomes, so later changes to the population do not leak in """
+        generation = []
+        for g in genomes:
+            record = copy.copy(g)
+            if record.image and getattr(record, "base_latents", None) is not None:
+                record.base_latents = None # Only needed until the image is rendered
+            generation.append(record)
+        self.generations.append(generation)
+
+        if len(self.generations) > self.window:
+            self._compact(self.generations[-self.window - 1])
+
+    def pop(self):
+        """ Remove the latest generation, loading any spilled images back in """
+        generation = self.generations.pop()
+        future = self.pending.pop(id(generation), None)
+        if future:
+            future.result() # only when going back faster than images are written
+        for g in generation:
+            if not g.image and getattr(g, "history_image_path", None):
+                try:
+                    with Image.open(g.history_image_path) as image:
+                        image.load()
+                        g.set_image(image)
+                except OSError:
+                    print(f"Missing history image for {g}, will render again")
+        return generation
+
+    def _compact(self, generation):
+        """ Drop every image in generation from RAM, spilling those the cache lacks to disk """
+        cache = self.cache_fn() if self.cache_fn else None
+        spill = []
+        for g in generation:
+            if getattr(g, "base_latents", None) is not None:
+                g.base_latents = None
+            if not g.image:
+                continue
+            key = self.key_fn(g)
+            # Resumed renders are never in the phenotype cache, see trajectory.py
+            # The file must already exist, pop opens it directly
+            if cache is not None and cache.on_disk(key) and not getattr(g, "resumed_at_step", 0):
+                g.history_image_path = cache.path(key)
+                g.set_image(None)
+            else:
+                spill.append((g, key))
+        if spill:
+            if self.store is None:
+                self.store = PhenotypeCache(self.directory, self.max_bytes)
+            future = self.writer.submit(self._spill, spill)
+            self.pending[id(generation)] = future
+            future.add_done_callback(lambda _, key=id(generation): self.pending.pop(key, None))
+
+    def _spill(self, spill):
+        """ Runs on the writer thread """
+        for (g, key) in spill:
+            try:
+                self.store.put(key, g.image)
+            except OSError as e:
+                print(f"Could not spill history image for {g}, keeping it in RAM: {e}")
+                continue
+            g.history_image_path = self.store.path(key)
+            g.set_image(None)
+
+    def flush(self):
+        """ Wait for every spill to be written """
+        for future in list(self.pending.values()):
+            future.result()
+
+    def memory_report(self, live_genomes=()):
+        """
+        What each recorded generation costs, as a list of dicts. An image is only
+        counted once: not if live_genomes or an earlier generation holds it too.
+        """
+        counted = set(id(g.image) for g in live_genomes if g.image)
+        report = []
+        for (i, generation) in enumerate(self.generations):
+            images = [g.image for g in generation if g.image and id(g.image) not in counted]
+            images = list({id(image): image for image in images}.values())
+            counted.update(id(image) for image in images)
+            report.append({
+                "generation" : i,
+                "genomes" : len(generation),
+                "image_bytes" : sum(image_bytes(image) for image in images),
+                "latent_bytes" : sum(latent_bytes(getattr(g, "base_latents", None)) for g in generation),
+                "spilled_images" : sum(1 for g in generation if not g.image and getattr(g, "history_image_path", None))
+            })
+        return report
+
+    def print_memory_report(self, live_genomes=()):
+        total = 0
+        for row in self.memory_report(live_genomes):
+            cost = row["image_bytes"] + row["latent_bytes"]
+            total += cost
+            print(f"History generation {row['generation']}: {row['genomes']} genomes, {cost / 2**20:.1f} MB in RAM, {row['spilled_images']} images on disk")
+        print(f"History total: {total / 2**20:.1f} MB in RAM, not counting images still on screen")
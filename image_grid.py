@@ -1,16 +1,22 @@
 import tkinter as tk
-from PIL import Image, ImageTk, PngImagePlugin
+from PIL import Image, ImageTk
+from image_writer import ImageWriter
+from instrumentation import tracer
 from math import ceil, sqrt
 import io
-import re
 import json
 
 """
 This class was made by Claude: https://claude.ai/
 """
 
+RESIZE_DEBOUNCE_MS = 250  # High quality thumbnails are made once resizing pauses this long
+FAST_RESAMPLE = Image.Resampling.BILINEAR  # Used while the window is being resized
+FINAL_RESAMPLE = Image.Resampling.LANCZOS
+MIN_THUMBNAIL_SIZE = 100
+
 class ImageGridViewer:
-    def __init__(self, root, callback_fn=None, initial_prompt="", initial_neg_prompt="", back_fn=None):
+    def __init__(self, root, callback_fn=None, initial_prompt="", initial_neg_prompt="", back_fn=None, writer=None, settings_fn=None):
         self.root = root
         self.root.title("Generated Images")
         self.images = []  # Stores PIL Image objects
@@ -19,8 +25,16 @@ class ImageGridViewer:
         self.buttons = []  # Stores the button widgets
         self.tooltips = []  # Stores tooltip text for each image
         self.metadata = []  # to be embedded in PNG images
+        self.thumbnails = {}  # (id(image), size, resample) -> PhotoImage, so thumbnails are only made once
+        self.grid_columns = 0  # Columns and thumbnail size the buttons are currently laid out for
+        self.thumbnail_size = None
+        self.thumbnail_resample = FINAL_RESAMPLE
+        self._resize_pending = None  # after ids used to coalesce <Configure> events
+        self._resize_final = None
         self.callback_fn = callback_fn
         self.back_fn = back_fn
+        self.settings_fn = settings_fn  # render settings for the phenotype of saved images
+        self.writer = writer or ImageWriter()  # saves selected images off the Tk thread
         
         # Initial window sizing
         screen_width = root.winfo_screenwidth()
@@ -83,6 +97,10 @@ class ImageGridViewer:
             width=20
         )
         self.close_button.pack(side=tk.LEFT, padx=5, pady=5)
+
+        # Shows model loading and rendering progress
+        self.status_label = tk.Label(self.button_frame, text="", anchor=tk.W)
+        self.status_label.pack(side=tk.LEFT, padx=5, pady=5, fill=tk.X, expand=True)
         
         # Create prompt input frame
         self.prompt_frame = tk.Frame(self.control_frame)
@@ -107,12 +125,17 @@ class ImageGridViewer:
         # Bind resize event
         self.root.bind('<Configure>', self._on_window_resize)
 
+    def set_status(self, text):
+        if self.status_label.cget("text") != text:
+            self.status_label.config(text=text)
+
     def clear_images(self):
         """Clears all images from the grid and resets selections."""
         self.images.clear()
         self.tooltips.clear()
         self.metadata.clear()
         self.selected_images.clear()
+        self.thumbnails.clear()
         self._update_grid()
 
     def add_image(self, pil_image, tooltip_text="", image_metadata=None):
@@ -126,8 +149,27 @@ class ImageGridViewer:
         self.images.append(pil_image)
         self.tooltips.append(tooltip_text)
         self.metadata.append(image_metadata)
-        self._update_grid()
+
+        if self._grid_columns() == self.grid_columns and self._target_thumbnail_size() == self.thumbnail_size:
+            # Layout is unchanged, so only the new button needs to be made
+            idx = len(self.images) - 1
+            self._create_button(idx)
+            self._place_button(idx, self.thumbnail_resample)
+        else:
+            self._update_grid()
         
+    def replace_image(self, idx, pil_image, tooltip_text=None, image_metadata=None):
+        """ Swap the image at idx, such as a preview for its full quality render, and optionally its tooltip and metadata """
+        old = self.images[idx]
+        self.thumbnails = {key: photo for (key, photo) in self.thumbnails.items() if key[0] != id(old)}
+        self.images[idx] = pil_image
+        if tooltip_text is not None:
+            self.tooltips[idx] = tooltip_text
+            self._create_tooltip(self.buttons[idx], tooltip_text)
+        if image_metadata is not None:
+            self.metadata[idx] = image_metadata
+        self._place_button(idx, self.thumbnail_resample)
+
     def get_selected_images(self):
         """Returns list of selected PIL Image objects."""
         return [(i,self.images[i]) for i in self.selected_images]
@@ -143,7 +185,7 @@ class ImageGridViewer:
         if n_images == 0:
             return (256, 256)  # Default size if no images
         
-        grid_size = min(3, ceil(sqrt(n_images)))
+        grid_size = self._grid_columns()
         
         # Calculate thumbnail size to fit the grid with some padding
         padding = 50  # Additional padding for margins and buttons
@@ -185,71 +227,124 @@ class ImageGridViewer:
             widget.bind('<Enter>', enter)
             widget.bind('<Leave>', leave)
     
+    def _grid_columns(self):
+        return min(3, ceil(sqrt(len(self.images))))
+
+    def _target_thumbnail_size(self):
+        thumbnail_size = self._calculate_thumbnail_size()
+        return (max(MIN_THUMBNAIL_SIZE, thumbnail_size[0]), max(MIN_THUMBNAIL_SIZE, thumbnail_size[1]))
+
     def _on_window_resize(self, event):
         """Handles window resize event."""
-        # Only update if the resize is significant to prevent excessive redraws
-        if event.widget == self.root:
-            self._update_grid()
-    
-    def _update_grid(self):
-        # Clear existing buttons
-        for button in self.buttons:
-            button.destroy()
-        self.buttons.clear()
-        self.photo_images.clear()
+        if event.widget != self.root:
+            return
+        # Dragging the window edge fires this for every pixel. Redraw at most
+        # once per idle period with cheap thumbnails, then once more in high
+        # quality after the resizing stops.
+        if self._resize_pending is None:
+            self._resize_pending = self.root.after_idle(self._resize_fast)
+        if self._resize_final is not None:
+            self.root.after_cancel(self._resize_final)
+        self._resize_final = self.root.after(RESIZE_DEBOUNCE_MS, self._resize_done)
+
+    def _resize_fast(self):
+        self._resize_pending = None
+        # Moving the window also sends <Configure>, without changing the size
+        if self._target_thumbnail_size() != self.thumbnail_size:
+            self._update_grid(FAST_RESAMPLE)
+
+    def _resize_done(self):
+        self._resize_final = None
+        if self._target_thumbnail_size() != self.thumbnail_size or self.thumbnail_resample != FINAL_RESAMPLE:
+            self._update_grid(FINAL_RESAMPLE)
+        # Thumbnails of sizes passed through during the resize will not be needed again
+        self.thumbnails = {key: photo for (key, photo) in self.thumbnails.items() if key[1] == self.thumbnail_size}
+
+    def _thumbnail(self, idx, resample):
+        """ PhotoImage of image idx at the current thumbnail size, made only once per size """
+        img = self.images[idx]
+        photo = self.thumbnails.get((id(img), self.thumbnail_size, FINAL_RESAMPLE))
+        if photo is None:
+            photo = self.thumbnails.get((id(img), self.thumbnail_size, resample))
+        if photo is None:
+            tracer.count("thumbnail.miss")
+            # Same result as copy() then thumbnail(), without copying the full image first
+            scale = min(self.thumbnail_size[0] / img.width, self.thumbnail_size[1] / img.height, 1.0)
+            thumb = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), resample)
+            photo = ImageTk.PhotoImage(thumb)
+            self.thumbnails[(id(img), self.thumbnail_size, resample)] = photo
+        else:
+            tracer.count("thumbnail.hit")
+        return photo
+
+    def _create_button(self, idx):
+        btn = tk.Button(
+            self.image_frame,
+            relief='solid',
+            borderwidth=2
+        )
+        
+        # Add tooltip
+        self._create_tooltip(btn, self.tooltips[idx])
+        
+        # Configure selection behavior
+        btn.configure(
+            command=lambda i=idx, b=btn: self._toggle_selection(i, b)
+        )
+
+        self.buttons.append(btn)
+        self.photo_images.append(None)
+        
+        # Update selected state if necessary
+        if idx in self.selected_images:
+            btn.configure(bg='blue')
+
+    def _place_button(self, idx, resample):
+        """ Show the current thumbnail of image idx in its grid cell """
+        photo = self._thumbnail(idx, resample)
+        self.photo_images[idx] = photo
+        btn = self.buttons[idx]
+        btn.configure(image=photo)
+        
+        # Position in grid
+        row = idx // self.grid_columns
+        col = idx % self.grid_columns
+        btn.grid(row=row, column=col, padx=5, pady=5, sticky='nsew')
+        
+        # Configure grid weights to make buttons resize
+        self.image_frame.grid_rowconfigure(row, weight=1)
+        self.image_frame.grid_columnconfigure(col, weight=1)
+
+    def _update_grid(self, resample=FINAL_RESAMPLE):
+        """ Lay out every image, reusing existing buttons and cached thumbnails """
+        # Remove buttons for images that are gone
+        while len(self.buttons) > len(self.images):
+            self.buttons.pop().destroy()
+            self.photo_images.pop()
         
         # Calculate grid dimensions
-        n_images = len(self.images)
-        if n_images == 0:
+        if len(self.images) == 0:
+            self.grid_columns = 0
+            self.thumbnail_size = None
             return
             
-        # Dynamically calculate grid size
-        grid_size = min(3, ceil(sqrt(n_images)))
-        
-        # Get dynamic thumbnail size
-        thumbnail_size = self._calculate_thumbnail_size()
-        thumbnail_size = (max(100,thumbnail_size[0]), max(100,thumbnail_size[1]))
+        # Dynamically calculate grid size and thumbnail size
+        self.grid_columns = self._grid_columns()
+        self.thumbnail_size = self._target_thumbnail_size()
+        self.thumbnail_resample = resample
 
-        for idx, img in enumerate(self.images):
-            # Create a copy and resize for thumbnail
-            thumb = img.copy()
-            thumb.thumbnail(thumbnail_size, Image.Resampling.LANCZOS)
-            
-            # Convert to PhotoImage
-            photo = ImageTk.PhotoImage(thumb)
-            self.photo_images.append(photo)
-            
-            # Create button
-            btn = tk.Button(
-                self.image_frame,
-                image=photo,
-                relief='solid',
-                borderwidth=2
-            )
-            
-            # Add tooltip
-            self._create_tooltip(btn, self.tooltips[idx])
-            
-            # Configure selection behavior
-            btn.configure(
-                command=lambda i=idx, b=btn: self._toggle_selection(i, b)
-            )
-            
-            # Position in grid
-            row = idx // grid_size
-            col = idx % grid_size
-            btn.grid(row=row, column=col, padx=5, pady=5, sticky='nsew')
-            
-            # Configure grid weights to make buttons resize
-            self.image_frame.grid_rowconfigure(row, weight=1)
-            self.image_frame.grid_columnconfigure(col, weight=1)
-            
-            self.buttons.append(btn)
-            
-            # Update selected state if necessary
-            if idx in self.selected_images:
-                btn.configure(bg='blue')
+        with tracer.span("update_grid", images=len(self.images), resample=str(resample)):
+            for idx in range(len(self.images)):
+                if idx == len(self.buttons):
+                    self._create_button(idx)
+                self._place_button(idx, resample)
     
+    def set_selection(self, indices):
+        """ Select exactly the images at indices, such as ones picked by a fitness function """
+        for idx in set(self.selected_images) | set(indices):
+            if (idx in self.selected_images) != (idx in indices):
+                self._toggle_selection(idx, self.buttons[idx])
+
     def _toggle_selection(self, idx, button):
         if idx in self.selected_images:
             self.selected_images.remove(idx)
@@ -274,22 +369,10 @@ class ImageGridViewer:
             self.callback_fn(selected, prompt, neg_prompt)
 
     def _save_selected(self):
-        selected = self.get_selected_images()
-        for (i,image) in selected:
-            full_desc = self.tooltips[i]
-            image_meta = self.metadata[i]
-
-            #print(image_meta)
-            #print(type(image_meta))
-
-            metadata = PngImagePlugin.PngInfo()
-            for key in image_meta:
-                metadata.add_text(f"sd_{key}", str(image_meta[key]))
-
-            match = re.search(r"id=(\d+)", full_desc)
-            output = f"Image_Id{match.group(1)}_Num{i}.png"
-            image.save(output, "PNG", pnginfo=metadata)
-            print(f"Saved {output}")
+        """ Hands the selected images to the background writer, so the window never waits on disk """
+        settings = self.settings_fn() if self.settings_fn else None
+        for (i, image) in self.get_selected_images():
+            self.writer.save(image, self.metadata[i], i, settings)
 
     def _handle_back(self):
         """Called when Back button is clicked"""
@@ -0,0 +1,161 @@
+"""
+Saves images on background threads and records every save in an
+append-only index, saved_images.jsonl, holding the metadata() of each
+image. The index can be searched by prompt, seed or lineage and
+deduplicated without opening any of the saved files.
+
+Example:
+    python image_writer.py --prompt cat --dedup
+    python image_writer.py --lineage 42 --dir saved
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from png_metadata import png_info
+from phenotype_cache import metadata_key
+from instrumentation import tracer
+
+INDEX_FILE = "saved_images.jsonl"
+WRITER_THREADS = 2
+PNG_COMPRESS_LEVEL = 6 # 0 is fastest and largest, 9 is slowest and smallest
+LOSSY_QUALITY = 95 # for JPEG and WEBP
+
+EXTENSIONS = {"PNG" : "png", "JPEG" : "jpg", "WEBP" : "webp"}
+
+class ImageWriter:
+    def __init__(self, directory=".", image_format="PNG", compress_level=PNG_COMPRESS_LEVEL, quality=LOSSY_QUALITY, threads=WRITER_THREADS):
+        """
+        Args:
+            directory: where images and the index are saved
+            image_format: PNG, JPEG or WEBP. Only PNG embeds the metadata in the
+                          file itself, but the index always has it
+        """
+        if image_format not in EXTENSIONS:
+            raise ValueError(f"Unsupported image format {image_format}, use one of {list(EXTENSIONS)}")
+        self.directory = directory
+        self.image_format = image_format
+        self.compress_level = compress_level
+        self.quality = quality
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.lock = threading.Lock()
+        self.reserved = set() # file names handed out but possibly not written yet
+        os.makedirs(directory, exist_ok=True)
+
+    def _unique_name(self, genome_id, num):
+        """ A file name no earlier save used, so nothing is overwritten """
+        extension = EXTENSIONS[self.image_format]
+        base = f"Image_Id{genome_id}_Num{num}"
+        name = f"{base}.{extension}"
+        copy = 1
+        with self.lock:
+            while name in self.reserved or os.path.exists(os.path.join(self.directory, name)):
+                copy += 1
+                name = f"{base}_{copy}.{extension}"
+            self.reserved.add(name)
+        return name
+
+    def save(self, image, metadata, num, settings=None):
+        """
+        Queue image for saving and return its future path. num is its
+        position in the grid, which is part of the file name. settings are
+        the render settings the phenotype cache keys include, such as
+        Evolver.render_settings(), so the index phenotype matches the cache key.
+        """
+        metadata = metadata or {}
+        name = self._unique_name(metadata.get("id", "unknown"), num)
+        path = os.path.join(self.directory, name)
+        self.pool.submit(self._write, image, metadata, path, settings)
+        return path
+
+    def _write(self, image, metadata, path, settings):
+        try:
+            with tracer.span("save_image", format=self.image_format):
+                if self.image_format == "PNG":
+                    image.save(path, "PNG", pnginfo=png_info(metadata), compress_level=self.compress_level)
+                else:
+                    image.convert("RGB").save(path, self.image_format, quality=self.quality)
+            row = dict(metadata)
+            row["file"] = os.path.basename(path)
+            row["saved_at"] = time.time()
+            row["phenotype"] = metadata_key(metadata, settings)
+            with self.lock:
+                with open(self.index_path, "a") as f:
+                    f.write(json.dumps(row, default=str) + "\n")
+            print(f"Saved {path}")
+        except Exception as e:
+            print(f"Could not save {path}: {e}")
+
+    def close(self):
+        """ Wait for queued saves """
+        self.pool.shutdown(wait=True)
+
+def load_index(directory="."):
+    """ Every row of the index in directory, oldest first """
+    path = os.path.join(directory, INDEX_FILE)
+    if not os.path.exists(path):
+        return []
+    rows = []
+    with open(path) as f:
+        for line in f:
+            try:
+                rows.append(json.loads(line))
+            except json.JSONDecodeError:
+                print(f"Skipping damaged line in {path}")
+    return rows
+
+def lineage(rows, genome_id):
+    """ Ids of genome_id and every saved descendant of it """
+    children = {}
+    for row in rows:
+        children.setdefault(row.get("parent_id"), []).append(row["id"])
+    found = set()
+    pending = [genome_id]
+    while pending:
+        current = pending.pop()
+        if current in found:
+            continue
+        found.add(current)
+        pending.extend(children.get(current, []))
+    return found
+
+def query(rows, prompt=None, seed=None, lineage_of=None, dedup=False):
+    """
+    Rows whose prompt contains prompt, whose seed equals seed and that
+    descend from genome lineage_of, as given. dedup keeps only the first
+    save of each distinct image.
+    """
+    if lineage_of is not None:
+        family = lineage(rows, lineage_of)
+    results = []
+    seen = set()
+    for row in rows:
+        if prompt is not None and prompt.lower() not in str(row.get("prompt", "")).lower():
+            continue
+        if seed is not None and row.get("seed") != seed:
+            continue
+        if lineage_of is not None and row.get("id") not in family:
+            continue
+        if dedup:
+            if row["phenotype"] in seen:
+                continue
+            seen.add(row["phenotype"])
+        results.append(row)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Search the index of saved images.")
+    parser.add_argument("--dir", default=".", help="Directory holding the images and the index")
+    parser.add_argument("--prompt", default=None, help="Text the prompt must contain")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--lineage", type=int, default=None, metavar="ID", help="Only this genome and its descendants")
+    parser.add_argument("--dedup", action="store_true", help="Show each distinct image once")
+    parser.add_argument("--files", action="store_true", help="Print only file names")
+    args = parser.parse_args()
+
+    for row in query(load_index(args.dir), args.prompt, args.seed, args.lineage, args.dedup):
+        print(row["file"] if args.files else json.dumps(row))
@@ -0,0 +1,184 @@
+"""
+Timing and memory instrumentation. Code wraps interesting stages in
+tracer.span(...) and counts cache results with tracer.count(...). Spans
+record wall time, iterations per second when given a number of
+iterations, and memory: CUDA memory when torch is using a GPU, otherwise
+the resident size of the process (Linux only). The peak is reset only
+when no other span is running, so a span's peak covers everything since
+the outermost running span began, including other threads' work. Spans
+also record memory at their start, so peak minus start is what the
+stage added. Nothing is recorded until the tracer is enabled, and a
+disabled span costs one check.
+
+Each finished generation becomes one line of JSON in the trace file.
+All spans can also be exported in Chrome trace format, for viewing in
+chrome://tracing or https://ui.perfetto.dev.
+
+Example:
+    from instrumentation import tracer
+    tracer.enable("trace.jsonl", chrome_path="trace.json")
+    with tracer.span("generate_images", iterations=steps, images=4):
+        ...
+    tracer.count("phenotype_cache.hit")
+    tracer.end_generation(3)
+    tracer.close()
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+def _cuda():
+    """ torch, if it is already imported and has a GPU. Never imports torch itself """
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        return torch
+    return None
+
+def _proc_status_bytes(field):
+    """ A kB field of /proc/self/status, such as VmRSS, in bytes. None where there is no /proc """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def memory_bytes():
+    """ (kind, current bytes, peak bytes since the last reset_peak_memory) """
+    torch = _cuda()
+    if torch:
+        return ("cuda", torch.cuda.memory_allocated(), torch.cuda.max_memory_allocated())
+    peak = _proc_status_bytes("VmHWM")
+    if peak is not None:
+        return ("cpu_rss", _proc_status_bytes("VmRSS"), peak)
+    return ("none", 0, 0)
+
+def reset_peak_memory():
+    torch = _cuda()
+    if torch:
+        torch.cuda.reset_peak_memory_stats()
+        return
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5") # resets VmHWM to the current resident size
+    except OSError:
+        pass
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.trace_path = None
+        self.chrome_path = None
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.events = [] # spans of the current generation
+        self.all_events = [] # every span, for the Chrome trace
+        self.counters = {}
+        self.active = 0 # spans running on any thread
+
+    def enable(self, trace_path = None, chrome_path = None):
+        """
+        Args:
+            trace_path: JSON Lines file that gets one line per generation
+            chrome_path: file the Chrome trace is written to by close()
+        """
+        self.enabled = True
+        self.trace_path = trace_path
+        self.chrome_path = chrome_path
+
+    @contextmanager
+    def span(self, name, iterations = None, **args):
+        """ Time the body of a with statement. Extra keyword arguments are recorded with it """
+        if not self.enabled:
+            yield
+            return
+        with self.lock:
+            if self.active == 0:
+                # Never while another span runs, which would lose that span's peak
+                reset_peak_memory()
+            self.active += 1
+        (_, start_memory, _) = memory_bytes()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            (memory_kind, _, memory) = memory_bytes()
+            with self.lock:
+                self.active -= 1
+            event = {
+                "name" : name,
+                "start" : start - self.origin,
+                "seconds" : seconds,
+                "thread" : threading.current_thread().name,
+                "peak_memory_bytes" : memory,
+                "start_memory_bytes" : start_memory,
+                "memory_kind" : memory_kind,
+                **args
+            }
+            if iterations is not None:
+                event["iterations"] = iterations
+                event["it_per_second"] = iterations / seconds if seconds > 0 else None
+            with self.lock:
+                self.events.append(event)
+                self.all_events.append(event)
+
+    def count(self, name, n = 1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def end_generation(self, generation):
+        """ Summarize and write out everything recorded since the last call. Returns the summary """
+        if not self.enabled:
+            return None
+        with self.lock:
+            (events, counters) = (self.events, self.counters)
+            (self.events, self.counters) = ([], {})
+
+        totals = {}
+        for event in events:
+            (count, seconds) = totals.get(event["name"], (0, 0.0))
+            totals[event["name"]] = (count + 1, seconds + event["seconds"])
+        summary = {
+            "generation" : generation,
+            "totals" : {name: {"count" : count, "seconds" : seconds} for (name, (count, seconds)) in totals.items()},
+            "counters" : counters,
+            "events" : events
+        }
+        if self.trace_path:
+            with open(self.trace_path, "a") as f:
+                f.write(json.dumps(summary, default=str) + "\n")
+        return summary
+
+    def chrome_trace(self):
+        """ Every span as a Chrome trace event dict """
+        with self.lock:
+            events = list(self.all_events)
+        threads = {}
+        trace = []
+        for event in events:
+            tid = threads.setdefault(event["thread"], len(threads))
+            args = {k: v for (k, v) in event.items() if k not in ("name", "start", "seconds", "thread")}
+            trace.append({"name" : event["name"], "ph" : "X", "pid" : os.getpid(), "tid" : tid,
+                          "ts" : event["start"] * 1e6, "dur" : event["seconds"] * 1e6, "args" : args})
+        for (name, tid) in threads.items():
+            trace.append({"name" : "thread_name", "ph" : "M", "pid" : os.getpid(), "tid" : tid, "args" : {"name" : name}})
+        return {"traceEvents" : trace, "displayTimeUnit" : "ms"}
+
+    def close(self):
+        """ Write the Chrome trace, if one was asked for """
+        if self.enabled and self.chrome_path:
+            with open(self.chrome_path, "w") as f:
+                json.dump(self.chrome_trace(), f, default=str)
+            print(f"Wrote Chrome trace to {self.chrome_path}")
+
+# Shared by every module, so hooks need no wiring
+tracer = Tracer()
@@ -0,0 +1,167 @@
+"""
+Content-addressed on-disk cache of rendered phenotypes. Each image is
+stored as a PNG named by a hash of the genome parameters that determine
+it, so a genome rendered in an earlier session is loaded from disk
+instead of being rendered again. The least recently used files are
+evicted once the cache grows beyond its size cap. put_later encodes and
+writes on a background thread, so rendering never waits on PNG encoding.
+
+The directory is only created, and its files only listed, on first use.
+It defaults to ./phenotype_cache, or to the SDEVOLUTION_CACHE_DIR
+environment variable when that is set.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+CACHE_DIR = "phenotype_cache"
+CACHE_DIR_ENV = "SDEVOLUTION_CACHE_DIR" # overrides CACHE_DIR
+CACHE_MAX_BYTES = 2 * 1024 ** 3 # 2 GB
+
+# metadata fields that identify a genome but do not affect its image
+IGNORED_FIELDS = ("id", "parent_id")
+# Entry of render settings listing more metadata fields the renderer ignores, such as refiner settings without a refiner
+IGNORED_FIELDS_SETTING = "ignored_fields"
+
+def phenotype_key(g, extra=None):
+    """
+    Stable hash of everything in g.metadata() that determines the image,
+    plus any renderer settings in extra (such as whether a refiner is used).
+    Fields listed in extra["ignored_fields"] are left out.
+    """
+    return metadata_key(g.metadata(), extra)
+
+def metadata_key(metadata, extra=None):
+    """ phenotype_key of the genome that produced metadata, for when only its metadata is at hand """
+    extra = dict(extra or {})
+    ignored = IGNORED_FIELDS + tuple(extra.pop(IGNORED_FIELDS_SETTING, ()))
+    params = {k: v for (k, v) in metadata.items() if k not in ignored}
+    params.update(extra)
+    text = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class PhenotypeCache:
+    def __init__(self, directory=None, max_bytes=CACHE_MAX_BYTES):
+        """ directory defaults to SDEVOLUTION_CACHE_DIR, or to CACHE_DIR without it """
+        self.directory = directory or os.environ.get(CACHE_DIR_ENV, CACHE_DIR)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.pending = {} # key -> image queued by put_later and not yet written
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self._sizes = None # listed on first use
+        self.total_bytes = 0
+
+    @property
+    def sizes(self):
+        """ file name -> size, oldest access first """
+        if self._sizes is None:
+            with self.load_lock:
+                if self._sizes is None:
+                    self._load()
+        return self._sizes
+
+    def _load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # Access times are kept in file modification times so that recency survives restarts
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".png"):
+                stat = os.stat(os.path.join(self.directory, name))
+                files.append((stat.st_mtime, name, stat.st_size))
+        files.sort()
+        self.total_bytes = sum(size for (_, _, size) in files)
+        self._sizes = OrderedDict((name, size) for (_, name, size) in files)
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.png")
+
+    def __contains__(self, key):
+        return f"{key}.png" in self.sizes or key in self.pending
+
+    def on_disk(self, key):
+        """ True once key is written, unlike in, which includes images put_later has not written yet """
+        return f"{key}.png" in self.sizes
+
+    def get(self, key):
+        """ Returns the cached PIL image for key, or None """
+        name = f"{key}.png"
+        with self.lock:
+            if key in self.pending:
+                self.hits += 1
+                return self.pending[key]
+            if name not in self.sizes:
+                self.misses += 1
+                return None
+            self.sizes.move_to_end(name)
+            self.hits += 1
+
+        path = self.path(key)
+        try:
+            os.utime(path)
+            image = Image.open(path)
+            image.load()
+        except OSError:
+            # Deleted or corrupted behind our back: treat as a miss
+            with self.lock:
+                self.total_bytes -= self.sizes.pop(name, 0)
+                self.hits -= 1
+                self.misses += 1
+            return None
+        return image
+
+    def put(self, key, image):
+        name = f"{key}.png"
+        if name in self.sizes:
+            return
+
+        # Write to a temporary file first so readers never see a partial PNG
+        path = self.path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        image.save(tmp_path, "PNG")
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            size = os.path.getsize(path)
+            self.total_bytes += size - self.sizes.get(name, 0)
+            self.sizes[name] = size
+            self.sizes.move_to_end(name)
+            self._evict()
+
+    def put_later(self, key, image):
+        """ put on the writer thread. Until it is written, get returns image itself """
+        with self.lock:
+            if f"{key}.png" in self.sizes or key in self.pending:
+                return
+            self.pending[key] = image
+        self.writer.submit(self._put_pending, key)
+
+    def _put_pending(self, key):
+        try:
+            self.put(key, self.pending[key])
+        except OSError as e:
+            print(f"Could not cache image {key}: {e}")
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def flush(self):
+        """ Wait until everything queued by put_later is written """
+        self.writer.submit(lambda: None).result()
+
+    def _evict(self):
+        """ Remove least recently used images until the cache fits its cap """
+        while self.max_bytes is not None and self.total_bytes > self.max_bytes and len(self.sizes) > 1:
+            (name, size) = self.sizes.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
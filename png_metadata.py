@@ -1,5 +1,37 @@
-from PIL import Image
+"""
+Reads the genome metadata that evolution embeds in PNG text chunks.
+The scanner reads chunk headers straight from memory-mapped files and
+stops at the first image data chunk, so no pixels are ever decoded.
+Directories are scanned by a pool of processes.
+
+Example:
+    python png_metadata.py show Image_Id12_Num3.png
+    python png_metadata.py Image_Id12_Num3.png  (same as show)
+    python png_metadata.py scan saved --format csv > saved.csv
+    python png_metadata.py regenerate Image_Id12_Num3.png --output again.png
+"""
+
+from PIL import Image, PngImagePlugin
+from concurrent.futures import ProcessPoolExecutor
 import argparse
+import csv
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+METADATA_PREFIX = "sd_"
+SCAN_CHUNKSIZE = 64 # files handed to a scanning process at a time
+
+def png_info(image_metadata):
+    """ PNG text chunks holding genome metadata, each key prefixed with sd_ """
+    metadata = PngImagePlugin.PngInfo()
+    for key in image_metadata:
+        metadata.add_text(f"{METADATA_PREFIX}{key}", str(image_metadata[key]))
+    return metadata
 
 def get_png_metadata(image_path):
     print(image_path)
@@ -9,10 +41,148 @@ def get_png_metadata(image_path):
         for key, value in metadata.items():
             print(f"{key}: {value}")
 
+def _decode_text_chunk(kind, data):
+    """ (key, value) of a tEXt, zTXt or iTXt chunk. Raises ValueError if it is malformed """
+    (key, _, rest) = data.partition(b"\0")
+    key = key.decode("latin-1")
+    if kind == b"tEXt":
+        return (key, rest.decode("latin-1"))
+    if kind == b"zTXt":
+        return (key, zlib.decompress(rest[1:]).decode("latin-1")) # skip compression method
+    # iTXt: compression flag, compression method, language, translated keyword, text
+    if len(rest) < 2:
+        raise ValueError(f"truncated iTXt chunk {key!r}")
+    (compressed, rest) = (rest[0], rest[2:])
+    (_, _, rest) = rest.partition(b"\0")
+    (_, _, text) = rest.partition(b"\0")
+    if compressed:
+        text = zlib.decompress(text)
+    return (key, text.decode("utf-8"))
+
+def read_png_text(path):
+    """
+    Every text chunk before the image data of the PNG at path, as a dict.
+    Raises ValueError if the file is not a PNG.
+    """
+    text = {}
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < len(PNG_SIGNATURE):
+            raise ValueError(f"{path} is not a PNG file")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(PNG_SIGNATURE)] != PNG_SIGNATURE:
+                raise ValueError(f"{path} is not a PNG file")
+            offset = len(PNG_SIGNATURE)
+            while offset + 8 <= len(data):
+                (length, kind) = struct.unpack(">I4s", data[offset:offset + 8])
+                if kind in (b"IDAT", b"IEND"):
+                    break # text after the image data is not used by evolution
+                if offset + 12 + length > len(data):
+                    raise ValueError(f"{path} is truncated")
+                if kind in (b"tEXt", b"zTXt", b"iTXt"):
+                    (key, value) = _decode_text_chunk(kind, data[offset + 8:offset + 8 + length])
+                    text[key] = value
+                offset += length + 12 # length, type and CRC
+    return text
+
+def read_sd_metadata(path):
+    """ The genome metadata saved in a PNG, without the sd_ prefix on its keys """
+    return {key[len(METADATA_PREFIX):]: value for (key, value) in read_png_text(path).items()
+            if key.startswith(METADATA_PREFIX)}
+
+def _scan_one(path):
+    try:
+        return (path, read_sd_metadata(path), None)
+    except (OSError, ValueError, IndexError, zlib.error) as e:
+        # One bad file never stops a scan
+        return (path, None, str(e))
+
+def find_pngs(root):
+    """ Every .png file under root, in a stable order """
+    paths = []
+    for (directory, _, files) in os.walk(root):
+        paths.extend(os.path.join(directory, name) for name in files if name.lower().endswith(".png"))
+    return sorted(paths)
+
+def scan(root, workers = None):
+    """ Yields (path, metadata) for every PNG under root that has genome metadata """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for (path, metadata, error) in pool.map(_scan_one, find_pngs(root), chunksize=SCAN_CHUNKSIZE):
+            if error:
+                print(f"Skipping {path}: {error}", file=sys.stderr)
+            elif metadata:
+                yield (path, metadata)
+
+def write_scan(rows, output_format, out = sys.stdout):
+    """ Write (path, metadata) rows as csv, jsonl or an aligned table """
+    if output_format == "jsonl":
+        for (path, metadata) in rows:
+            out.write(json.dumps({"file" : path, **metadata}) + "\n")
+        return
+
+    rows = list(rows) # every row is needed to find the columns
+    columns = ["file"]
+    for (_, metadata) in rows:
+        columns.extend(key for key in metadata if key not in columns)
+    table = [[path] + [metadata.get(key, "") for key in columns[1:]] for (path, metadata) in rows]
+    if output_format == "csv":
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        writer.writerows(table)
+    else:
+        widths = [max([len(column)] + [len(str(row[i])) for row in table]) for (i, column) in enumerate(columns)]
+        out.write("  ".join(column.ljust(width) for (column, width) in zip(columns, widths)) + "\n")
+        for row in table:
+            out.write("  ".join(str(value).ljust(width) for (value, width) in zip(row, widths)) + "\n")
+
+def regenerate(path, output, refine = False, device = None, any_model = False):
+    """
+    Render the genome saved in the PNG at path again, saving the result to output.
+    Raises ValueError if it was rendered by a model other than the current ones,
+    unless any_model is True.
+    """
+    # Imported here so that scanning never loads torch
+    from genome import genome_from_metadata, SDXLGenome
+    from headless import make_evolver
+    from models import SD_MODEL, SDXL_MODEL
+
+    metadata = read_sd_metadata(path)
+    if not metadata:
+        raise ValueError(f"{path} has no genome metadata")
+    model = metadata.get("model")
+    if model not in (SD_MODEL, SDXL_MODEL) and not any_model:
+        raise ValueError(f"{path} was rendered by {model}, not {SD_MODEL} or {SDXL_MODEL}. Use --any-model to render it anyway")
+    g = genome_from_metadata(metadata)
+    evolver = make_evolver("sdxl" if isinstance(g, SDXLGenome) else "sd", refine, device)
+    evolver.render_genomes([g], lambda: False, None)
+    g.image.save(output, "PNG", pnginfo=png_info(g.metadata()))
+    print(f"Regenerated {g} as {output}")
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Extract metadata from a PNG file.")
-    parser.add_argument("image_path", help="Path to the PNG file")
-    args = parser.parse_args()
-    
-    get_png_metadata(args.image_path)
+    parser = argparse.ArgumentParser(description="Read genome metadata from PNG files.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    show = subparsers.add_parser("show", help="Print all metadata of one PNG file")
+    show.add_argument("image_path", help="Path to the PNG file")
+
+    scanner = subparsers.add_parser("scan", help="Collect the genome metadata of every PNG in a directory tree")
+    scanner.add_argument("directory")
+    scanner.add_argument("--format", choices=["csv", "jsonl", "table"], default="table")
+    scanner.add_argument("--workers", type=int, default=None, help="Scanning processes. Defaults to one per CPU")
+
+    regen = subparsers.add_parser("regenerate", help="Render the genome saved in a PNG again")
+    regen.add_argument("image_path")
+    regen.add_argument("--output", required=True)
+    regen.add_argument("--refine", action="store_true", help="Use the SDXL refiner")
+    regen.add_argument("--device", default=None)
+    regen.add_argument("--any-model", action="store_true", help="Render with a current model even if the PNG came from another")
+
+    argv = sys.argv[1:]
+    if argv and not argv[0].startswith("-") and argv[0] not in subparsers.choices:
+        argv = ["show"] + argv # the original usage: python png_metadata.py FILE.png
+    args = parser.parse_args(argv)
+    if args.command == "show":
+        get_png_metadata(args.image_path)
+    elif args.command == "scan":
+        write_scan(scan(args.directory, args.workers), args.format)
+    elif args.command == "regenerate":
+        regenerate(args.image_path, args.output, args.refine, args.device, args.any_model)
@@ -0,0 +1,178 @@
+"""
+Struct-of-arrays population for automated runs with thousands of
+genomes. Each genome parameter is one NumPy array, and a whole
+generation of children is mutated with a few vector operations drawn
+from a seeded numpy.random.Generator. The mutation rules match
+SDGenome.mutate and SDXLGenome.mutate. Every bred generation records the rows that survived
+into it, the generator state and the ids its children got, so replay can
+breed any generation again exactly. Genome objects are only built for the
+rows that get rendered.
+
+Example:
+    population = Population.random(10000, "a white cat", "", seed = 0)
+    population = population.next_generation(keepers, 10000)
+    to_render = population.genomes(range(9))
+"""
+
+import numpy as np
+import genome as genome_module
+from genome import (SDGenome, SDXLGenome, MUTATE_MAX_STEP_DELTA,
+                    MUTATE_MAX_REFINE_STEP_DELTA, MUTATE_MAX_GUIDANCE_DELTA, MUTATE_MAX_SPLIT_DELTA,
+                    DEFAULT_DENOISING_SPLIT, MIN_DENOISING_SPLIT, MAX_DENOISING_SPLIT)
+
+def allocate_ids(n):
+    """ n consecutive ids from the same counter genome objects use """
+    start = genome_module.genome_id
+    genome_module.reserve_genome_ids(start + n)
+    return np.arange(start, start + n, dtype=np.int64)
+
+class Population:
+    def __init__(self, prompt, neg_prompt, ids, parent_ids, seeds, steps, guidance_scales, refine_steps = None, rng = None, generation = 0, lineage = None, denoising_splits = None):
+        """
+        Arrays all have one entry per genome. parent_ids uses -1 for no parent.
+        refine_steps and denoising_splits are None for Stable Diffusion and set for SDXL populations.
+        lineage is shared by every generation of a run, see next_generation.
+        """
+        self.prompt = prompt
+        self.neg_prompt = neg_prompt
+        self.ids = ids
+        self.parent_ids = parent_ids
+        self.seeds = seeds
+        self.steps = steps
+        self.guidance_scales = guidance_scales
+        self.refine_steps = refine_steps
+        self.denoising_splits = denoising_splits
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.generation = generation
+        self.lineage = lineage if lineage is not None else {} # generation -> (survivors, generator state, child ids) it was bred from
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def random(size, prompt, neg_prompt, steps = 20, guidance_scale = 7.5, refine_steps = None, seed = None):
+        """ Like initialize_population: random seeds and settings spread around the defaults """
+        rng = np.random.default_rng(seed)
+        refine = None
+        splits = None
+        if refine_steps is not None:
+            refine = np.maximum(1, refine_steps + rng.integers(-MUTATE_MAX_REFINE_STEP_DELTA, MUTATE_MAX_REFINE_STEP_DELTA, size, endpoint=True)).astype(np.int32)
+            splits = np.clip(DEFAULT_DENOISING_SPLIT + rng.uniform(-MUTATE_MAX_SPLIT_DELTA, MUTATE_MAX_SPLIT_DELTA, size), MIN_DENOISING_SPLIT, MAX_DENOISING_SPLIT)
+        return Population(
+            prompt, neg_prompt,
+            allocate_ids(size),
+            np.full(size, -1, dtype=np.int64),
+            rng.integers(0, 2**64, size, dtype=np.uint64),
+            np.maximum(1, steps + rng.integers(-MUTATE_MAX_STEP_DELTA, MUTATE_MAX_STEP_DELTA, size, endpoint=True)).astype(np.int32),
+            np.maximum(1.0, guidance_scale + rng.uniform(-MUTATE_MAX_GUIDANCE_DELTA, MUTATE_MAX_GUIDANCE_DELTA, size)),
+            refine, rng, 0, None, splits
+        )
+
+    @staticmethod
+    def from_genomes(genomes, generation = 0, seed = None):
+        """ Population of existing genome objects, which must share their prompts """
+        sdxl = isinstance(genomes[0], SDXLGenome)
+        return Population(
+            genomes[0].prompt, genomes[0].neg_prompt,
+            np.array([g.id for g in genomes], dtype=np.int64),
+            np.array([-1 if g.parent_id is None else g.parent_id for g in genomes], dtype=np.int64),
+            np.array([g.seed for g in genomes], dtype=np.uint64),
+            np.array([g.num_inference_steps for g in genomes], dtype=np.int32),
+            np.array([g.guidance_scale for g in genomes], dtype=np.float64),
+            np.array([g.refine_steps for g in genomes], dtype=np.int32) if sdxl else None,
+            np.random.default_rng(seed), generation, None,
+            np.array([g.denoising_split for g in genomes], dtype=np.float64) if sdxl else None
+        )
+
+    def rows(self, rows):
+        """ Population of just the given rows, sharing the generator and lineage """
+        rows = np.asarray(rows, dtype=np.int64)
+        (ids, seeds, steps, guidance, refine, splits) = self._take(rows)
+        return Population(self.prompt, self.neg_prompt, ids, self.parent_ids[rows], seeds, steps, guidance,
+                          refine, self.rng, self.generation, self.lineage, splits)
+
+    def _take(self, rows):
+        return (self.ids[rows], self.seeds[rows], self.steps[rows], self.guidance_scales[rows],
+                None if self.refine_steps is None else self.refine_steps[rows],
+                None if self.denoising_splits is None else self.denoising_splits[rows])
+
+    def mutated_children(self, parents, ids = None):
+        """
+        Arrays for one mutated child of each row in parents: half get a new
+        seed, the others a small change to every other setting. New ids are
+        allocated unless given.
+        """
+        (parent_ids, seeds, steps, guidance, refine, splits) = self._take(parents)
+        n = len(parents)
+        new_seed = self.rng.integers(0, 2, n).astype(bool)
+        small = ~new_seed
+
+        seeds = np.where(new_seed, self.rng.integers(0, 2**64, n, dtype=np.uint64), seeds)
+        steps = np.where(small, np.maximum(1, steps + self.rng.integers(-MUTATE_MAX_STEP_DELTA, MUTATE_MAX_STEP_DELTA, n, endpoint=True)), steps).astype(np.int32)
+        guidance = np.where(small, np.maximum(1.0, guidance + self.rng.uniform(-MUTATE_MAX_GUIDANCE_DELTA, MUTATE_MAX_GUIDANCE_DELTA, n)), guidance)
+        if refine is not None:
+            refine = np.where(small, np.maximum(1, refine + self.rng.integers(-MUTATE_MAX_REFINE_STEP_DELTA, MUTATE_MAX_REFINE_STEP_DELTA, n, endpoint=True)), refine).astype(np.int32)
+            splits = np.where(small, np.clip(splits + self.rng.uniform(-MUTATE_MAX_SPLIT_DELTA, MUTATE_MAX_SPLIT_DELTA, n), MIN_DENOISING_SPLIT, MAX_DENOISING_SPLIT), splits)
+        return (allocate_ids(n) if ids is None else ids, parent_ids, seeds, steps, guidance, refine, splits)
+
+    def next_generation(self, selected, size):
+        """
+        Pure elitism, like Evolver.evolve: the rows in selected survive and
+        mutated children of randomly chosen survivors fill the rest. The
+        survivors are recorded in the lineage, so replay needs no other generation.
+        """
+        survivors = self.rows(selected)
+        state = self.rng.bit_generator.state
+        child = survivors._breed(size)
+        self.forget_after(self.generation) # breeding an older generation again starts a new branch
+        self.lineage[child.generation] = (survivors, state, child.ids[len(survivors):])
+        return child
+
+    def forget_after(self, generation):
+        """ Drop the lineage of every generation bred after generation """
+        for later in [g for g in self.lineage if g > generation]:
+            del self.lineage[later]
+
+    def _breed(self, size, ids = None):
+        """ This population followed by mutated children of its rows, up to size rows """
+        parents = self.rng.integers(0, len(self), size - len(self))
+        (ids, parent_ids, seeds, steps, guidance, refine, splits) = self.mutated_children(parents, ids)
+        return Population(
+            self.prompt, self.neg_prompt,
+            np.concatenate([self.ids, ids]),
+            np.concatenate([self.parent_ids, parent_ids]),
+            np.concatenate([self.seeds, seeds]),
+            np.concatenate([self.steps, steps]),
+            np.concatenate([self.guidance_scales, guidance]),
+            None if refine is None else np.concatenate([self.refine_steps, refine]),
+            self.rng, self.generation + 1, self.lineage,
+            None if splits is None else np.concatenate([self.denoising_splits, splits])
+        )
+
+    def replay(self, generation):
+        """
+        Breed generation again, from the survivors, generator state and child ids
+        recorded when it was first bred, giving the same rows. Generation 0 is
+        not bred: call random again with the same seed. The generator is left
+        where it was after generation was first bred, so the run can continue
+        from there, but the lineage of every later generation is forgotten.
+        """
+        if generation not in self.lineage:
+            raise ValueError(f"Generation {generation} was not bred by this run, only {sorted(self.lineage)} were")
+        (survivors, state, ids) = self.lineage[generation]
+        self.forget_after(generation)
+        self.rng.bit_generator.state = state
+        return survivors._breed(len(survivors) + len(ids), ids)
+
+    def genome(self, i):
+        """ Genome object for row i, for rendering or display. It keeps the row's id """
+        parent_id = int(self.parent_ids[i])
+        parent_id = None if parent_id < 0 else parent_id
+        if self.refine_steps is None:
+            return SDGenome(self.prompt, self.neg_prompt, int(self.seeds[i]), int(self.steps[i]), float(self.guidance_scales[i]), False, parent_id, int(self.ids[i]))
+        return SDXLGenome(self.prompt, self.neg_prompt, int(self.seeds[i]), int(self.steps[i]), float(self.guidance_scales[i]), int(self.refine_steps[i]),
+                          False, parent_id, float(self.denoising_splits[i]), int(self.ids[i]))
+
+    def genomes(self, rows = None):
+        rows = range(len(self)) if rows is None else rows
+        return [self.genome(i) for i in rows]
@@ -0,0 +1,250 @@
+"""
+Spreads rendering across several worker processes, usually one per GPU.
+Each worker loads its model once, then takes batches of genomes from a
+shared job queue whenever it is idle. Images come back tagged by genome
+id. A worker that dies or stops sending heartbeats is restarted, and its
+batch is requeued. A worker that keeps dying before it is ready, such as
+one whose model does not fit on its device, is given up on, and render
+raises once no worker is left. Every worker talks over its own pipe, so a worker
+that dies mid-message cannot leave a lock held for the others.
+
+Example:
+    pool = RenderPool(functools.partial(make_evolver, "sd", False), ["cuda:0", "cuda:1"])
+    evolver = SDEvolver(load = False)
+    evolver.render_pool = pool
+"""
+
+import multiprocessing
+import multiprocessing.connection
+import threading
+import time
+import traceback
+from collections import deque
+
+HEARTBEAT_SECONDS = 5 # How often workers report that they are alive
+HEARTBEAT_TIMEOUT = 120 # Workers silent for this long are considered hung
+MAX_ATTEMPTS = 2 # Times a batch is tried before it is given up on
+MAX_RESTARTS = 3 # Restarts in a row without becoming ready before a worker is given up on
+POLL_SECONDS = 1.0
+
+def _heartbeat(index, conn, lock):
+    while True:
+        with lock:
+            conn.send(("heartbeat", index, None))
+        time.sleep(HEARTBEAT_SECONDS)
+
+def _worker_main(index, factory, device, conn):
+    """ Entry point of a worker process """
+    lock = threading.Lock() # The heartbeat thread shares the pipe
+    def send(message):
+        with lock:
+            conn.send(message)
+
+    threading.Thread(target=_heartbeat, args=(index, conn, lock), daemon=True).start()
+    evolver = factory(device)
+    evolver.phenotype_cache = None # The parent process owns the cache
+    send(("ready", index, None))
+
+    while True:
+        job = conn.recv()
+        if job is None:
+            return
+        (job_id, genomes) = job
+        start = time.perf_counter()
+        try:
+            evolver.render_genomes(genomes, lambda: False, None)
+            images = [(g.id, g.image) for g in genomes]
+            send(("done", index, (job_id, images, time.perf_counter() - start)))
+        except Exception:
+            traceback.print_exc()
+            send(("failed", index, job_id))
+
+class WorkerState:
+    def __init__(self, device):
+        self.device = device
+        self.process = None
+        self.conn = None
+        self.job_id = None # job currently being rendered
+        self.last_heartbeat = time.monotonic()
+        self.ready = False
+        self.jobs = 0
+        self.images = 0
+        self.busy_seconds = 0.0
+        self.restarts = 0
+        self.failed_starts = 0 # restarts since the worker was last ready
+        self.given_up = False
+
+class RenderPool:
+    def __init__(self, factory, devices):
+        """
+        Args:
+            factory: picklable callable that builds a loaded evolver from a device name,
+                     such as functools.partial(headless.make_evolver, "sd", False)
+            devices: one worker is started per entry, such as ["cuda:0", "cuda:1"].
+                     Use ["cpu"] * N for N CPU workers.
+        """
+        # CUDA cannot be used in forked children
+        self.context = multiprocessing.get_context("spawn")
+        self.factory = factory
+        self.queue = deque() # ids of jobs waiting for an idle worker
+        self.job_ids = 0
+        self.pending = {} # job id -> (genomes, attempts), queued or being rendered
+        self.workers = [WorkerState(device) for device in devices]
+        for index in range(len(self.workers)):
+            self._start(index)
+
+    def _start(self, index):
+        worker = self.workers[index]
+        (worker.conn, child_conn) = self.context.Pipe()
+        worker.process = self.context.Process(
+            target=_worker_main,
+            args=(index, self.factory, worker.device, child_conn),
+            daemon=True
+        )
+        worker.process.start()
+        child_conn.close()
+        worker.job_id = None
+        worker.ready = False
+        worker.last_heartbeat = time.monotonic()
+
+    def _submit(self, genomes, attempts = 0):
+        self.job_ids += 1
+        self.pending[self.job_ids] = (genomes, attempts)
+        self.queue.append(self.job_ids)
+
+    def _dispatch(self):
+        """ Hand queued jobs to idle workers """
+        for worker in self.workers:
+            while worker.ready and worker.job_id is None and self.queue:
+                job_id = self.queue.popleft()
+                if job_id not in self.pending:
+                    continue # cancelled
+                worker.job_id = job_id
+                try:
+                    worker.conn.send((job_id, self.pending[job_id][0]))
+                except OSError:
+                    break # died, check_health will requeue
+
+    def _requeue(self, job_id):
+        (genomes, attempts) = self.pending.pop(job_id)
+        if attempts + 1 < MAX_ATTEMPTS:
+            print(f"Requeueing {len(genomes)} genomes")
+            self._submit(genomes, attempts + 1)
+        else:
+            print(f"Giving up on {len(genomes)} genomes after {MAX_ATTEMPTS} attempts")
+
+    def check_health(self):
+        """ Restart workers that died or hung, requeueing whatever they were rendering """
+        now = time.monotonic()
+        for (index, worker) in enumerate(self.workers):
+            if worker.given_up:
+                continue
+            hung = now - worker.last_heartbeat > HEARTBEAT_TIMEOUT
+            if worker.process.is_alive() and not hung:
+                continue
+
+            if hung:
+                worker.process.terminate()
+            worker.process.join(timeout=10)
+            worker.conn.close()
+            if worker.job_id in self.pending:
+                self._requeue(worker.job_id)
+            worker.job_id = None
+            worker.ready = False
+            if worker.failed_starts >= MAX_RESTARTS:
+                print(f"Render worker {index} on {worker.device} {'hung' if hung else 'died'} {worker.failed_starts + 1} times in a row, giving up on it")
+                worker.given_up = True
+                continue
+            print(f"Render worker {index} on {worker.device} {'hung' if hung else 'died'}, restarting")
+            worker.restarts += 1
+            worker.failed_starts += 1
+            self._start(index)
+
+    def alive(self):
+        """ Workers that are ready or may still become ready """
+        return [worker for worker in self.workers if not worker.given_up]
+
+    def render(self, batches, cancelled, finish):
+        """
+        Render batches across the workers, calling finish(batch) for each
+        completed batch. Returns when all are done or cancelled() is True.
+        Raises RuntimeError if every worker has been given up on.
+        """
+        by_id = {}
+        for batch in batches:
+            self._submit(batch)
+            for g in batch:
+                by_id[g.id] = g
+
+        while self.pending:
+            if cancelled():
+                self.cancel()
+                return
+            if not self.alive():
+                failed = sum(len(genomes) for (genomes, _) in self.pending.values())
+                self.cancel()
+                raise RuntimeError(f"No render worker could start, {failed} genomes were not rendered")
+            self._dispatch()
+            conns = [worker.conn for worker in self.alive()]
+            ready = multiprocessing.connection.wait(conns, timeout=POLL_SECONDS)
+            for conn in ready:
+                # Drain everything, including heartbeats that piled up while the pool was idle
+                try:
+                    while conn.poll():
+                        self._handle(conn.recv(), finish, by_id)
+                except (EOFError, OSError):
+                    pass # died, check_health will requeue
+            self.check_health()
+
+    def _handle(self, message, finish, by_id):
+        (kind, index, data) = message
+        worker = self.workers[index]
+        worker.last_heartbeat = time.monotonic()
+        if kind == "ready":
+            worker.ready = True
+            worker.failed_starts = 0
+        elif kind == "failed":
+            worker.job_id = None
+            if data in self.pending:
+                self._requeue(data)
+        elif kind == "done":
+            (job_id, images, seconds) = data
+            worker.job_id = None
+            worker.jobs += 1
+            worker.images += len(images)
+            worker.busy_seconds += seconds
+            if job_id not in self.pending:
+                return # from a cancelled render
+            (batch, _) = self.pending.pop(job_id)
+            for (genome_id, image) in images:
+                by_id[genome_id].set_image(image)
+            finish(batch)
+
+    def cancel(self):
+        """ Drop every job that no worker has started yet. Started jobs finish and are ignored """
+        self.pending.clear()
+        self.queue.clear()
+
+    def stats(self):
+        """ Throughput of each worker """
+        return [{
+            "device" : worker.device,
+            "ready" : worker.ready,
+            "jobs" : worker.jobs,
+            "images" : worker.images,
+            "images_per_second" : worker.images / worker.busy_seconds if worker.busy_seconds else 0.0,
+            "restarts" : worker.restarts,
+            "given_up" : worker.given_up
+        } for worker in self.workers]
+
+    def close(self):
+        self.cancel()
+        for worker in self.alive():
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+        for worker in self.workers:
+            worker.process.join(timeout=10)
+            if worker.process.is_alive():
+                worker.process.terminate()
@@ -0,0 +1,135 @@
+"""
+Orders render batches by predicted cost and keeps a generation within an
+optional wall-clock budget. Cost is predicted from step count, image
+count and resolution times a per-step latency, which is learned as a
+moving average of how long batches actually take. Over budget batches
+either get fewer steps or are deferred: the viewer shows a placeholder
+for them and renders them at low priority once everything else is done.
+
+Example:
+    evolver.scheduler = RenderScheduler(budget_seconds = 30, over_budget = OVER_BUDGET_DEFER)
+"""
+
+from PIL import Image, ImageDraw
+
+REFERENCE_PIXELS = 512 * 512 # resolution the per-step latency is expressed at
+DEFAULT_SECONDS_PER_STEP = 0.05 # per image and step at the reference resolution, until measured
+LATENCY_SMOOTHING = 0.3 # weight of the newest measurement in the moving average
+MIN_CAPPED_STEPS = 4 # capping never goes below this many steps
+
+ORDER_CHEAPEST = "cheapest" # cheapest batches first, so most of the grid appears soonest
+ORDER_POPULATION = "population" # population order, as before
+OVER_BUDGET_CAP = "cap" # lower the steps of batches that do not fit
+OVER_BUDGET_DEFER = "defer" # leave batches that do not fit for later
+
+def render_steps(g):
+    """ Denoising steps g is rendered with: its own, unless cap_steps lowered them for this render """
+    return getattr(g, "step_override", None) or g.num_inference_steps
+
+def placeholder_image(text = "deferred", size = 256):
+    """ Gray image shown in place of a genome that is not rendered yet """
+    image = Image.new("RGB", (size, size), (96, 96, 96))
+    ImageDraw.Draw(image).text((10, size // 2), text, fill=(230, 230, 230))
+    return image
+
+class LatencyModel:
+    def __init__(self, seconds_per_step = DEFAULT_SECONDS_PER_STEP, smoothing = LATENCY_SMOOTHING):
+        self.seconds_per_step = seconds_per_step
+        self.smoothing = smoothing
+        self.samples = 0
+
+    def units(self, steps, images, pixels):
+        """ Image steps at the reference resolution """
+        return steps * images * pixels / REFERENCE_PIXELS
+
+    def predict(self, units):
+        return self.seconds_per_step * units
+
+    def observe(self, units, seconds):
+        if units <= 0:
+            return
+        measured = seconds / units
+        if self.samples == 0:
+            self.seconds_per_step = measured # the default was only a guess
+        else:
+            self.seconds_per_step += self.smoothing * (measured - self.seconds_per_step)
+        self.samples += 1
+
+class RenderScheduler:
+    def __init__(self, budget_seconds = None, over_budget = OVER_BUDGET_DEFER, order = ORDER_CHEAPEST, latency = None):
+        """
+        Args:
+            budget_seconds: predicted render time allowed per generation. None for no limit
+            over_budget: OVER_BUDGET_CAP or OVER_BUDGET_DEFER
+            order: ORDER_CHEAPEST or ORDER_POPULATION
+        """
+        self.budget_seconds = budget_seconds
+        self.over_budget = over_budget
+        self.order = order
+        self.latency = latency or LatencyModel()
+        self.jobs = [] # one dict per rendered batch: predicted and actual seconds
+
+    def batch_units(self, evolver, batch):
+        steps = max(evolver.step_count(g) for g in batch)
+        return self.latency.units(steps, len(batch), evolver.image_size ** 2)
+
+    def predict(self, evolver, batch):
+        return self.latency.predict(self.batch_units(evolver, batch))
+
+    def plan(self, evolver, batches):
+        """ Returns (batches to render now in order, genomes deferred until later) """
+        for batch in batches:
+            for g in batch:
+                g.step_override = None # a cap only applies to the render it was planned for
+        costs = [(self.predict(evolver, batch), batch) for batch in batches]
+        if self.order == ORDER_CHEAPEST:
+            costs.sort(key=lambda cost_batch: cost_batch[0])
+        if self.budget_seconds is None:
+            return ([batch for (_, batch) in costs], [])
+
+        scheduled = []
+        deferred = []
+        spent = 0.0
+        for (cost, batch) in costs:
+            if spent + cost <= self.budget_seconds:
+                scheduled.append(batch)
+                spent += cost
+            elif self.over_budget == OVER_BUDGET_CAP:
+                self.cap_steps(evolver, batch, max(0.0, self.budget_seconds - spent) / cost)
+                scheduled.append(batch)
+                spent += self.predict(evolver, batch)
+            else:
+                deferred.extend(batch)
+        if deferred:
+            print(f"Deferring {len(deferred)} genomes to keep within {self.budget_seconds:.1f}s")
+        return (scheduled, deferred)
+
+    def cap_steps(self, evolver, batch, fraction):
+        """
+        Render every genome in batch with its steps scaled by fraction. The genomes
+        keep their own steps: the cap is their step_override, see render_steps
+        """
+        for g in batch:
+            capped = max(MIN_CAPPED_STEPS, int(g.num_inference_steps * fraction))
+            if capped < g.num_inference_steps:
+                print(f"Capping {g} at {capped} steps to keep within budget")
+                g.step_override = capped
+
+    def observe(self, evolver, batch, seconds):
+        """ Record how long batch actually took and learn from it """
+        units = self.batch_units(evolver, batch)
+        predicted = self.latency.predict(units)
+        self.latency.observe(units, seconds)
+        self.jobs.append({"genomes" : [g.id for g in batch], "steps" : max(evolver.step_count(g) for g in batch),
+                          "images" : len(batch), "predicted_seconds" : predicted, "actual_seconds" : seconds})
+        print(f"Rendered {len(batch)} images in {seconds:.2f}s, predicted {predicted:.2f}s")
+
+    def report(self):
+        """ How well predictions matched, over every recorded job """
+        if not self.jobs:
+            return {"jobs" : 0}
+        errors = [abs(job["predicted_seconds"] - job["actual_seconds"]) / job["actual_seconds"] for job in self.jobs if job["actual_seconds"] > 0]
+        return {"jobs" : len(self.jobs), "seconds_per_step" : self.latency.seconds_per_step,
+                "mean_relative_error" : sum(errors) / len(errors) if errors else None,
+                "predicted_seconds" : sum(job["predicted_seconds"] for job in self.jobs),
+                "actual_seconds" : sum(job["actual_seconds"] for job in self.jobs)}
@@ -0,0 +1,88 @@
+"""
+Renders genomes on a background thread so that the Tk event loop
+never blocks on diffusion. The Tk thread submits whole populations
+and collects finished batches by polling with root.after.
+Speculative jobs only run while no regular job is waiting.
+"""
+
+import itertools
+import queue
+import threading
+import traceback
+
+PRIORITY_STOP = -1
+PRIORITY_RENDER = 0
+PRIORITY_SPECULATIVE = 1
+
+class RenderWorker:
+    def __init__(self, render_fn):
+        """
+        Args:
+            render_fn: called on the worker thread as render_fn(genomes, cancelled, publish).
+                       cancelled() is True once the job has been superseded, and
+                       publish(batch) hands a list of finished genomes back to the Tk thread,
+                       and is None for speculative jobs, which report nothing.
+        """
+        self.render_fn = render_fn
+        self.jobs = queue.PriorityQueue()
+        self.job_order = itertools.count() # first in, first out among equal priorities
+        self.results = queue.Queue()
+        self.epoch = 0 # Only jobs from the latest epoch are rendered and reported
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, genomes, speculative = False):
+        """
+        Queue a population for rendering, superseding every earlier job.
+        Speculative jobs instead join the current epoch at low priority,
+        and their results are cached on the genomes but never reported.
+        """
+        if speculative:
+            priority = PRIORITY_SPECULATIVE
+        else:
+            priority = PRIORITY_RENDER
+            self.epoch += 1
+        self.jobs.put((priority, next(self.job_order), self.epoch, genomes))
+        return self.epoch
+
+    def cancel(self):
+        """ Abandon the in-flight job at the next batch boundary """
+        self.epoch += 1
+
+    def is_current(self, epoch):
+        return epoch == self.epoch
+
+    def poll(self):
+        """ Returns genomes finished for the current job since the last poll """
+        finished = []
+        while True:
+            try:
+                (epoch, batch) = self.results.get_nowait()
+            except queue.Empty:
+                return finished
+            if self.is_current(epoch):
+                finished.extend(batch)
+
+    def stop(self):
+        self.cancel()
+        self.jobs.put((PRIORITY_STOP, next(self.job_order), None, None))
+
+    def _run(self):
+        while True:
+            (priority, _, epoch, genomes) = self.jobs.get()
+            if priority == PRIORITY_STOP:
+                return
+
+            if not self.is_current(epoch):
+                continue # superseded before it started
+
+            if priority == PRIORITY_SPECULATIVE:
+                publish = None
+            else:
+                publish = lambda batch: self.results.put((epoch, batch))
+
+            try:
+                self.render_fn(genomes, lambda: not self.is_current(epoch), publish)
+            except Exception:
+                # Keep the worker alive so the next generation can still render
+                traceback.print_exc()
@@ -0,0 +1,103 @@
+"""
+Owns the pipelines an evolver renders with and decides which of them
+live on the render device. This replaces moving whole pipelines between
+"cuda" and "cpu" by hand every generation. torch is imported lazily so
+that importing the evolvers stays fast.
+"""
+
+import time
+from instrumentation import tracer
+
+POLICY_AUTO = "auto" # resident if everything fits in device memory, otherwise swap
+POLICY_RESIDENT = "resident" # every pipeline stays on the device
+POLICY_SWAP = "swap" # only the pipeline in use is on the device
+POLICY_MODEL_OFFLOAD = "model_offload" # accelerate moves one submodel at a time to the device
+POLICY_SEQUENTIAL_OFFLOAD = "sequential_offload" # accelerate streams layers: least memory, slowest
+
+RESIDENT_HEADROOM = 1.3 # fraction of model size needed for activations when deciding auto policy
+
+def pipe_bytes(pipe):
+    """ Size of every torch module in a diffusers pipeline """
+    import torch
+    total = 0
+    for component in pipe.components.values():
+        if isinstance(component, torch.nn.Module):
+            total += sum(p.numel() * p.element_size() for p in component.parameters())
+    return total
+
+class ModelResidency:
+    def __init__(self, pipes, device, policy = POLICY_AUTO):
+        """
+        Args:
+            pipes: dict from a name such as "base" or "refiner" to a pipeline
+            device: render device, such as "cuda" or "cpu"
+            policy: one of the POLICY_ constants
+        """
+        self.pipes = pipes
+        self.device = device
+        self.transfers = [] # (pipe name, destination, seconds)
+        self.on_device = set()
+
+        if policy == POLICY_AUTO:
+            policy = self._choose_policy()
+        if policy in (POLICY_MODEL_OFFLOAD, POLICY_SEQUENTIAL_OFFLOAD) and not device.startswith("cuda"):
+            # Offloading to the CPU means nothing when the CPU renders
+            policy = POLICY_RESIDENT
+        self.policy = policy
+        print(f"Model residency policy: {self.policy}")
+
+        for (name, pipe) in self.pipes.items():
+            if self.policy == POLICY_MODEL_OFFLOAD:
+                pipe.enable_model_cpu_offload(device=device)
+            elif self.policy == POLICY_SEQUENTIAL_OFFLOAD:
+                pipe.enable_sequential_cpu_offload(device=device)
+            elif self.policy == POLICY_RESIDENT:
+                self._move(name, device)
+
+    def _choose_policy(self):
+        import torch
+        if not self.device.startswith("cuda"):
+            return POLICY_RESIDENT
+        (free, _) = torch.cuda.mem_get_info(torch.device(self.device))
+        needed = sum(pipe_bytes(pipe) for pipe in self.pipes.values())
+        if len(self.pipes) == 1 or needed * RESIDENT_HEADROOM < free:
+            return POLICY_RESIDENT
+        return POLICY_SWAP
+
+    def _move(self, name, destination):
+        import torch
+        start = time.perf_counter()
+        with tracer.span("pipe.to", pipe=name, destination=destination):
+            self.pipes[name].to(destination)
+            if self.device.startswith("cuda"):
+                torch.cuda.synchronize()
+        seconds = time.perf_counter() - start
+        self.transfers.append((name, destination, seconds))
+        print(f"Moved {name} pipeline to {destination} in {seconds:.2f}s")
+
+        if destination == self.device:
+            self.on_device.add(name)
+        else:
+            self.on_device.discard(name)
+
+    def activate(self, name):
+        """ Make the named pipeline ready to render. Does nothing if it already is """
+        if self.policy in (POLICY_MODEL_OFFLOAD, POLICY_SEQUENTIAL_OFFLOAD) or name in self.on_device:
+            return
+
+        if self.policy == POLICY_SWAP:
+            # Empty VRAM before bringing in the next pipeline
+            for other in list(self.on_device):
+                self._move(other, "cpu")
+            if self.device.startswith("cuda"):
+                import torch
+                torch.cuda.empty_cache()
+        self._move(name, self.device)
+
+    def transfer_report(self):
+        """ Total transfer count and seconds for each pipeline """
+        report = {}
+        for (name, _, seconds) in self.transfers:
+            (count, total) = report.get(name, (0, 0.0))
+            report[name] = (count + 1, total + seconds)
+        return report
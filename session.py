@@ -0,0 +1,125 @@
+"""
+Saves an evolution session as it goes and restores it later. A session
+directory holds session.jsonl, one line per displayed generation with
+the parameters and lineage of every genome, and an image store of PNGs
+named by phenotype key. Lines only reference images, so an image shared
+by many generations is written once. Writing happens on a background
+thread, so saving never stalls the window.
+
+Example:
+    evolver = SDEvolver(load = False)
+    evolver.session = Session("sessions/cat")
+    evolver.session.restore(evolver) # does nothing for a new session
+    evolver.start_evolution()
+"""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from phenotype_cache import PhenotypeCache, phenotype_key
+from genome import genome_from_metadata, reserve_genome_ids
+from instrumentation import tracer
+import genome as genome_module
+
+SESSION_FILE = "session.jsonl"
+IMAGE_DIR = "images"
+
+class Session:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, SESSION_FILE)
+        # Never evicts: lines of the session refer to these images
+        self.images = PhenotypeCache(os.path.join(directory, IMAGE_DIR), max_bytes=None)
+        self.writer = ThreadPoolExecutor(max_workers=1) # one thread keeps lines in order
+
+    def save_generation(self, evolver):
+        """
+        Record the population on screen. Call once its images are rendered.
+        The line records how deep the history is, so that going back with
+        "Previous Generation" and evolving again restores correctly.
+        """
+        settings = evolver.render_settings()
+        genomes = [(type(g).__name__, g.metadata(), phenotype_key(g, settings), g.image) for g in evolver.genomes]
+        record = {
+            "generation" : evolver.generation,
+            "depth" : len(evolver.evolution_history),
+            "next_genome_id" : genome_module.genome_id,
+            "prompt" : evolver.prompt,
+            "neg_prompt" : evolver.neg_prompt,
+            "genomes" : [{"class" : name, "metadata" : metadata, "image" : key if image else None}
+                         for (name, metadata, key, image) in genomes]
+        }
+        self.writer.submit(self._write, record, [(key, image) for (_, _, key, image) in genomes if image])
+
+    def _write(self, record, images):
+        try:
+            with tracer.span("save_session", images=len(images)):
+                for (key, image) in images:
+                    self.images.put(key, image)
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+        except Exception as e:
+            print(f"Could not save session generation {record['generation']}: {e}")
+
+    def load_records(self):
+        """ One dict per saved generation line, oldest first. Empty for a new session """
+        if not os.path.exists(self.path):
+            return []
+        records = []
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    print(f"Skipping damaged line in {self.path}") # likely cut off by a crash
+        return records
+
+    def _genomes(self, record):
+        classes = {c.__name__: c for c in (genome_module.SDGenome, genome_module.SDXLGenome,
+                                             genome_module.SDLatentGenome, genome_module.SDXLLatentGenome)}
+        genomes = []
+        for entry in record["genomes"]:
+            g = genome_from_metadata(entry["metadata"], classes.get(entry["class"]))
+            g.session_image = entry["image"]
+            genomes.append(g)
+        return genomes
+
+    def restore(self, evolver):
+        """
+        Put the evolver back where the session left off: population, history,
+        generation and prompts. Images come from the image store, so nothing is
+        rendered. Returns False if there is nothing to restore.
+        """
+        records = self.load_records()
+        if not records:
+            return False
+
+        # Replay the history stack: a line at depth d replaces everything from d on
+        stack = []
+        for record in records:
+            stack = stack[:record["depth"]] + [record]
+
+        for record in stack[:-1]:
+            generation = self._genomes(record)
+            for g in generation:
+                # Loaded only if the user goes back this far
+                if g.session_image:
+                    g.history_image_path = self.images.path(g.session_image)
+            evolver.evolution_history.generations.append(generation)
+
+        latest = stack[-1]
+        evolver.genomes = self._genomes(latest)
+        for g in evolver.genomes:
+            if g.session_image:
+                g.set_image(self.images.get(g.session_image))
+        evolver.generation = latest["generation"]
+        evolver.prompt = latest["prompt"]
+        evolver.neg_prompt = latest["neg_prompt"]
+        reserve_genome_ids(max(record["next_genome_id"] for record in records))
+        print(f"Restored generation {evolver.generation} with {len(stack) - 1} earlier generations from {self.directory}")
+        return True
+
+    def close(self):
+        """ Wait for pending writes """
+        self.writer.shutdown(wait=True)
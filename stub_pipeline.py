@@ -0,0 +1,78 @@
+"""
+Stand-ins for the diffusion pipelines, for benchmarks and for trying the
+evolution loop without a GPU or downloaded models. The stub "renders" a
+deterministic noise image from the genome parameters after sleeping for
+a configurable time, so timings behave like a real pipeline's: a fixed
+cost per call plus a cost per step for the whole batch.
+
+Example:
+    evolver = StubEvolver(seconds_per_step = 0.01, image_size = 256)
+    evolver.evolve([], "a white cat", "")
+    evolver.render_genomes(evolver.genomes, lambda: False, None)
+"""
+
+import hashlib
+import time
+import numpy as np
+from PIL import Image
+from evolution import Evolver
+from genome import SDGenome, SDLatentGenome
+from render_scheduler import render_steps
+
+STUB_IMAGE_SIZE = 512
+STUB_SECONDS_PER_STEP = 0.0 # sleep per denoising step of a whole batch
+STUB_SECONDS_PER_CALL = 0.0 # sleep per pipeline call
+STUB_LOAD_SECONDS = 0.0
+
+class StubPipeline:
+    def __init__(self, image_size = STUB_IMAGE_SIZE, seconds_per_step = STUB_SECONDS_PER_STEP, seconds_per_call = STUB_SECONDS_PER_CALL):
+        self.image_size = image_size
+        self.seconds_per_step = seconds_per_step
+        self.seconds_per_call = seconds_per_call
+        self.calls = 0
+        self.images = 0
+
+    def image_for(self, g):
+        """ The same image for the same parameters, every time and on every machine """
+        text = f"{g.prompt}|{g.neg_prompt}|{g.seed}|{render_steps(g)}|{g.guidance_scale:.6f}|{getattr(g, 'noise_terms', '')}"
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+        rng = np.random.default_rng(seed)
+        # Upscaled coarse noise compresses and resizes like a real image rather than like static
+        coarse = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+        return Image.fromarray(coarse, "RGB").resize((self.image_size, self.image_size), Image.BILINEAR)
+
+    def __call__(self, genomes):
+        """ Images for a batch of genomes that share their step count """
+        steps = max(render_steps(g) for g in genomes)
+        time.sleep(self.seconds_per_call + self.seconds_per_step * steps)
+        self.calls += 1
+        self.images += len(genomes)
+        return [self.image_for(g) for g in genomes]
+
+class StubEvolver(Evolver):
+    """ SDEvolver with the pipeline replaced by a StubPipeline """
+    def __init__(self, image_size = STUB_IMAGE_SIZE, seconds_per_step = STUB_SECONDS_PER_STEP,
+                 seconds_per_call = STUB_SECONDS_PER_CALL, load_seconds = STUB_LOAD_SECONDS, device = "cpu", load = True):
+        Evolver.__init__(self, device = device)
+        self.stub_load_seconds = load_seconds
+        self.image_size = image_size
+        self.pipe = StubPipeline(image_size, seconds_per_step, seconds_per_call)
+        if load:
+            self.load_model()
+
+    def load_model(self):
+        time.sleep(self.stub_load_seconds)
+        self.model_loaded = True
+
+    def render_settings(self):
+        # Stub images must never be mistaken for the real model's renders of the same genome
+        settings = Evolver.render_settings(self)
+        settings["stub"] = True
+        return settings
+
+    def initialize_population(self):
+        genome_class = SDLatentGenome if self.latent_genomes else SDGenome
+        self.genomes = [genome_class(self.prompt, self.neg_prompt, seed, self.steps, self.guidance_scale) for seed in range(self.population_size)]
+
+    def generate_images(self, genomes):
+        return self.pipe(genomes)
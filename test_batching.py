@@ -0,0 +1,86 @@
+"""
+Checks that rendering genomes in one batched pipeline call gives every
+genome the same image as rendering it alone. Runs on the CPU with a
+stand-in pipeline that draws its noise from the generators it is passed,
+as the diffusers pipelines do. Run with: python -m pytest test_batching.py
+"""
+
+import numpy as np
+import torch
+from PIL import Image
+from evolution import SDEvolver
+from genome import SDGenome, SDLatentGenome
+from phenotype_cache import PhenotypeCache
+
+LATENT_SHAPE = (4, 8, 8)
+
+class Config:
+    in_channels = LATENT_SHAPE[0]
+    sample_size = LATENT_SHAPE[1]
+
+class Unet:
+    config = Config()
+
+class Output:
+    def __init__(self, images):
+        self.images = images
+
+class GeneratorPipeline:
+    """ Turns each image's initial noise, prompt embedding and settings into pixels """
+    _execution_device = "cpu"
+    unet = Unet()
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def _encode_prompt(self, prompt, device, num_images, guidance, neg_prompt):
+        embeds = [torch.full((1, 4), float(sum(map(ord, text)) % 97)) for text in (neg_prompt, prompt)]
+        return torch.cat(embeds)
+
+    def __call__(self, prompt, prompt_embeds, negative_prompt_embeds, generator, latents, guidance_scale, num_inference_steps):
+        n = prompt_embeds.shape[0]
+        assert len(generator) == n, "one generator per image"
+        self.batch_sizes.append(n)
+        if latents is None:
+            latents = torch.stack([torch.randn(LATENT_SHAPE, generator=gen) for gen in generator])
+        images = []
+        for i in range(n):
+            x = latents[i] * guidance_scale + prompt_embeds[i].sum() - negative_prompt_embeds[i].sum() + num_inference_steps
+            pixels = (x[:3].numpy() * 16).astype(np.int64) % 256
+            images.append(Image.fromarray(pixels.transpose(1, 2, 0).astype(np.uint8), "RGB"))
+        return Output(images)
+
+def make_evolver(directory):
+    evolver = SDEvolver(device = "cpu", load = False)
+    evolver.phenotype_cache = PhenotypeCache(str(directory / "phenotype_cache"))
+    evolver.resolve_device()
+    evolver.pipe = GeneratorPipeline()
+    evolver.model_loaded = True
+    return evolver
+
+def assert_batch_matches_singles(genomes, directory):
+    evolver = make_evolver(directory)
+    batched = evolver.generate_images(genomes)
+    assert evolver.pipe.batch_sizes == [len(genomes)]
+    for (g, image) in zip(genomes, batched):
+        alone = make_evolver(directory).generate_images([g])[0]
+        assert np.array_equal(np.asarray(image), np.asarray(alone)), f"batched image of {g} differs"
+
+def test_seeded_batch_matches_batch_of_one(tmp_path):
+    assert_batch_matches_singles([SDGenome("a white cat", "", seed, 20, 7.5, False) for seed in (1, 2, 3, 2 ** 63 + 5)], tmp_path)
+
+def test_latent_noise_batch_matches_batch_of_one(tmp_path):
+    genomes = [SDLatentGenome("a white cat", "", seed, 20, 7.5, False) for seed in (1, 2, 3)]
+    genomes.append(genomes[0].crossover(genomes[1]))
+    genomes[1].perturb_noise(0.2)
+    assert_batch_matches_singles(genomes, tmp_path)
+
+def test_make_batches_groups_matching_settings(tmp_path):
+    evolver = make_evolver(tmp_path)
+    evolver.max_batch_size = 2
+    genomes = [SDGenome("a white cat", "", seed, 20, 7.5, False) for seed in range(3)]
+    genomes.append(SDGenome("a white cat", "", 9, 30, 7.5, False))
+    batches = evolver.make_batches(genomes)
+    assert [len(batch) for batch in batches] == [2, 1, 1]
+    for batch in batches:
+        assert len(set(evolver.batch_key(g) for g in batch)) == 1
@@ -0,0 +1,54 @@
+"""
+Checks the contract of Population.replay: a generation bred again from its
+lineage has the same rows, and the run continues from it exactly as it did
+the first time. Run with: python -m pytest test_population.py
+"""
+
+import numpy as np
+from population import Population
+from stub_pipeline import StubEvolver
+
+def assert_same_rows(a, b):
+    assert a.generation == b.generation
+    for name in ("ids", "parent_ids", "seeds", "steps", "guidance_scales", "refine_steps", "denoising_splits"):
+        (x, y) = (getattr(a, name), getattr(b, name))
+        assert (x is None and y is None) or np.array_equal(x, y), f"{name} differs"
+
+def breed(population, generations):
+    populations = [population]
+    for i in range(generations):
+        population = population.next_generation([i % len(population), len(population) - 1], 50)
+        populations.append(population)
+    return populations
+
+def test_replay_breeds_the_same_generation_and_continues_the_same():
+    for refine_steps in (None, 20):
+        populations = breed(Population.random(50, "a white cat", "", refine_steps = refine_steps, seed = 3), 4)
+        again = populations[-1].replay(2)
+        assert_same_rows(again, populations[2])
+        # The generations after it are bred again exactly too, with new ids
+        later = again.next_generation([2, 49], 50)
+        for name in ("seeds", "steps", "guidance_scales", "refine_steps"):
+            (x, y) = (getattr(later, name), getattr(populations[3], name))
+            assert (x is None and y is None) or np.array_equal(x, y), f"{name} differs"
+        assert sorted(later.lineage) == [1, 2, 3]
+        assert_same_rows(later.replay(1), populations[1])
+
+def test_evolver_breeds_with_population(tmp_path):
+    evolver = StubEvolver(image_size = 64)
+    evolver.vectorized_population = True
+    evolver.population_size = 12
+    evolver.evolution_history.directory = str(tmp_path / "history")
+    evolver.fill_with_images_from_genomes = lambda genomes: None # no front end
+    evolver.evolve([], "a white cat", "")
+    first = evolver.genomes
+    evolver.evolve([3, 5], "a white cat", "")
+    assert len(evolver.genomes) == 12
+    assert evolver.genomes[:2] == [first[3], first[5]]
+    assert all(g.parent_id in (first[3].id, first[5].id) for g in evolver.genomes[2:])
+    assert [g.id for g in evolver.genomes] == list(evolver.population.ids)
+    # Going back forgets the Population, the next one is built from the restored genomes
+    evolver.previous_generation()
+    evolver.evolve([0], "a black cat", "")
+    assert evolver.population.generation == 1
+    assert all(g.prompt == "a black cat" for g in evolver.genomes[1:])
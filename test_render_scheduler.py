@@ -0,0 +1,40 @@
+"""
+Checks that capping steps to keep within a budget only changes the render,
+never the genomes. Run with: python -m pytest test_render_scheduler.py
+"""
+
+from genome import SDGenome
+from phenotype_cache import PhenotypeCache, phenotype_key
+from render_scheduler import RenderScheduler, OVER_BUDGET_CAP, MIN_CAPPED_STEPS, render_steps
+from stub_pipeline import StubEvolver
+
+def make_evolver(directory, budget_seconds):
+    evolver = StubEvolver(image_size = 16)
+    evolver.phenotype_cache = PhenotypeCache(str(directory / "phenotype_cache"))
+    evolver.scheduler = RenderScheduler(budget_seconds, OVER_BUDGET_CAP)
+    return evolver
+
+def test_capped_genomes_keep_their_steps(tmp_path):
+    evolver = make_evolver(tmp_path, 0.0)
+    genomes = [SDGenome("a white cat", "", seed, 20, 7.5, False) for seed in range(3)]
+    evolver.render_genomes(genomes, lambda: False, None)
+    evolver.phenotype_cache.flush()
+
+    for g in genomes:
+        assert g.num_inference_steps == 20
+        assert render_steps(g) == MIN_CAPPED_STEPS
+        assert g.image
+        # A capped image is not what the genome renders to, so it is not cached as such
+        assert not evolver.phenotype_cache.on_disk(phenotype_key(g, evolver.render_settings()))
+    assert evolver.scheduler.jobs[0]["steps"] == MIN_CAPPED_STEPS
+
+def test_cap_only_applies_to_the_render_it_was_planned_for(tmp_path):
+    g = SDGenome("a white cat", "", 1, 20, 7.5, False)
+    make_evolver(tmp_path, 0.0).render_genomes([g], lambda: False, None)
+    g.set_image(None)
+    evolver = make_evolver(tmp_path, None)
+    evolver.render_genomes([g], lambda: False, None)
+    evolver.phenotype_cache.flush()
+    assert render_steps(g) == 20
+    assert evolver.scheduler.jobs[0]["steps"] == 20
+    assert evolver.phenotype_cache.on_disk(phenotype_key(g, evolver.render_settings()))
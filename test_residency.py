@@ -0,0 +1,92 @@
+"""
+Checks ModelResidency on the CPU with small torch modules standing in for
+the pipelines. "cuda" is only a name here: the stand-in pipelines record
+where they are moved instead of moving. Run with: python -m pytest test_residency.py
+"""
+
+import pytest
+import torch
+from PIL import Image
+from evolution import SDXLEvolver
+from genome import SDXLGenome
+from phenotype_cache import PhenotypeCache, phenotype_key
+from residency import (ModelResidency, pipe_bytes, POLICY_AUTO, POLICY_RESIDENT, POLICY_SWAP,
+                       POLICY_MODEL_OFFLOAD, RESIDENT_HEADROOM)
+
+class Pipe:
+    """ The parts of a diffusers pipeline that ModelResidency uses """
+    def __init__(self, size = 100):
+        self.components = {"unet" : torch.nn.Linear(size, size), "scheduler" : object()}
+        self.device = "cpu"
+        self.moves = []
+
+    def to(self, device):
+        self.device = device
+        self.moves.append(device)
+        return self
+
+@pytest.fixture
+def fake_cuda(monkeypatch):
+    """ Pretend a GPU with the returned amount of free memory is present """
+    free = {"bytes" : 0}
+    monkeypatch.setattr(torch.cuda, "mem_get_info", lambda device = None: (free["bytes"], free["bytes"]))
+    monkeypatch.setattr(torch.cuda, "synchronize", lambda device = None: None)
+    monkeypatch.setattr(torch.cuda, "empty_cache", lambda: None)
+    return free
+
+def test_pipe_bytes_counts_modules_only():
+    assert pipe_bytes(Pipe(100)) == (100 * 100 + 100) * 4
+
+def test_policy_choice(fake_cuda):
+    pipes = {"base" : Pipe(), "refiner" : Pipe()}
+    needed = sum(pipe_bytes(pipe) for pipe in pipes.values())
+
+    fake_cuda["bytes"] = int(needed * RESIDENT_HEADROOM) + 1
+    assert ModelResidency(pipes, "cuda", POLICY_AUTO).policy == POLICY_RESIDENT
+    fake_cuda["bytes"] = needed
+    assert ModelResidency(pipes, "cuda", POLICY_AUTO).policy == POLICY_SWAP
+    # A single pipeline has nothing to swap with
+    assert ModelResidency({"base" : Pipe()}, "cuda", POLICY_AUTO).policy == POLICY_RESIDENT
+    # The CPU renders with everything where it already is
+    assert ModelResidency(pipes, "cpu", POLICY_AUTO).policy == POLICY_RESIDENT
+    assert ModelResidency(pipes, "cpu", POLICY_MODEL_OFFLOAD).policy == POLICY_RESIDENT
+
+def test_swap_moves_one_pipe_at_a_time_and_reports_transfers(fake_cuda):
+    pipes = {"base" : Pipe(), "refiner" : Pipe()}
+    residency = ModelResidency(pipes, "cuda", POLICY_SWAP)
+    assert residency.transfers == []
+
+    residency.activate("base")
+    residency.activate("base") # already there
+    residency.activate("refiner")
+    residency.activate("base")
+    assert pipes["base"].moves == ["cuda", "cpu", "cuda"]
+    assert pipes["refiner"].moves == ["cuda", "cpu"]
+    assert residency.on_device == {"base"}
+    report = residency.transfer_report()
+    assert {name : count for (name, (count, _)) in report.items()} == {"base" : 3, "refiner" : 2}
+    assert all(seconds >= 0 for (_, seconds) in report.values())
+
+def test_resident_moves_every_pipe_once(fake_cuda):
+    pipes = {"base" : Pipe(), "refiner" : Pipe()}
+    residency = ModelResidency(pipes, "cuda", POLICY_RESIDENT)
+    for name in ("base", "refiner", "base", "refiner"):
+        residency.activate(name)
+    assert [pipe.moves for pipe in pipes.values()] == [["cuda"], ["cuda"]]
+    assert {name : count for (name, (count, _)) in residency.transfer_report().items()} == {"base" : 1, "refiner" : 1}
+
+def test_fully_cached_population_moves_no_pipe(fake_cuda, tmp_path):
+    evolver = SDXLEvolver(True, device = "cuda", load = False)
+    evolver.pipe = Pipe()
+    evolver.refiner_pipe = Pipe()
+    evolver.residency = ModelResidency({"base" : evolver.pipe, "refiner" : evolver.refiner_pipe}, "cuda", POLICY_SWAP)
+    evolver.model_loaded = True
+    evolver.phenotype_cache = PhenotypeCache(str(tmp_path / "phenotype_cache"))
+    genomes = [SDXLGenome("a white cat", "", seed, 20, 7.5, 20, False) for seed in range(4)]
+    for g in genomes:
+        evolver.phenotype_cache.put(phenotype_key(g, evolver.render_settings()), Image.new("RGB", (8, 8)))
+
+    evolver.render_genomes(genomes, lambda: False, None)
+    assert all(g.image for g in genomes)
+    assert evolver.residency.transfers == []
+    assert evolver.residency.transfer_report() == {}
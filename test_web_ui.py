@@ -0,0 +1,103 @@
+"""
+Drives the browser front end over a real WebSocket, with the stub evolver
+standing in for the model. Run with: python -m pytest test_web_ui.py
+"""
+
+import asyncio
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+from aiohttp.test_utils import TestClient, TestServer
+import web_ui
+from phenotype_cache import PhenotypeCache
+from stub_pipeline import StubEvolver
+
+TIMEOUT = 10 # seconds to wait for any one message
+
+def make_server(directory):
+    evolver = StubEvolver(image_size = 64)
+    evolver.population_size = 4
+    evolver.phenotype_cache = PhenotypeCache(str(directory / "phenotype_cache"))
+    evolver.evolution_history.directory = str(directory / "history")
+    return web_ui.WebServer(evolver)
+
+async def receive_until(ws, kind):
+    while True:
+        message = await ws.receive_json(timeout = TIMEOUT)
+        if message["type"] == kind:
+            return message
+
+async def receive_population(ws):
+    """ Wait for the next non-empty population and all of its thumbnails, returning their ids """
+    size = None
+    ids = {}
+    while not size or len(ids) < size:
+        message = await ws.receive_json(timeout = TIMEOUT)
+        if message["type"] == "population":
+            (size, ids) = (message["size"], {})
+        elif message["type"] == "image" and size is not None:
+            ids[message["index"]] = message["id"]
+    return ids
+
+async def run(server, test):
+    client = TestClient(TestServer(server.make_app()))
+    await client.start_server()
+    try:
+        await test(client)
+    finally:
+        await client.close()
+
+def test_evolve_and_open_full_image(tmp_path):
+    async def test(client):
+        async with client.ws_connect("/ws") as ws:
+            session_id = (await receive_until(ws, "session"))["id"]
+            await ws.send_json({"type" : "reset", "prompt" : "a white cat", "neg_prompt" : ""})
+            assert len(await receive_population(ws)) == 4
+
+            await ws.send_json({"type" : "evolve", "selected" : [0, 1]})
+            ids = await receive_population(ws)
+            assert len(ids) == 4
+            response = await client.get(f"/image/{session_id}/{ids[3]}.png")
+            assert response.status == 200
+            assert (await response.read()).startswith(b"\x89PNG")
+            response = await client.get(f"/image/{session_id}/123456789.png")
+            assert response.status == 404
+
+    asyncio.run(run(make_server(tmp_path), test))
+
+def test_bad_message_is_answered_without_closing(tmp_path):
+    async def test(client):
+        async with client.ws_connect("/ws") as ws:
+            await receive_until(ws, "session")
+            await ws.send_json({"type" : "reset", "prompt" : "a white cat", "neg_prompt" : ""})
+            await receive_population(ws)
+            for bad in ({"type" : "evolve", "selected" : [42]}, {"type" : "evolve", "selected" : "0"}, {"type" : "dance"}):
+                await ws.send_json(bad)
+                assert (await receive_until(ws, "error"))["text"]
+            await ws.send_str("not json")
+            await receive_until(ws, "error")
+
+            await ws.send_json({"type" : "evolve", "selected" : [0]})
+            assert (await receive_until(ws, "population"))["generation"] == 1
+            assert not ws.closed
+
+    asyncio.run(run(make_server(tmp_path), test))
+
+def test_connected_sessions_are_not_evicted(tmp_path, monkeypatch):
+    monkeypatch.setattr(web_ui, "MAX_SESSIONS", 1)
+    server = make_server(tmp_path)
+    async def test(client):
+        async with client.ws_connect("/ws") as first:
+            first_id = (await receive_until(first, "session"))["id"]
+            async with client.ws_connect("/ws") as second:
+                second_id = (await receive_until(second, "session"))["id"]
+                assert first_id in server.sessions
+            while server.sessions[second_id].sockets:
+                await asyncio.sleep(0.01)
+            # Once the second page is gone, its idle session makes room for a new one
+            async with client.ws_connect("/ws") as third:
+                await receive_until(third, "session")
+                assert first_id in server.sessions
+                assert second_id not in server.sessions
+
+    asyncio.run(run(server, test))
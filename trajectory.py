@@ -0,0 +1,82 @@
+"""
+Checkpoints of partial denoising trajectories, so a child that kept its
+parent's seed and noise can skip the first steps of its render. A
+mutation that only changes the step count or guidance scale leaves the
+early, high noise part of the trajectory nearly unchanged. The child
+starts from a saved parent latent instead: it is noised up to the
+nearest noise level of the child's own schedule and then denoised from
+there.
+
+A resumed render is close to, but not exactly, the image a full render
+would give, so resumed images are never put in the phenotype cache, and
+only full renders save checkpoints. A grandchild therefore resumes from
+latents that never drifted, and drift cannot compound over generations.
+Run "python benchmark.py trajectory" to measure speed and drift.
+"""
+
+import json
+from collections import OrderedDict
+
+TRAJECTORY_CHECKPOINTS = (0.2, 0.4) # fractions of the schedule after which latents are saved
+TRAJECTORY_MAX_BYTES = 512 * 1024 ** 2 # CPU memory for saved latents
+MAX_RESUME_FRACTION = 0.4 # most of a child's steps that may be skipped
+GUIDANCE_TOLERANCE = 1.0 # largest guidance difference from the parent that still resumes
+
+def trajectory_key(g):
+    """ Everything about a genome that decides the noise it starts from and what it denoises toward """
+    noise = g.noise_recipe() if hasattr(g, "noise_recipe") else None
+    return json.dumps([g.prompt, g.neg_prompt, g.seed, noise], sort_keys=True, default=str)
+
+class TrajectoryCache:
+    def __init__(self, max_bytes = TRAJECTORY_MAX_BYTES, checkpoints = TRAJECTORY_CHECKPOINTS):
+        self.max_bytes = max_bytes
+        self.checkpoints = checkpoints
+        self.entries = OrderedDict() # trajectory key -> list of (sigma, guidance, latents on the CPU, id of the genome that saved them)
+        self.total_bytes = 0
+        self.resumed = 0
+        self.full = 0
+        self.skipped_steps = 0
+
+    def checkpoint_indices(self, steps):
+        """ Step indices of a schedule with this many steps after which latents are saved """
+        return sorted(set(max(0, round(fraction * steps) - 1) for fraction in self.checkpoints))
+
+    def put(self, g, sigma, guidance_scale, latents):
+        """ Save one genome's latents at noise level sigma, as a CPU tensor """
+        key = trajectory_key(g)
+        latents = latents.detach().to("cpu")
+        checkpoints = self.entries.pop(key, [])
+        checkpoints.append((float(sigma), float(guidance_scale), latents, g.id))
+        self.entries[key] = checkpoints
+        self.total_bytes += latents.numel() * latents.element_size()
+        while self.total_bytes > self.max_bytes and self.entries:
+            (_, dropped) = self.entries.popitem(last=False)
+            self.total_bytes -= sum(l.numel() * l.element_size() for (_, _, l, _) in dropped)
+
+    def resume_point(self, g, sigmas):
+        """
+        (step index, checkpoint sigma, latents) for the latest step of the schedule
+        with noise levels sigmas that g can resume at, or None to render in full.
+        sigmas is the scheduler's list of noise levels, one per step plus the final 0.
+        A genome never resumes from its own checkpoints, so re-rendering it gives the full image.
+        """
+        key = trajectory_key(g)
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        steps = len(sigmas) - 1
+        most = int(MAX_RESUME_FRACTION * steps)
+        best = None
+        for (sigma, guidance, latents, owner) in self.entries[key]:
+            if owner == g.id or abs(guidance - g.guidance_scale) > GUIDANCE_TOLERANCE:
+                continue
+            # Latest step that is still at least as noisy as the checkpoint, so noise is only ever added
+            index = max([i for i in range(steps) if sigmas[i] >= sigma] or [0])
+            index = min(index, most)
+            if index > 0 and (best is None or index > best[0]):
+                best = (index, sigma, latents)
+        return best
+
+    def stats(self):
+        return {"trajectories" : len(self.entries), "bytes" : self.total_bytes, "resumed" : self.resumed,
+                "full" : self.full, "skipped_steps" : self.skipped_steps}
@@ -0,0 +1,355 @@
+"""
+Browser front end, an alternative to the Tk window for remote GPU boxes.
+One loaded model is shared by every browser session. Each session gets
+its own forked evolver with its own population and history, and its own
+render thread, and a lock makes sessions take turns on the model. Each
+image is pushed over a WebSocket as a small JPEG thumbnail as soon as it
+is ready, and the full PNG is fetched only when it is opened.
+
+Needs aiohttp (pip install -r requirements-web.txt).
+
+Example:
+    python web_ui.py serve --model sd --port 8080
+    python web_ui.py serve --model stub # no GPU needed
+    python web_ui.py client --url http://localhost:8080 --generations 3
+"""
+
+import argparse
+import asyncio
+import base64
+import io
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from render_worker import RenderWorker
+from png_metadata import png_info
+
+try:
+    import aiohttp
+    from aiohttp import web
+except ImportError:
+    aiohttp = None
+
+THUMBNAIL_SIZE = 256 # longest side of pushed thumbnails
+THUMBNAIL_QUALITY = 80 # JPEG quality of pushed thumbnails
+POLL_SECONDS = 0.1 # how often each session checks for finished renders
+MAX_SESSIONS = 16 # least recently used sessions beyond this are closed
+
+def thumbnail_data(image):
+    """ Base64 JPEG thumbnail of image, for sending inside JSON """
+    thumb = image.convert("RGB")
+    thumb.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    buffer = io.BytesIO()
+    thumb.save(buffer, "JPEG", quality=THUMBNAIL_QUALITY)
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+class WebViewer:
+    """ The part of ImageGridViewer that Evolver.fill_with_images_from_genomes uses """
+    def __init__(self, session):
+        self.session = session
+
+    def clear_images(self):
+        self.session.sent = set()
+        self.session.new_population = True
+
+class WebSession:
+    def __init__(self, session_id, evolver, render_lock):
+        self.id = session_id
+        self.evolver = evolver
+        self.render_lock = render_lock
+        self.sent = set() # indices of the displayed population already pushed
+        self.new_population = False
+        self.status = None
+        self.sockets = 0 # open WebSockets, a session is only closed while it has none
+        evolver.viewer = WebViewer(self)
+        evolver.worker = RenderWorker(self.render)
+        evolver.fill_with_images_from_genomes([])
+
+    def render(self, genomes, cancelled, publish):
+        """ Runs on this session's render thread, waiting its turn on the shared model """
+        with self.render_lock:
+            if not cancelled():
+                self.evolver.render_genomes(genomes, cancelled, publish)
+
+    def handle(self, message):
+        """ Apply one message from the browser. Raises ValueError if it is malformed """
+        if not isinstance(message, dict):
+            raise ValueError("message is not an object")
+        kind = message.get("type")
+        prompt = message.get("prompt", self.evolver.prompt)
+        neg_prompt = message.get("neg_prompt", self.evolver.neg_prompt)
+        if kind == "evolve" and not self.evolver.genomes:
+            kind = "reset" # nothing to select from yet
+        if kind == "evolve":
+            selected = message.get("selected", [])
+            size = len(self.evolver.genomes)
+            if not isinstance(selected, list) or not all(type(i) == int and 0 <= i < size for i in selected):
+                raise ValueError(f"selected must be a list of indices below {size}")
+            # An empty selection resets, just like in the Tk window
+            self.evolver.next_generation([(i, None) for i in selected], prompt, neg_prompt)
+        elif kind == "reset":
+            self.evolver.next_generation([], prompt, neg_prompt)
+        elif kind == "back":
+            self.evolver.previous_generation()
+        else:
+            raise ValueError(f"unknown message type {kind!r}")
+
+    def genome(self, genome_id):
+        for g in self.evolver.displayed_genomes:
+            if g.id == genome_id:
+                return g
+        return None
+
+    def updates(self):
+        """
+        Messages describing what changed since the last call. Image messages
+        hold the PIL image under "image", to be replaced by a thumbnail.
+        """
+        self.evolver.worker.poll()
+        genomes = self.evolver.displayed_genomes
+        messages = []
+        if self.new_population:
+            self.new_population = False
+            messages.append({"type" : "population", "size" : len(genomes), "generation" : self.evolver.generation,
+                             "prompt" : self.evolver.prompt, "neg_prompt" : self.evolver.neg_prompt})
+        for (i, g) in enumerate(genomes):
+            if i not in self.sent and g.image:
+                self.sent.add(i)
+                messages.append({"type" : "image", "index" : i, "id" : g.id, "title" : str(g), "image" : g.image})
+
+        if not self.evolver.model_loaded and not self.evolver.render_pool and len(self.sent) < len(genomes):
+            status = "Loading model..."
+        elif len(self.sent) < len(genomes):
+            status = f"Rendering {len(self.sent)}/{len(genomes)}"
+        else:
+            status = "Ready"
+        if status != self.status:
+            self.status = status
+            messages.append({"type" : "status", "text" : status})
+        return messages
+
+    def close(self):
+        self.evolver.worker.stop()
+
+class WebServer:
+    def __init__(self, evolver):
+        """ evolver is forked for every session, so load its model once up front """
+        self.evolver = evolver
+        self.render_lock = threading.Lock()
+        self.sessions = OrderedDict()
+
+    def session(self, session_id):
+        """ The session with session_id, or a new one when it is unknown """
+        if session_id in self.sessions:
+            self.sessions.move_to_end(session_id)
+            return self.sessions[session_id]
+        session = WebSession(uuid.uuid4().hex, self.evolver.fork(), self.render_lock)
+        self.sessions[session.id] = session
+        while len(self.sessions) > MAX_SESSIONS:
+            # Least recently used first, but never one a browser is still connected to
+            idle = [key for (key, old) in self.sessions.items() if not old.sockets and old is not session]
+            if not idle:
+                break
+            self.sessions.pop(idle[0]).close()
+        print(f"New session {session.id}, {len(self.sessions)} open")
+        return session
+
+    def make_app(self):
+        if aiohttp is None:
+            raise ImportError("The web front end needs aiohttp: pip install -r requirements-web.txt")
+        app = web.Application()
+        app.router.add_get("/", self.index)
+        app.router.add_get("/ws", self.websocket)
+        app.router.add_get("/image/{session}/{genome_id}.png", self.full_image)
+        app.on_shutdown.append(self.shutdown)
+        return app
+
+    async def index(self, request):
+        return web.Response(text=INDEX_HTML, content_type="text/html")
+
+    async def full_image(self, request):
+        session = self.sessions.get(request.match_info["session"])
+        g = session.genome(int(request.match_info["genome_id"])) if session else None
+        if g is None or not g.image:
+            raise web.HTTPNotFound()
+        def encode():
+            buffer = io.BytesIO()
+            g.image.save(buffer, "PNG", pnginfo=png_info(g.metadata()))
+            return buffer.getvalue()
+        data = await asyncio.get_running_loop().run_in_executor(None, encode)
+        return web.Response(body=data, content_type="image/png")
+
+    async def websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        session = self.session(request.query.get("session"))
+        session.sockets += 1
+        session.new_population = True # a reconnecting page needs everything again
+        session.sent = set()
+        session.status = None
+        await ws.send_json({"type" : "session", "id" : session.id})
+
+        pusher = asyncio.create_task(self.push(session, ws))
+        try:
+            async for message in ws:
+                if message.type == aiohttp.WSMsgType.TEXT:
+                    # A bad message is answered, it must not close the socket
+                    try:
+                        session.handle(message.json())
+                    except ValueError as e:
+                        await ws.send_json({"type" : "error", "text" : str(e)})
+        finally:
+            session.sockets -= 1
+            pusher.cancel()
+        return ws
+
+    async def push(self, session, ws):
+        """ Send each session update to the browser. Thumbnails are encoded off the event loop """
+        loop = asyncio.get_running_loop()
+        while not ws.closed:
+            # Collected on the event loop, which is also where messages change the population
+            for message in session.updates():
+                if "image" in message:
+                    message["thumbnail"] = await loop.run_in_executor(None, thumbnail_data, message.pop("image"))
+                await ws.send_json(message)
+            await asyncio.sleep(POLL_SECONDS)
+
+    async def shutdown(self, app):
+        for session in self.sessions.values():
+            session.close()
+
+async def run_client(url, prompt, generations, keep):
+    """
+    Drive a server like a browser would: reset, wait for every thumbnail,
+    open one full image, keep the first few images and evolve. Prints timings.
+    """
+    async with aiohttp.ClientSession() as http:
+        async with http.ws_connect(f"{url}/ws") as ws:
+            session_id = (await ws.receive_json())["id"]
+            await ws.send_json({"type" : "reset", "prompt" : prompt, "neg_prompt" : ""})
+            for step in range(generations):
+                start = time.perf_counter()
+                (size, generation, first, ids) = (None, None, None, {})
+                while not size or len(ids) < size: # the empty population before the reset does not count
+                    message = await ws.receive_json()
+                    if message["type"] == "population":
+                        (size, generation, ids) = (message["size"], message["generation"], {})
+                    elif message["type"] == "image" and size is not None:
+                        ids[message["index"]] = message["id"]
+                        first = first or time.perf_counter() - start
+                async with http.get(f"{url}/image/{session_id}/{ids[0]}.png") as response:
+                    full = await response.read()
+                print(f"Step {step}: generation {generation}, first thumbnail after {first:.2f}s, "
+                      f"{size} thumbnails after {time.perf_counter() - start:.2f}s, full image {len(full)} bytes")
+                await ws.send_json({"type" : "evolve", "selected" : list(range(min(keep, size))), "prompt" : prompt, "neg_prompt" : ""})
+
+INDEX_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<title>Generated Images</title>
+<style>
+body { font-family: sans-serif; margin: 1em; }
+#grid { display: flex; flex-wrap: wrap; gap: 8px; }
+#grid img { border: 4px solid transparent; cursor: pointer; max-width: 256px; }
+#grid img.selected { border-color: royalblue; }
+.row { display: flex; gap: 8px; margin: 4px 0; }
+.row input { flex: 1; }
+</style>
+</head>
+<body>
+<div class="row">Prompt: <input id="prompt"></div>
+<div class="row">Neg prompt: <input id="neg_prompt"></div>
+<div class="row">
+<button id="evolve">Evolve</button>
+<button id="back">Previous Generation</button>
+<button id="reset">Reset</button>
+<span id="status"></span>
+</div>
+<div id="grid"></div>
+<script>
+let sessionId = sessionStorage.getItem("session") || "";
+let ws = null;
+let selected = new Set();
+const grid = document.getElementById("grid");
+
+function send(type, extra) {
+    ws.send(JSON.stringify(Object.assign({
+        type: type,
+        prompt: document.getElementById("prompt").value,
+        neg_prompt: document.getElementById("neg_prompt").value
+    }, extra || {})));
+}
+
+function connect() {
+    ws = new WebSocket(`ws://${location.host}/ws?session=${sessionId}`);
+    ws.onmessage = (event) => {
+        const message = JSON.parse(event.data);
+        if (message.type === "session") {
+            sessionId = message.id;
+            sessionStorage.setItem("session", sessionId);
+        } else if (message.type === "population") {
+            grid.innerHTML = "";
+            selected = new Set();
+            document.getElementById("prompt").value = message.prompt;
+            document.getElementById("neg_prompt").value = message.neg_prompt;
+            for (let i = 0; i < message.size; i++) {
+                const img = document.createElement("img");
+                img.alt = "rendering";
+                img.onclick = () => {
+                    if (selected.has(i)) { selected.delete(i); } else { selected.add(i); }
+                    img.classList.toggle("selected");
+                };
+                img.ondblclick = () => { if (img.dataset.id) { window.open(`/image/${sessionId}/${img.dataset.id}.png`); } };
+                grid.appendChild(img);
+            }
+        } else if (message.type === "image") {
+            const img = grid.children[message.index];
+            img.src = "data:image/jpeg;base64," + message.thumbnail;
+            img.title = message.title + " (double click for full size)";
+            img.dataset.id = message.id;
+        } else if (message.type === "status" || message.type === "error") {
+            document.getElementById("status").textContent = message.text;
+        }
+    };
+    ws.onclose = () => setTimeout(connect, 1000);
+}
+
+document.getElementById("evolve").onclick = () => send("evolve", {selected: [...selected].sort((a, b) => a - b)});
+document.getElementById("back").onclick = () => send("back");
+document.getElementById("reset").onclick = () => send("reset");
+connect();
+</script>
+</body>
+</html>
+"""
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evolve images from a browser.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve = subparsers.add_parser("serve", help="Load the model and serve the front end")
+    serve.add_argument("--model", choices=["sd", "sdxl", "stub"], default="sd")
+    serve.add_argument("--refine", action="store_true", help="Use the SDXL refiner")
+    serve.add_argument("--device", default=None)
+    serve.add_argument("--host", default="127.0.0.1", help="Only this machine by default. Use SSH port forwarding to reach it")
+    serve.add_argument("--port", type=int, default=8080)
+    serve.add_argument("--cache-dir", default=None, help="Phenotype cache directory. Defaults to $SDEVOLUTION_CACHE_DIR or ./phenotype_cache")
+
+    client = subparsers.add_parser("client", help="Drive a running server end to end, printing timings")
+    client.add_argument("--url", default="http://127.0.0.1:8080")
+    client.add_argument("--prompt", default="a white cat")
+    client.add_argument("--generations", type=int, default=3)
+    client.add_argument("--keep", type=int, default=2)
+
+    args = parser.parse_args()
+    if aiohttp is None:
+        parser.error("The web front end needs aiohttp: pip install -r requirements-web.txt")
+    if args.command == "serve":
+        from headless import make_evolver
+        from phenotype_cache import PhenotypeCache
+        evolver = make_evolver(args.model, args.refine, args.device)
+        evolver.phenotype_cache = PhenotypeCache(args.cache_dir)
+        web.run_app(WebServer(evolver).make_app(), host=args.host, port=args.port)
+    else:
+        asyncio.run(run_client(args.url, args.prompt, args.generations, args.keep))